@@ -70,20 +70,19 @@ def checkFailedBackups(courser, time, warning, critical):
     # MySQL needs other Queries than PostgreSQL
     if(databaseType == "psql"):
         query = """
-        SELECT Job.Name,Level,starttime, JobStatus
+        SELECT count(*)
         FROM Job
         Where JobStatus in ('E','f') and starttime > (now()::date-""" + str(time) + """ * '1 day'::INTERVAL);
         """
     # According to --help output, MySQL is the default
     else:
         query = """
-        SELECT Job.Name,Level,starttime, JobStatus
+        SELECT count(*)
         FROM Job
         Where JobStatus in ('E','f') and starttime > DATE_SUB(now(), INTERVAL """ + str(time) + """ DAY);
         """
     courser.execute(query)
-    results = courser.fetchall()  # Returns a value
-    result = len(results)
+    result = courser.fetchone()[0]  # Returns a value
 
     if result >= int(critical):
             checkState["returnCode"] = 2
@@ -162,20 +161,19 @@ def checkOversizedBackups(courser, time, size, kind, unit, warning, critical):
             # MySQL needs other Queries than PostgreSQL
             if(databaseType == "psql"):
                 query = """
-                SELECT Job.Name,Level,starttime, JobBytes/""" + str(float(factor)) + """
+                SELECT count(*)
                 FROM Job
                 Where Level in (""" + kind + """) and starttime > (now()::date-""" + str(time) + """ * '1 day'::INTERVAL) and JobBytes/""" + str(float(factor)) + """>""" + str(size) + """;
                 """
             # MySQL is the default
             else:
                 query = """
-                SELECT Job.Name,Level,starttime, JobBytes/""" + str(float(factor)) + """
+                SELECT count(*)
                 FROM Job
                 Where Level in (""" + kind + """) and starttime > DATE_SUB(now(), INTERVAL """ + str(time) + """ DAY) and JobBytes/""" + str(float(factor)) + """>""" + str(size) + """;
                 """
             courser.execute(query)
-            results = courser.fetchall()  # Returns a value
-            result = len(results) 
+            result = courser.fetchone()[0]  # Returns a value
     
             if result >= int(critical):
                     checkState["returnCode"] = 2
@@ -196,20 +194,19 @@ def checkEmptyBackups(cursor, time, kind, warning, critical):
             # MySQL needs other Queries than PostgreSQL
             if(databaseType == "psql"):
                 query = """
-                SELECT Job.Name,Level,starttime
+                SELECT count(*)
                 FROM Job
                 Where Level in (""" + str(kind) + """) and JobBytes=0 and starttime > (now()::date-""" + str(time) + """ * '1 day'::INTERVAL) and JobStatus in ('T');
                 """
             # MySQL is the default
             else:
                 query = """
-                SELECT Job.Name,Level,starttime
+                SELECT count(*)
                 FROM Job
                 Where Level in (""" + str(kind) + """) and JobBytes=0 and starttime > DATE_SUB(now(), INTERVAL """ + str(time) + """ DAY) and JobStatus in ('T');
                 """
             cursor.execute(query)
-            results = cursor.fetchall()  # Returns a value
-            result = len(results) 
+            result = cursor.fetchone()[0]  # Returns a value
             
             if result >= int(critical):
                     checkState["returnCode"] = 2
@@ -267,20 +264,19 @@ def checkSingleJob(cursor, name, state, kind, time, warning, critical):
     # MySQL needs other Queries than PostgreSQL
     if(databaseType == "psql"):
         query = """
-        Select Job.Name,Job.JobStatus, Job.Starttime
+        Select count(*)
         FROm Job
         Where Job.Name like '%"""+name+"""%' and Job.JobStatus like '"""+state+"""' and (starttime > (now()::date-"""+str(time)+""" * '1 day'::INTERVAL) or starttime IS NULL) and Job.Level in ("""+kind+""");
         """
     # MySQL is the default
     else:
         query = """
-        Select Job.Name,Job.JobStatus, Job.Starttime
+        Select count(*)
         FROm Job
         Where Job.Name like '%"""+name+"""%' and Job.JobStatus like '"""+state+"""' and (starttime > DATE_SUB(now(), INTERVAL """ + str(time) + """ DAY) or starttime IS NULL) and Job.Level in ("""+kind+""");
         """
     cursor.execute(query)
-    results = cursor.fetchall()  # Returns a value 
-    result = len(results)
+    result = cursor.fetchone()[0]  # Returns a value 
 
     if result >= int(critical):
             checkState["returnCode"] = 2
@@ -330,6 +326,135 @@ def checkRunTimeJobs(cursor,name,state,time,warning,critical):
 
     return checkState
 
+
+# Summary of several job checks from one query
+def getJobSummary(cursor, time, border, name=None):
+    # One pass over the Job table for the time window, grouped by
+    # JobStatus/Level/Name. Jobs without starttime (queued) are included like
+    # in checkJobs, Empty/OverSized/Bytes only count jobs that have started.
+    # The job name filter is left to the database so it matches like
+    # Job.Name like '%name%' in checkSingleJob.
+    # MySQL needs other Queries than PostgreSQL
+    if(databaseType == "psql"):
+        window = "now()::date - %s * '1 day'::INTERVAL"
+    # MySQL is the default
+    else:
+        window = "DATE_SUB(now(), INTERVAL %s DAY)"
+    query = """
+    SELECT JobStatus, Level, Name, count(*),
+           SUM(CASE WHEN starttime IS NULL THEN 0 ELSE 1 END),
+           COALESCE(SUM(CASE WHEN starttime IS NULL THEN 0 ELSE JobBytes END), 0),
+           SUM(CASE WHEN starttime IS NOT NULL AND JobBytes = 0 THEN 1 ELSE 0 END),
+           SUM(CASE WHEN starttime IS NOT NULL AND JobBytes > %s THEN 1 ELSE 0 END),
+           SUM(CASE WHEN Name LIKE %s THEN 1 ELSE 0 END)
+    FROM Job
+    Where starttime > """ + window + """ or starttime IS NULL
+    GROUP BY JobStatus, Level, Name;
+    """
+    if name == None:
+        pattern = "%"
+    else:
+        pattern = "%" + name + "%"
+    cursor.execute(query, (border, pattern, int(time)))
+    summary = []
+    for row in cursor.fetchall():  # one row per JobStatus/Level/Name
+        summary.append({"state": row[0], "level": row[1], "name": row[2],
+                        "count": int(row[3]), "started": int(row[4]),
+                        "bytes": float(row[5]), "empty": int(row[6]),
+                        "oversized": int(row[7]), "named": int(row[8]) > 0})
+    return summary
+
+def sumJobSummary(summary, field, states=None, levels=None, named=False):
+    result = 0
+    for row in summary:
+        if states != None and row["state"] not in states:
+            continue
+        if levels != None and row["level"] not in levels:
+            continue
+        if named and not row["named"]:
+            continue
+        result += row[field]
+    return result
+
+def parseThresholds(value, warning, critical):
+    # --check W:C overrides -w/-c for a single check
+    if value == True:
+        return warning, critical
+    try:
+        warning, critical = value.split(":")
+        return float(warning), float(critical)
+    except ValueError:
+        checkState = {}
+        checkState["returnCode"] = 3
+        checkState["returnMessage"] = "UNKNOWN - Invalid threshold '" + str(value) + "', expected WARNING:CRITICAL"
+        checkState["performanceData"] = ";;;;"
+        printNagiosOutput(checkState)
+
+def checkSummary(args):
+    cursor = connectDB(args.user, args.password, args.host, args.database);
+    if checkConnection(cursor):
+        checks = [args.failedBackups, args.checkJobs, args.checkJob, args.emptyBackups, args.oversizedBackups, args.totalBackupsSize]
+        if not any(checks):
+            # Default: everything that needs no further arguments
+            args.failedBackups = args.checkJobs = args.emptyBackups = args.oversizedBackups = True
+            if args.name:
+                args.checkJob = True
+        if args.checkJob and not args.name:
+            checkState = {}
+            checkState["returnCode"] = 3
+            checkState["returnMessage"] = "UNKNOWN - checkJob needs a job name (-n)"
+            checkState["performanceData"] = ";;;;"
+            printNagiosOutput(checkState)
+        # Validate thresholds before touching the catalog
+        thresholds = {}
+        for check in ['failedBackups', 'checkJobs', 'checkJob', 'emptyBackups', 'oversizedBackups', 'totalBackupsSize']:
+            if getattr(args, check):
+                thresholds[check] = parseThresholds(getattr(args, check), args.warning, args.critical)
+        kind = createBackupKindString(args.full, args.inc, args.diff)
+        levels = kind.replace("'", "").split(",")
+        factor = createFactor(args.unit)
+        summary = getJobSummary(cursor, args.time, float(args.size) * factor, args.name)
+        cursor.close();
+
+        # (result, thresholds, message, perfdata label)
+        results = []
+        if args.failedBackups:
+            result = sumJobSummary(summary, "started", states=['E', 'f'])
+            results.append((result, thresholds['failedBackups'], str(result) + " Backups failed/canceled", "Failed"))
+        if args.checkJobs:
+            result = sumJobSummary(summary, "count", states=[args.state], levels=levels)
+            results.append((result, thresholds['checkJobs'], str(result) + " Jobs are in the state: " + str(getState(args.state)), str(getState(args.state))))
+        if args.checkJob:
+            result = sumJobSummary(summary, "count", states=[args.state], levels=levels, named=True)
+            results.append((result, thresholds['checkJob'], str(result) + " " + args.name + " Jobs are in the state: " + str(getState(args.state)), args.name))
+        if args.emptyBackups:
+            result = sumJobSummary(summary, "empty", states=['T'], levels=levels)
+            results.append((result, thresholds['emptyBackups'], str(result) + " successful " + kind + " backups are empty", "EmptyBackups"))
+        if args.oversizedBackups:
+            result = sumJobSummary(summary, "oversized", levels=levels)
+            results.append((result, thresholds['oversizedBackups'], str(result) + " " + kind + " Backups larger than " + str(args.size) + " " + args.unit, "OverSized"))
+        if args.totalBackupsSize:
+            result = round(sumJobSummary(summary, "bytes", levels=levels) / factor, 3)
+            results.append((result, thresholds['totalBackupsSize'], str(result) + " " + args.unit + " Kind:" + kind, "Size"))
+
+        checkState = {}
+        checkState["returnCode"] = 0
+        messages = []
+        perfData = []
+        for result, (warning, critical), message, label in results:
+            if result >= float(critical):
+                checkState["returnCode"] = max(checkState["returnCode"], 2)
+                message = "CRITICAL: " + message
+            elif result >= float(warning):
+                checkState["returnCode"] = max(checkState["returnCode"], 1)
+                message = "WARNING: " + message
+            messages.append(message)
+            perfData.append("'" + label + "'=" + str(result) + ";" + str(warning) + ";" + str(critical) + ";;")
+        prefix = {0: "OK - ", 1: "WARNING - ", 2: "CRITICAL - "}[checkState["returnCode"]]
+        checkState["returnMessage"] = prefix + ", ".join(messages) + " in the last " + str(args.time) + " days"
+        checkState["performanceData"] = " ".join(perfData)
+        printNagiosOutput(checkState)
+
      
 # Checks on Tapes
 def checkTapesInStorage(cursor, warning, critical):
@@ -561,6 +686,25 @@ def argumentParser():
     statusParser.add_argument('-u', '--unit', dest='unit', choices=['MB', 'GB', 'TB', 'PB', 'EB'], default='TB', help='display unit [default=TB]')
    
 
+    summaryParser = subParser.add_parser('summary', help='Evaluate several job checks from one aggregate query');
+    summaryParser.set_defaults(func=checkSummary)
+    summaryParser.add_argument('-fb', '--failedBackups', dest='failedBackups', nargs='?', const=True, metavar='W:C', help='Check if a backup failed in the last n day')
+    summaryParser.add_argument('-js', '--checkJobs', dest='checkJobs', nargs='?', const=True, metavar='W:C', help='Check how many jobs are in a specific state')
+    summaryParser.add_argument('-j', '--checkJob', dest='checkJob', nargs='?', const=True, metavar='W:C', help='Check the state of a specific job (needs -n)')
+    summaryParser.add_argument('-e', '--emptyBackups', dest='emptyBackups', nargs='?', const=True, metavar='W:C', help='Check if a successful backup have 0 bytes')
+    summaryParser.add_argument('-o', '--oversizedBackup', dest='oversizedBackups', nargs='?', const=True, metavar='W:C', help='Check if a backup have more than n TB')
+    summaryParser.add_argument('-b', '--totalBackupsSize', dest='totalBackupsSize', nargs='?', const=True, metavar='W:C', help='the size of all backups in the time window')
+    summaryParser.add_argument('-n', '--name', dest='name', action='store', help='Name of the job, matches every job name containing it (SQL LIKE: case-insensitive on MySQL, case-sensitive on PostgreSQL)')
+    summaryParser.add_argument('-st', '--state', dest='state', choices=['T', 'C', 'R', 'E', 'f','A'], default='C', help='Job state for checkJobs/checkJob [default=C]')
+    summaryParser.add_argument('-f', '--full', dest='full', action='store_true', help='Backup kind full')
+    summaryParser.add_argument('-i', '--inc', dest='inc', action='store_true', help='Backup kind inc')
+    summaryParser.add_argument('-d', '--diff', dest='diff', action='store_true', help='Backup kind diff')
+    summaryParser.add_argument('-t', '--time', dest='time', action='store', help='Time in days [default=7]', default=7)
+    summaryParser.add_argument('-w', '--warning', dest='warning', action='store', help='Warning value for checks without W:C [default=5]', default=5)
+    summaryParser.add_argument('-c', '--critical', dest='critical', action='store', help='Critical value for checks without W:C [default=10]', default=10)
+    summaryParser.add_argument('-s', '--size', dest='size', action='store', help='Border value for oversized backups [default=2]', default=2)
+    summaryParser.add_argument('-u', '--unit', dest='unit', choices=['MB', 'GB', 'TB', 'PB', 'EB'], default='TB', help='display unit [default=TB]')
+
     return parser
 
 def checkConnection(cursor):
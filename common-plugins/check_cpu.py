@@ -20,7 +20,7 @@
 Version = "1.7 $Id$"
 
 # import modules
-import sys, getopt, time
+import sys, getopt, time, os, struct, array
 
 #nagios return codes
 UNKNOWN = 3
@@ -41,8 +41,21 @@ usage = """usage: ./check_cpu.py [-w num|--warn=num] [-c|--crit=num] [-W num |--
   -s, --steal-warn  ... generate warning  if any single cpu exceeds num in steal (default: 30)
   -S, --steal-crit  ... generate critical if any single cpu exceeds num in steal (default: 80)
   -p, --period   ... sample cpu usage over num seconds
+  -t, --state-file=file ... compute usage since the previous run, from the /proc/stat snapshot it saved in file,
+                     instead of sleeping for the sample period (default: off)
+  -m, --max-age=num ... state file snapshots older than num seconds are stale and a new sample is taken (default: 900)
   -a, --abs      ... generate performance stats in cpu-ticks (jiffies), as well as percent
+  -M, --modes    ... add per-mode percentages (user, nice, system, irq, softirq, guest) to the performance stats
   -A, --abs-only ... generate performance stats in cpu-ticks (jiffies), instead of percent
+  -P, --psi      ... check pressure stall information (/proc/pressure/{cpu,io,memory}) instead of cpu ticks.
+                     No sample period is needed. With --state-file the stall time since the previous run is reported too.
+      --psi-cgroup=path ... also check the cpu.pressure of this cgroup (relative to /sys/fs/cgroup, may be repeated).
+                     A pressure file eg. system.slice/io.pressure may be given instead of the cgroup directory
+      --psi-warn=line.field=num ... generate warning  if a pressure line exceeds num percent (may be repeated)
+      --psi-crit=line.field=num ... generate critical if a pressure line exceeds num percent (may be repeated)
+                     line is cpu.some, cpu.full, io.some, io.full, memory.some or memory.full
+                     field is avg10, avg60, avg300 or stall
+                     (default: cpu.some.avg60 25/50, io.full.avg60 10/25, memory.full.avg10 5/10)
   -v  --version  ... print version
 
 Notes:
@@ -52,11 +65,15 @@ Notes:
   A warning/critical will also be generated if any single cpu exceeds a threshold. Specify 100 to disable. eg.
        check_cpu.py -W 100 -C 100 
   'total' includes io_wait and steal (ie. everything except idle)
+  guest time is counted once, as part of user/nice the way the kernel reports it
+  PSI thresholds for cpu.some etc. also apply to the same pressure line of the --psi-cgroup cgroups
 """
 
-cpu_percent = dict()
-io_wait_percent = dict()
-steal_percent = dict()
+# Per-cpu figures are lists in the order of cpu_id_list ('cpu' is the total)
+cpu_percent = []
+io_wait_percent = []
+steal_percent = []
+mode_percent = dict()
 cpu_id_list = []
 ctxt_per_second = 0
 processes_per_second = 0
@@ -74,64 +91,180 @@ steal_crit=80
 proc_stat_file='/proc/stat'
 sample_period = 1
 perfdata_abs = 1
+perfdata_modes = False
+state_file = None
+state_max_age = 900
+psi_mode = False
+psi_dir = '/proc/pressure'
+cgroup_root = '/sys/fs/cgroup'
+psi_cgroups = []
+psi_stats = []
+# PSI thresholds, keyed by (pressure line, field)
+psi_warn = { ('cpu.some','avg60'): 25.0, ('io.full','avg60'): 10.0, ('memory.full','avg10'): 5.0 }
+psi_crit = { ('cpu.some','avg60'): 50.0, ('io.full','avg60'): 25.0, ('memory.full','avg10'): 10.0 }
 
+# Columns of the cpu lines in /proc/stat. Every cpu line is stored as one
+# row of NCOLS ticks in a flat array, rows in the order of the cpu ids.
+# Note that user already includes guest and nice includes guest_nice.
+COLUMNS = ('user', 'nice', 'system', 'idle', 'iowait', 'irq', 'softirq', 'steal', 'guest', 'guest_nice')
+NCOLS = len(COLUMNS)
+(USER, NICE, SYSTEM, IDLE, IOWAIT, IRQ, SOFTIRQ, STEAL, GUEST, GUEST_NICE) = range(NCOLS)
+# Per-mode percentages reported with --modes
+MODES = ('user', 'nice', 'system', 'irq', 'softirq', 'guest')
+try:
+  TICKS_TYPE = array.array('Q').typecode
+except ValueError:
+  # python 2 has no (unsigned) long long arrays
+  TICKS_TYPE = 'L'
+DELTA_TYPE = TICKS_TYPE.lower()
+
+# State file layout: header, the cpu numbers ('cpu' is stored as -1), then the ticks array
+# header: magic, format version, time of the snapshot, btime, ctxt, processes, number of cpus, number of columns
+STATE_MAGIC = b'CPUS'
+STATE_VERSION = 2
+STATE_HEADER = struct.Struct('<4sBdQQQII')
+
+# Pressure stall information (PSI): resources in /proc/pressure, and the fields thresholds can be set on.
+# 'stall' is the percentage of time stalled since the previous run (needs --state-file)
+PSI_RESOURCES = ('cpu', 'io', 'memory')
+PSI_FIELDS = ('avg10', 'avg60', 'avg300', 'stall')
+PSI_STATE_MAGIC = 'PSI1'
+
+# Read /proc/stat, returns dict with 'ids' (cpu ids), 'ticks' (flat array of NCOLS ticks per cpu),
+# 'ctxt', 'processes' and 'btime'
 def get_procstat_now():
-  global cpu_id_list
   global proc_stat_file
-  cpu_id_list=[]
-  cpu_stats = dict()
+  cpu_ids = []
+  ticks = array.array(TICKS_TYPE)
+  cpu_stats = { 'ids': cpu_ids, 'ticks': ticks, 'btime': 0 }
   procstat = open(proc_stat_file,'r')
   procstat_text = procstat.read()
   procstat.close()
+  padding = [0] * NCOLS
   for line in procstat_text.split("\n"):
-    if line.startswith('cpu '):
-      [cpu_id,junk,cpu_ticks] = line.split(' ',2)
-    elif line.startswith('cpu'):
-      [cpu_id,cpu_ticks] = line.split(' ',1)
+    if line.startswith('cpu'):
+      fields = line.split()
+      cpu_ids.append(fields[0])
+      row = [int(x) for x in fields[1:NCOLS+1]]
+      # older kernels have fewer columns
+      ticks.extend(row + padding[len(row):])
     elif line.startswith('ctxt '):
-      cpu_stats['ctxt'] = line.split()[1]
-      continue
+      cpu_stats['ctxt'] = int(line.split()[1])
     elif line.startswith('processes '):
-      cpu_stats['processes'] = line.split()[1]
-      continue
-    else:
-      continue
-    # Fields are:
-    # cpu user nice system idle io_wait hw_intr sw_intr steal guest guest_nice
-    cpu_ticks_array = cpu_ticks.split()
-    while len(cpu_ticks_array) < 10:
-      cpu_ticks_array.append('0')
-    [user,nice,system,idle,io_wait,hw_intr,sw_intr,steal,guest,guest_nice] = cpu_ticks_array
-    cpu_usage = int(user)+int(nice)+int(system)+int(io_wait)+int(hw_intr)+int(sw_intr)+int(steal)+int(guest)+int(guest_nice)
-    cpu_total_ticks = cpu_usage + int(idle)
-    cpu_stats[cpu_id] = cpu_usage
-    cpu_stats[cpu_id+'all'] = cpu_total_ticks
-    cpu_stats[cpu_id+'io_wait'] = int(io_wait)
-    cpu_stats[cpu_id+'steal'] = int(steal)
-    cpu_id_list.append(cpu_id)
+      cpu_stats['processes'] = int(line.split()[1])
+    elif line.startswith('btime '):
+      cpu_stats['btime'] = int(line.split()[1])
   return cpu_stats
 
+# Save a get_procstat_now() snapshot in the state file
+def save_state(cpu_stats, sample_time):
+  cpu_nums = [-1 if cpu_id == 'cpu' else int(cpu_id[3:]) for cpu_id in cpu_stats['ids']]
+  ticks = cpu_stats['ticks']
+  data = b''.join([
+    STATE_HEADER.pack(STATE_MAGIC, STATE_VERSION, sample_time, cpu_stats['btime'], cpu_stats['ctxt'], cpu_stats['processes'], len(cpu_nums), NCOLS),
+    struct.pack('<%di' % len(cpu_nums), *cpu_nums),
+    struct.pack('<%dQ' % len(ticks), *ticks),
+  ])
+  # write and rename, so a concurrent run never reads half a snapshot
+  tmp_file = state_file + '.' + str(os.getpid())
+  try:
+    f = open(tmp_file, 'wb')
+    f.write(data)
+    f.close()
+    os.rename(tmp_file, state_file)
+  except (IOError, OSError):
+    pass
+
+# Load the snapshot saved by the previous run, returns (cpu_stats, sample_time) or (None, None)
+def load_state():
+  try:
+    f = open(state_file, 'rb')
+    data = f.read()
+    f.close()
+    (magic, version, sample_time, btime, ctxt, processes, count, ncols) = STATE_HEADER.unpack_from(data, 0)
+    if magic != STATE_MAGIC or version != STATE_VERSION or ncols != NCOLS:
+      return (None, None)
+    offset = STATE_HEADER.size
+    cpu_nums = struct.unpack_from('<%di' % count, data, offset)
+    offset += 4 * count
+    ticks = array.array(TICKS_TYPE, struct.unpack_from('<%dQ' % (count * NCOLS), data, offset))
+    cpu_ids = ['cpu' if cpu_num < 0 else 'cpu' + str(cpu_num) for cpu_num in cpu_nums]
+    return ({ 'ids': cpu_ids, 'ticks': ticks, 'btime': btime, 'ctxt': ctxt, 'processes': processes }, sample_time)
+  except (IOError, OSError, struct.error):
+    return (None, None)
+
+# Tick deltas between two snapshots, as a flat array in the row order of cpu_stats_t1.
+# CPUs are matched by cpu id: a row without baseline (cpu brought online since t0)
+# or with counters going backwards is all zeros.
+def column_deltas(cpu_stats_t0, cpu_stats_t1):
+  ticks_t0 = cpu_stats_t0['ticks']
+  ticks_t1 = cpu_stats_t1['ticks']
+  if cpu_stats_t0['ids'] != cpu_stats_t1['ids']:
+    rows_t0 = dict((cpu_id, i) for i, cpu_id in enumerate(cpu_stats_t0['ids']))
+    aligned = array.array(TICKS_TYPE)
+    for cpu_id in cpu_stats_t1['ids']:
+      if cpu_id in rows_t0:
+        base = rows_t0[cpu_id] * NCOLS
+        aligned.extend(ticks_t0[base:base+NCOLS])
+      else:
+        aligned.extend(ticks_t1[len(aligned):len(aligned)+NCOLS])
+    ticks_t0 = aligned
+  delta = array.array(DELTA_TYPE, [t1 - t0 for (t0, t1) in zip(ticks_t0, ticks_t1)])
+  for base in range(0, len(delta), NCOLS):
+    if min(delta[base:base+NCOLS]) < 0:
+      delta[base:base+NCOLS] = array.array(DELTA_TYPE, [0] * NCOLS)
+  return delta
+
 # Calculate cpu use for all cpus
 def get_cpu_stats():
-  global cpu_id_list,cpu_percent,io_wait_percent,sample_period,steal_percent,cpu_stats_t1,ctxt_per_second,processes_per_second
-  cpu_stats_t0 = dict()
-  cpu_stats_t1 = dict()
-  cpu_stats_t0 = get_procstat_now()
-  time.sleep(sample_period)
-  cpu_stats_t1 = get_procstat_now()
-  for cpu_id in cpu_id_list:
-    if ( cpu_stats_t1[cpu_id+'all'] - cpu_stats_t0[cpu_id+'all'] ) > 0 :
+  global cpu_id_list,cpu_percent,io_wait_percent,sample_period,steal_percent,mode_percent,cpu_stats_t1,ctxt_per_second,processes_per_second
+  cpu_stats_t0 = None
+  if state_file:
+    (cpu_stats_t0, time_t0) = load_state()
+    cpu_stats_t1 = get_procstat_now()
+    time_t1 = time.time()
+    # Only use the saved snapshot if it is recent and from the same boot
+    if cpu_stats_t0 is not None:
+      age = time_t1 - time_t0
+      if age <= 0 or age > state_max_age or cpu_stats_t0['btime'] != cpu_stats_t1['btime']:
+        cpu_stats_t0 = None
+  if cpu_stats_t0 is None:
+    # First run, stale snapshot or no state file: sample over the sample period
+    cpu_stats_t0 = get_procstat_now()
+    time_t0 = time.time()
+    time.sleep(sample_period)
+    cpu_stats_t1 = get_procstat_now()
+    time_t1 = time.time()
+  if state_file:
+    save_state(cpu_stats_t1, time_t1)
+  cpu_id_list = cpu_stats_t1['ids']
+  delta = column_deltas(cpu_stats_t0, cpu_stats_t1)
+  cpu_percent = []
+  io_wait_percent = []
+  steal_percent = []
+  mode_percent = dict((mode, []) for mode in MODES)
+  for base in range(0, len(delta), NCOLS):
+    row = delta[base:base+NCOLS]
+    # guest time is already part of user and nice, so the total is everything up to steal
+    total = sum(row[USER:STEAL+1])
+    if total > 0:
       # The normal case
-      io_wait_percent[cpu_id] = int(( cpu_stats_t1[cpu_id+'io_wait'] - cpu_stats_t0[cpu_id+'io_wait'] ) * 100 / (cpu_stats_t1[cpu_id+'all'] - cpu_stats_t0[cpu_id+'all'] ))
-      steal_percent[cpu_id] = int(( cpu_stats_t1[cpu_id+'steal'] - cpu_stats_t0[cpu_id+'steal'] ) * 100 / (cpu_stats_t1[cpu_id+'all'] - cpu_stats_t0[cpu_id+'all'] ))
-      cpu_percent[cpu_id] = int(( cpu_stats_t1[cpu_id] - cpu_stats_t0[cpu_id] ) * 100 / (cpu_stats_t1[cpu_id+'all'] - cpu_stats_t0[cpu_id+'all'] ))
+      cpu_percent.append(int((total - row[IDLE]) * 100 / total))
+      io_wait_percent.append(int(row[IOWAIT] * 100 / total))
+      steal_percent.append(int(row[STEAL] * 100 / total))
+      modes = (row[USER] - row[GUEST], row[NICE] - row[GUEST_NICE], row[SYSTEM], row[IRQ], row[SOFTIRQ], row[GUEST] + row[GUEST_NICE])
     else:
       # The case of a VM that has had no cpu cycles devoted to this CPU at all
-      io_wait_percent[cpu_id] = 0
-      steal_percent[cpu_id] = 0
-      cpu_percent[cpu_id] = 0
-  ctxt_per_second = ( float(cpu_stats_t1['ctxt']) - float(cpu_stats_t0['ctxt']) ) / sample_period
-  processes_per_second = ( float(cpu_stats_t1['processes']) - float(cpu_stats_t0['processes']) ) / sample_period
+      cpu_percent.append(0)
+      io_wait_percent.append(0)
+      steal_percent.append(0)
+      modes = (0,) * len(MODES)
+      total = 1
+    for (mode, ticks) in zip(MODES, modes):
+      mode_percent[mode].append(int(max(ticks, 0) * 100 / total))
+  interval = time_t1 - time_t0
+  ctxt_per_second = float(cpu_stats_t1['ctxt'] - cpu_stats_t0['ctxt']) / interval
+  processes_per_second = float(cpu_stats_t1['processes'] - cpu_stats_t0['processes']) / interval
   return 
 
 # Build the performance data message
@@ -140,68 +273,72 @@ def performance_data():
   global warn,crit,io_warn,io_crit,cpu_id_list,cpu_percent,io_wait_percent,steal_percent,ctxt_per_second,processes_per_second
   perf_message_array = []
   if (perfdata_abs&1) == 1:
-    for cpu_id in cpu_id_list:
+    for (i, cpu_id) in enumerate(cpu_id_list):
       if cpu_id == 'cpu':
-        perf_message_array.append(cpu_id +        '=' + str(cpu_percent[cpu_id])     + '%;' + str(warn)            + ';' + str(crit)+';0;' )
-        perf_message_array.append(cpu_id + '_iowait=' + str(io_wait_percent[cpu_id]) + '%;' + str(io_warn_overall) + ';' + str(io_crit_overall)+';0;' )
-        perf_message_array.append(cpu_id +  '_steal=' + str(steal_percent[cpu_id])   + '%;;;0;' )
+        perf_message_array.append('%s=%d%%;%s;%s;0;' % (cpu_id, cpu_percent[i], warn, crit))
+        perf_message_array.append('%s_iowait=%d%%;%s;%s;0;' % (cpu_id, io_wait_percent[i], io_warn_overall, io_crit_overall))
+        perf_message_array.append('%s_steal=%d%%;;;0;' % (cpu_id, steal_percent[i]))
       else:
-        perf_message_array.append(cpu_id +        '=' + str(cpu_percent[cpu_id])     + '%;' + str(per_cpu_warn) + ';' + str(per_cpu_crit) + ';0;' )
-        perf_message_array.append(cpu_id + '_iowait=' + str(io_wait_percent[cpu_id]) + '%;' + str(io_warn)      + ';' + str(io_crit) +';0;' )
-        perf_message_array.append(cpu_id +  '_steal=' + str(steal_percent[cpu_id])   + '%;' + str(steal_warn)   + ';' + str(steal_crit) +';0;' )
+        perf_message_array.append('%s=%d%%;%s;%s;0;' % (cpu_id, cpu_percent[i], per_cpu_warn, per_cpu_crit))
+        perf_message_array.append('%s_iowait=%d%%;%s;%s;0;' % (cpu_id, io_wait_percent[i], io_warn, io_crit))
+        perf_message_array.append('%s_steal=%d%%;%s;%s;0;' % (cpu_id, steal_percent[i], steal_warn, steal_crit))
+      if perfdata_modes:
+        perf_message_array.extend(['%s_%s=%d%%;;;0;' % (cpu_id, mode, mode_percent[mode][i]) for mode in MODES])
   if (perfdata_abs&2) == 2:
-    for cpu_id in cpu_id_list:
-      perf_message_array.append(cpu_id +    '.all=' + str(cpu_stats_t1[cpu_id+'all'])     + 'c' )
-      perf_message_array.append(cpu_id +   '.busy=' + str(cpu_stats_t1[cpu_id])           + 'c' )
-      perf_message_array.append(cpu_id + '.iowait=' + str(cpu_stats_t1[cpu_id+'io_wait']) + 'c' )
-      perf_message_array.append(cpu_id +  '.steal=' + str(cpu_stats_t1[cpu_id+'steal'])   + 'c' )
-    perf_message_array.append('ctxt='       + str(cpu_stats_t1['ctxt'])           + 'c' )
-    perf_message_array.append('procs='              + str(cpu_stats_t1['processes'])      + 'c' )
+    ticks = cpu_stats_t1['ticks']
+    for (i, cpu_id) in enumerate(cpu_id_list):
+      row = ticks[i*NCOLS:(i+1)*NCOLS]
+      total = sum(row[USER:STEAL+1])
+      perf_message_array.append('%s.all=%dc %s.busy=%dc %s.iowait=%dc %s.steal=%dc' % (cpu_id, total, cpu_id, total - row[IDLE], cpu_id, row[IOWAIT], cpu_id, row[STEAL]))
+    perf_message_array.append('ctxt=%dc' % cpu_stats_t1['ctxt'])
+    perf_message_array.append('procs=%dc' % cpu_stats_t1['processes'])
   return " ".join(perf_message_array)
 
 # Build the status message (service output message) and set the exit code
 def check_status():
   global warn,crit,io_warn,io_crit,per_cpu_warn,per_cpu_crit,cpu_id_list,cpu_percent,io_wait_percent,steal_percent
   result = 0
-  message = ''
-  for cpu_id in cpu_id_list:
+  total_message = ''
+  messages = []
+  for (i, cpu_id) in enumerate(cpu_id_list):
     if cpu_id == 'cpu':
-      if cpu_percent[cpu_id] > crit:
+      if cpu_percent[i] > crit:
         result |= 2
-        message = 'Total=' + str(cpu_percent[cpu_id]) + '% > ' + str(crit)
-      elif cpu_percent[cpu_id] > warn:
+        total_message = 'Total=%d%% > %s' % (cpu_percent[i], crit)
+      elif cpu_percent[i] > warn:
         result |= 1
-        message = 'Total=' + str(cpu_percent[cpu_id]) + '% > ' + str(warn)
+        total_message = 'Total=%d%% > %s' % (cpu_percent[i], warn)
       else:
-        message = 'Total=' + str(cpu_percent[cpu_id]) + '%'
-      if io_wait_percent[cpu_id] > io_crit_overall:
+        total_message = 'Total=%d%%' % cpu_percent[i]
+      if io_wait_percent[i] > io_crit_overall:
         result |= 2
-        message += ' IOwait=' + str(io_wait_percent[cpu_id]) + '% > ' + str(io_crit_overall)
-      elif io_wait_percent[cpu_id] > io_warn_overall:
+        total_message += ' IOwait=%d%% > %s' % (io_wait_percent[i], io_crit_overall)
+      elif io_wait_percent[i] > io_warn_overall:
         result |= 1
-        message += ' IOwait=' + str(io_wait_percent[cpu_id]) + '% > ' + str(io_warn_overall)
+        total_message += ' IOwait=%d%% > %s' % (io_wait_percent[i], io_warn_overall)
       else:
-        message += ' IOwait=' + str(io_wait_percent[cpu_id]) + '%'
-      message += ' Steal=' + str(steal_percent[cpu_id]) + '%'
+        total_message += ' IOwait=%d%%' % io_wait_percent[i]
+      total_message += ' Steal=%d%%' % steal_percent[i]
     else:
-      if cpu_percent[cpu_id] > per_cpu_crit:
+      if cpu_percent[i] > per_cpu_crit:
         result |= 2
-        message += ' CRIT: ' + cpu_id + '=' + str(cpu_percent[cpu_id]) +  '% > ' + str(per_cpu_crit)
-      elif cpu_percent[cpu_id] > per_cpu_warn:
+        messages.append('CRIT: %s=%d%% > %s' % (cpu_id, cpu_percent[i], per_cpu_crit))
+      elif cpu_percent[i] > per_cpu_warn:
         result |= 1
-        message += ' WARN: ' + cpu_id + '=' + str(cpu_percent[cpu_id]) +  '% > ' + str(per_cpu_warn)
-      if io_wait_percent[cpu_id] > io_crit:
+        messages.append('WARN: %s=%d%% > %s' % (cpu_id, cpu_percent[i], per_cpu_warn))
+      if io_wait_percent[i] > io_crit:
         result |= 2
-        message += ' IO_CRIT: ' + cpu_id + '=' + str(io_wait_percent[cpu_id]) +  '% > ' + str(io_crit)
-      elif io_wait_percent[cpu_id] > io_warn:
+        messages.append('IO_CRIT: %s=%d%% > %s' % (cpu_id, io_wait_percent[i], io_crit))
+      elif io_wait_percent[i] > io_warn:
         result |= 1
-        message += ' IO_WARN: ' + cpu_id + '=' + str(io_wait_percent[cpu_id]) +  '% > ' + str(io_warn)
-      if steal_percent[cpu_id] > steal_crit:
+        messages.append('IO_WARN: %s=%d%% > %s' % (cpu_id, io_wait_percent[i], io_warn))
+      if steal_percent[i] > steal_crit:
         result |= 2
-        message += ' STEAL_CRIT: ' + cpu_id + '=' + str(steal_percent[cpu_id]) +  '% > ' + str(steal_crit)
-      elif steal_percent[cpu_id] > steal_warn:
+        messages.append('STEAL_CRIT: %s=%d%% > %s' % (cpu_id, steal_percent[i], steal_crit))
+      elif steal_percent[i] > steal_warn:
         result |= 1
-        message += ' STEAL_WARN: ' + cpu_id + '=' + str(steal_percent[cpu_id]) +  '% > ' + str(steal_warn)
+        messages.append('STEAL_WARN: %s=%d%% > %s' % (cpu_id, steal_percent[i], steal_warn))
+  message = ' '.join([total_message] + messages)
 
   if result == 3 or result == 2:
     result = 2
@@ -213,6 +350,157 @@ def check_status():
   return (result,message)
 
 
+# Read a pressure file, returns eg. { 'some': { 'avg10': 0.5, 'avg60': 0.2, 'avg300': 0.1, 'total': 12345 }, 'full': {...} }
+# 'total' is the accumulated stall time in microseconds
+def read_pressure(file_name):
+  pressure = dict()
+  f = open(file_name,'r')
+  pressure_text = f.read()
+  f.close()
+  for line in pressure_text.split("\n"):
+    fields = line.split()
+    if len(fields) == 0:
+      continue
+    values = dict()
+    for field in fields[1:]:
+      [key,value] = field.split('=',1)
+      if key == 'total':
+        values[key] = int(value)
+      else:
+        values[key] = float(value)
+    pressure[fields[0]] = values
+  return pressure
+
+# Save the stall totals of this run, so the next run can report the stall time in between
+def save_psi_state(totals, sample_time):
+  lines = [PSI_STATE_MAGIC + ' ' + repr(sample_time)]
+  for name in sorted(totals):
+    lines.append(name + ' ' + str(totals[name]))
+  tmp_file = state_file + '.' + str(os.getpid())
+  try:
+    f = open(tmp_file, 'w')
+    f.write("\n".join(lines) + "\n")
+    f.close()
+    os.rename(tmp_file, state_file)
+  except (IOError, OSError):
+    pass
+
+# Load the stall totals saved by the previous run, returns (totals, sample_time) or (None, None)
+def load_psi_state():
+  try:
+    f = open(state_file, 'r')
+    lines = f.read().split("\n")
+    f.close()
+    header = lines[0].split()
+    if len(header) != 2 or header[0] != PSI_STATE_MAGIC:
+      return (None, None)
+    totals = dict()
+    for line in lines[1:]:
+      fields = line.rsplit(' ',1)
+      if len(fields) == 2:
+        totals[fields[0]] = int(fields[1])
+    return (totals, float(header[1]))
+  except (IOError, OSError, ValueError, UnicodeDecodeError):
+    return (None, None)
+
+# Read the system wide and cgroup pressure files. No sampling period is needed, the kernel
+# keeps the running averages; stall time since the previous run comes from the state file.
+# Results are in psi_stats[] as (name, values) pairs, where name is eg. 'cpu.some' or 'system.slice/cpu.some'
+def get_psi_stats():
+  global psi_stats
+  pressure_files = []
+  for resource in PSI_RESOURCES:
+    pressure_files.append(('', resource, os.path.join(psi_dir, resource)))
+  for cgroup in psi_cgroups:
+    cgroup_dir = os.path.join(cgroup_root, cgroup.strip('/'))
+    if os.path.isfile(cgroup_dir):
+      (cgroup_dir, pressure_file) = os.path.split(cgroup_dir)
+      resource = pressure_file.split('.')[0]
+    else:
+      resource = 'cpu'
+    cgroup_name = os.path.relpath(cgroup_dir, cgroup_root)
+    pressure_files.append((cgroup_name + '/', resource, os.path.join(cgroup_dir, resource + '.pressure')))
+  psi_stats = []
+  for (prefix, resource, file_name) in pressure_files:
+    try:
+      pressure = read_pressure(file_name)
+    except (IOError, OSError):
+      # io and memory pressure may be missing, but cpu pressure is required
+      if prefix == '' and resource != 'cpu':
+        continue
+      print('UNKNOWN: pressure stall information not available in ' + file_name)
+      sys.exit(UNKNOWN)
+    for line in ('some','full'):
+      if line in pressure:
+        psi_stats.append((prefix + resource + '.' + line, pressure[line]))
+  sample_time = time.time()
+  totals = dict((name, values['total']) for (name, values) in psi_stats)
+  if state_file:
+    (totals_t0, time_t0) = load_psi_state()
+    if totals_t0 is not None and 0 < sample_time - time_t0 <= state_max_age:
+      interval_usec = (sample_time - time_t0) * 1000000
+      for (name, values) in psi_stats:
+        if name in totals_t0 and values['total'] >= totals_t0[name]:
+          values['stall'] = min((values['total'] - totals_t0[name]) * 100 / interval_usec, 100.0)
+    save_psi_state(totals, sample_time)
+  return
+
+# Parse a --psi-warn/--psi-crit value eg. cpu.some.avg60=25 into thresholds[('cpu.some','avg60')]
+def parse_psi_threshold(arg, thresholds):
+  [key,value] = arg.split('=',1)
+  [name,field] = key.rsplit('.',1)
+  if field not in PSI_FIELDS:
+    raise ValueError(field)
+  thresholds[(name,field)] = float(value.rstrip('%'))
+
+# Thresholds for a pressure line, the system wide thresholds apply to cgroups as well
+def psi_threshold(thresholds, name, field):
+  return thresholds.get((name,field), thresholds.get((name.split('/')[-1],field)))
+
+# Build the performance data message in PSI mode
+def psi_performance_data():
+  perf_message_array = []
+  for (name, values) in psi_stats:
+    label = name.replace('.','_')
+    for field in PSI_FIELDS:
+      if field in values:
+        warn_value = psi_threshold(psi_warn, name, field)
+        crit_value = psi_threshold(psi_crit, name, field)
+        perf_message_array.append("'%s_%s'=%.2f%%;%s;%s;0;100" % (label, field, values[field], '' if warn_value is None else warn_value, '' if crit_value is None else crit_value))
+    if (perfdata_abs&2) == 2:
+      perf_message_array.append("'%s_total'=%dc" % (label, values['total']))
+  return " ".join(perf_message_array)
+
+# Build the status message in PSI mode and set the exit code
+def check_psi_status():
+  result = 0
+  summary = []
+  messages = []
+  for (name, values) in psi_stats:
+    if '/' not in name:
+      summary.append('%s=%.2f%%/%.2f%%' % (name, values['avg10'], values['avg60']))
+    for field in PSI_FIELDS:
+      if field not in values:
+        continue
+      crit_value = psi_threshold(psi_crit, name, field)
+      warn_value = psi_threshold(psi_warn, name, field)
+      if crit_value is not None and values[field] > crit_value:
+        result |= 2
+        messages.append('CRIT: %s.%s=%.2f%% > %s' % (name, field, values[field], crit_value))
+      elif warn_value is not None and values[field] > warn_value:
+        result |= 1
+        messages.append('WARN: %s.%s=%.2f%% > %s' % (name, field, values[field], warn_value))
+  message = 'PSI avg10/avg60 ' + ' '.join(summary + messages)
+
+  if result == 3 or result == 2:
+    result = 2
+    message = 'CRITICAL: ' + message
+  elif result == 1:
+    message = 'WARNING: ' + message
+  else:
+    message = 'OK: ' + message
+  return (result,message)
+
 # define command lnie options and validate data.  Show usage or provide info on required options
 def command_line_validate(argv):
   global warn,crit,io_warn,io_crit,sample_period
@@ -221,8 +509,11 @@ def command_line_validate(argv):
   global per_cpu_warn,per_cpu_crit
   global steal_warn,steal_crit
   global perfdata_abs
+  global state_file,state_max_age
+  global perfdata_modes
+  global psi_mode,psi_cgroups,psi_warn,psi_crit
   try:
-    opts, args = getopt.getopt(argv, 'w:c:o:W:C:i:I:s:S:p:f:VaA', ['warn=' ,'crit=', 'warn-any=', 'crit-any=', 'io-warn=','io-crit=','io-warn-overall=','io-crit-overall=','steal-warn=','steal-crit=','period=','version','--abs'])
+    opts, args = getopt.getopt(argv, 'w:c:o:W:C:i:I:s:S:p:f:t:m:VaAMP', ['warn=' ,'crit=', 'warn-any=', 'crit-any=', 'io-warn=','io-crit=','io-warn-overall=','io-crit-overall=','steal-warn=','steal-crit=','period=','state-file=','max-age=','modes','psi','psi-cgroup=','psi-warn=','psi-crit=','version','--abs'])
   except getopt.GetoptError:
     print(usage)
   try:
@@ -285,10 +576,29 @@ def command_line_validate(argv):
           sample_period = int(arg)
         except:
           print('***period value must be an integer***')
+      elif opt in ('-t','--state-file'):
+        state_file = arg
+      elif opt in ('-m','--max-age'):
+        try:
+          state_max_age = int(arg)
+        except:
+          print('***max-age value must be an integer***')
       elif opt in ('-a','--abs'):
         perfdata_abs = 3
       elif opt in ('-A','--abs-only'):
         perfdata_abs = 2
+      elif opt in ('-M','--modes'):
+        perfdata_modes = True
+      elif opt in ('-P','--psi'):
+        psi_mode = True
+      elif opt == '--psi-cgroup':
+        psi_cgroups.append(arg)
+      elif opt in ('--psi-warn', '--psi-crit'):
+        try:
+          parse_psi_threshold(arg, psi_warn if opt == '--psi-warn' else psi_crit)
+        except ValueError:
+          print('***' + opt[2:] + ' value must be like cpu.some.avg60=25***')
+          sys.exit(CRITICAL)
       elif opt in ('-f'):
         # Just for testing
         proc_stat_file = arg
@@ -312,6 +622,14 @@ def main():
   # set crit,warn,io_crit,io_warn
   command_line_validate(argv)
   
+  if psi_mode:
+    # Read the pressure files - results are in psi_stats[]
+    get_psi_stats()
+    perf_message = psi_performance_data()
+    (exit_code,result_message) = check_psi_status()
+    print(result_message + '|' + perf_message)
+    sys.exit(exit_code)
+
   # Read the stats from /proc/stat - results are in cpu_percent[] and io_wait_percent[]
   get_cpu_stats()
 
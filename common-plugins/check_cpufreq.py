@@ -4,11 +4,15 @@
 # Exit codes: 0 OK, 1 WARNING, 2 CRITICAL, 3 UNKNOWN
 
 import argparse
+import json
+import math
 import os
 import re
 import sys
-from dataclasses import dataclass
-from typing import List, Optional, Tuple
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional, Tuple
 
 
 OK = 0
@@ -17,6 +21,9 @@ CRITICAL = 2
 UNKNOWN = 3
 
 CPU_RE = re.compile(r"^cpu([0-9]+)$")
+POLICY_RE = re.compile(r"^policy([0-9]+)$")
+BOOT_ID_PATH = "/proc/sys/kernel/random/boot_id"
+CACHE_VERSION = 1
 
 
 @dataclass
@@ -29,6 +36,23 @@ class CpuFreq:
     governor: Optional[str]
 
 
+@dataclass
+class Policy:
+    """One cpufreq policy and the online CPUs it covers.
+
+    reference_khz, governor and cur_file are the values that do not change
+    between samples; they may come from the cache file.
+    """
+
+    name: str
+    path: str
+    cpus: List[str]
+    reference_khz: Optional[int] = None
+    governor: Optional[str] = None
+    cur_file: Optional[str] = None
+    samples: List[int] = field(default_factory=list)
+
+
 def read_text(path: str) -> Optional[str]:
     try:
         with open(path, "r", encoding="utf-8") as f:
@@ -94,35 +118,219 @@ def list_cpu_paths(sysfs_root: str) -> List[Tuple[int, str, str]]:
     return sorted(cpus, key=lambda item: item[0])
 
 
-def collect_cpu_freqs(args: argparse.Namespace) -> Tuple[List[CpuFreq], List[str]]:
+def parse_cpu_list(text: Optional[str]) -> List[int]:
+    """Parse a sysfs CPU list such as "0-3,8,10-11"."""
+    cpus = []
+    if not text:
+        return cpus
+    for part in text.replace(" ", ",").split(","):
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            cpus.extend(range(int(first), int(last) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def list_online_cpus(sysfs_root: str) -> List[int]:
+    online = read_text(os.path.join(sysfs_root, "online"))
+    if online is not None:
+        try:
+            return parse_cpu_list(online)
+        except ValueError:
+            pass
+    return [cpu_num for cpu_num, _, _ in list_cpu_paths(sysfs_root)]
+
+
+def list_policies(sysfs_root: str, online: List[int]) -> List[Policy]:
+    """Group the online CPUs by cpufreq policy, so each policy is read once.
+
+    Kernels without policyN directories get one policy per CPU.
+    """
+    policies = []
+    cpufreq_root = os.path.join(sysfs_root, "cpufreq")
+    try:
+        entries = os.listdir(cpufreq_root)
+    except OSError:
+        entries = []
+
+    online_set = set(online)
+    policy_entries = [entry for entry in entries if POLICY_RE.match(entry)]
+    for entry in sorted(policy_entries, key=lambda e: int(POLICY_RE.match(e).group(1))):
+        path = os.path.join(cpufreq_root, entry)
+        affected = read_text(os.path.join(path, "affected_cpus")) or read_text(os.path.join(path, "related_cpus"))
+        try:
+            cpu_nums = parse_cpu_list(affected)
+        except ValueError:
+            continue
+        cpus = [f"cpu{n}" for n in cpu_nums if n in online_set]
+        if cpus:
+            policies.append(Policy(entry, path, cpus))
+
+    if not policies:
+        for cpu_num in online:
+            cpu = f"cpu{cpu_num}"
+            path = os.path.join(sysfs_root, cpu, "cpufreq")
+            if os.path.isdir(path):
+                policies.append(Policy(cpu, path, [cpu]))
+
+    return policies
+
+
+def read_static(policy: Policy, args: argparse.Namespace) -> None:
+    policy.cur_file = next(
+        (
+            name
+            for name in ("scaling_cur_freq", "cpuinfo_cur_freq")
+            if os.path.exists(os.path.join(policy.path, name))
+        ),
+        None,
+    )
+    policy.reference_khz = first_int(
+        [
+            os.path.join(policy.path, "cpuinfo_max_freq"),
+            os.path.join(policy.path, "scaling_max_freq"),
+            os.path.join(policy.path, "base_frequency"),
+        ]
+    )
+    policy.governor = None if args.no_governor_check else read_text(os.path.join(policy.path, "scaling_governor"))
+
+
+def cache_key(args: argparse.Namespace, online: List[int]) -> Dict[str, object]:
+    return {
+        "version": CACHE_VERSION,
+        "sysfs_root": os.path.abspath(args.sysfs_root),
+        "boot_id": read_text(BOOT_ID_PATH),
+        "online": online,
+        "governor_check": not args.no_governor_check,
+    }
+
+
+def load_cache(args: argparse.Namespace, online: List[int]) -> Optional[List[Policy]]:
+    if not args.cache_file:
+        return None
+    try:
+        with open(args.cache_file, "r", encoding="utf-8") as f:
+            cache = json.load(f)
+        if cache.get("key") != cache_key(args, online):
+            return None
+        if not 0 <= time.time() - cache["time"] <= args.cache_ttl:
+            return None
+        return [Policy(**policy) for policy in cache["policies"]]
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+
+def save_cache(args: argparse.Namespace, online: List[int], policies: List[Policy]) -> None:
+    if not args.cache_file:
+        return
+    cache = {
+        "key": cache_key(args, online),
+        "time": time.time(),
+        "policies": [dict(asdict(policy), samples=[]) for policy in policies],
+    }
+    directory = os.path.dirname(os.path.abspath(args.cache_file))
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".check_cpufreq.")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(cache, f)
+        os.rename(tmp_path, args.cache_file)
+    except OSError:
+        pass
+
+
+def load_policies(args: argparse.Namespace) -> List[Policy]:
+    online = list_online_cpus(args.sysfs_root)
+    policies = load_cache(args, online)
+    if policies is None:
+        policies = list_policies(args.sysfs_root, online)
+        for policy in policies:
+            read_static(policy, args)
+        save_cache(args, online, policies)
+    missing = set(f"cpu{n}" for n in online) - set(cpu for policy in policies for cpu in policy.cpus)
+    for cpu_num in online:
+        if f"cpu{cpu_num}" in missing:
+            policies.append(Policy(f"cpu{cpu_num}", "", [f"cpu{cpu_num}"]))
+    return policies
+
+
+def parse_freq(data: bytes) -> Optional[int]:
+    try:
+        value = int(data)
+    except ValueError:
+        return None
+    return value if value > 0 else None
+
+
+def sample_freqs(policies: List[Policy], samples: int, interval: float) -> None:
+    """Read the current frequency of every policy samples times, interval seconds apart.
+
+    Each file is opened once and re-read with pread, so a sample costs one
+    syscall per policy.
+    """
+    fds = {}
+    try:
+        for policy in policies:
+            if policy.path and policy.cur_file:
+                try:
+                    fds[policy.name] = os.open(os.path.join(policy.path, policy.cur_file), os.O_RDONLY)
+                except OSError:
+                    pass
+        for sample in range(samples):
+            if sample:
+                time.sleep(interval)
+            for policy in policies:
+                fd = fds.get(policy.name)
+                if fd is None:
+                    continue
+                try:
+                    value = parse_freq(os.pread(fd, 32, 0))
+                except OSError:
+                    value = None
+                if value is not None:
+                    policy.samples.append(value)
+    finally:
+        for fd in fds.values():
+            os.close(fd)
+
+
+def percentile(values: List[int], pct: float) -> int:
+    """Nearest-rank percentile."""
+    ordered = sorted(values)
+    rank = max(int(math.ceil(pct / 100.0 * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+def window_khz(policy: Policy, stat: str) -> int:
+    if stat == "min":
+        return min(policy.samples)
+    if stat == "avg":
+        return int(sum(policy.samples) / len(policy.samples))
+    return percentile(policy.samples, 10)
+
+
+def collect_cpu_freqs(args: argparse.Namespace) -> Tuple[List[CpuFreq], List[str], List[Policy]]:
     cpus = []
     unknown = []
 
-    for _, cpu, cpu_path in list_cpu_paths(args.sysfs_root):
-        cpufreq = os.path.join(cpu_path, "cpufreq")
-        if not os.path.isdir(cpufreq):
-            unknown.append(f"{cpu}: missing cpufreq")
+    policies = load_policies(args)
+    sample_freqs(policies, args.samples, args.interval)
+
+    for policy in policies:
+        if not policy.path:
+            unknown.extend(f"{cpu}: missing cpufreq" for cpu in policy.cpus)
             continue
 
-        current_khz = first_int(
-            [
-                os.path.join(cpufreq, "scaling_cur_freq"),
-                os.path.join(cpufreq, "cpuinfo_cur_freq"),
-            ]
-        )
-        if current_khz is None:
-            unknown.append(f"{cpu}: missing current frequency")
+        if not policy.samples:
+            unknown.extend(f"{cpu}: missing current frequency" for cpu in policy.cpus)
             continue
+        current_khz = window_khz(policy, args.sample_stat) if args.samples > 1 else policy.samples[0]
 
-        reference_khz = first_int(
-            [
-                os.path.join(cpufreq, "cpuinfo_max_freq"),
-                os.path.join(cpufreq, "scaling_max_freq"),
-                os.path.join(cpufreq, "base_frequency"),
-            ]
-        )
+        reference_khz = policy.reference_khz
         if reference_khz is None and (args.warn_mhz is None or args.crit_mhz is None):
-            unknown.append(f"{cpu}: missing max frequency for automatic thresholds")
+            unknown.extend(f"{cpu}: missing max frequency for automatic thresholds" for cpu in policy.cpus)
             continue
 
         if reference_khz is None:
@@ -132,13 +340,14 @@ def collect_cpu_freqs(args: argparse.Namespace) -> Tuple[List[CpuFreq], List[str
         crit_khz = int(args.crit_mhz * 1000) if args.crit_mhz is not None else int(reference_khz * args.crit_percent / 100.0)
 
         if warn_khz < crit_khz:
-            unknown.append(f"{cpu}: warning threshold is below critical threshold")
+            unknown.extend(f"{cpu}: warning threshold is below critical threshold" for cpu in policy.cpus)
             continue
 
-        governor = None if args.no_governor_check else read_text(os.path.join(cpufreq, "scaling_governor"))
-        cpus.append(CpuFreq(cpu, current_khz, reference_khz, warn_khz, crit_khz, governor))
+        for cpu in policy.cpus:
+            cpus.append(CpuFreq(cpu, current_khz, reference_khz, warn_khz, crit_khz, policy.governor))
 
-    return cpus, unknown
+    cpus.sort(key=lambda c: int(c.cpu[3:]))
+    return cpus, unknown, [policy for policy in policies if policy.samples]
 
 
 def status_name(code: int) -> str:
@@ -228,7 +437,7 @@ def determine_status(
     return status, message
 
 
-def performance_data(cpus: List[CpuFreq], args: argparse.Namespace) -> str:
+def performance_data(cpus: List[CpuFreq], policies: List[Policy], args: argparse.Namespace) -> str:
     if not cpus:
         return ""
 
@@ -267,6 +476,13 @@ def performance_data(cpus: List[CpuFreq], args: argparse.Namespace) -> str:
             )
             perf.append(f"{cpu.cpu}_freq_pct={perf_float(pct)}%;;;0;100")
 
+    if args.samples > 1:
+        for policy in policies:
+            max_mhz = perf_float(khz_to_mhz(policy.reference_khz)) if policy.reference_khz else ""
+            perf.append(f"{policy.name}_freq_min_mhz={perf_float(khz_to_mhz(min(policy.samples)))}MHz;;;0;{max_mhz}")
+            perf.append(f"{policy.name}_freq_avg_mhz={perf_float(khz_to_mhz(sum(policy.samples) / len(policy.samples)))}MHz;;;0;{max_mhz}")
+            perf.append(f"{policy.name}_freq_p10_mhz={perf_float(khz_to_mhz(percentile(policy.samples, 10)))}MHz;;;0;{max_mhz}")
+
     return " ".join(perf)
 
 
@@ -371,6 +587,35 @@ def parse_args() -> argparse.Namespace:
         action="store_true",
         help="Include per-CPU frequency metrics in performance data",
     )
+    parser.add_argument(
+        "--samples",
+        type=int,
+        default=1,
+        help="Read the current frequency this many times and check the --sample-stat of the window (default: 1)",
+    )
+    parser.add_argument(
+        "--interval",
+        type=float,
+        default=0.2,
+        help="Seconds between samples (default: 0.2)",
+    )
+    parser.add_argument(
+        "--sample-stat",
+        choices=("min", "avg", "p10"),
+        default="p10",
+        help="Per-policy statistic of the sample window compared with the thresholds (default: p10)",
+    )
+    parser.add_argument(
+        "--cache-file",
+        default=None,
+        help="Cache policy layout, max frequency and governor in this file between runs (default: off)",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=int,
+        default=3600,
+        help="Seconds before cached values are re-read; governor changes show up after at most this long (default: 3600)",
+    )
     args = parser.parse_args()
 
     if args.warn_percent <= 0 or args.crit_percent <= 0:
@@ -385,6 +630,10 @@ def parse_args() -> argparse.Namespace:
         parser.error("--warn-mhz must be greater than or equal to --crit-mhz")
     if args.show_cpus < 1:
         parser.error("--show-cpus must be at least 1")
+    if args.samples < 1:
+        parser.error("--samples must be at least 1")
+    if args.interval < 0:
+        parser.error("--interval must not be negative")
     if args.no_governor_check:
         args.governor = ""
 
@@ -393,7 +642,7 @@ def parse_args() -> argparse.Namespace:
 
 def main() -> int:
     args = parse_args()
-    cpus, unknown = collect_cpu_freqs(args)
+    cpus, unknown, policies = collect_cpu_freqs(args)
     status, message = determine_status(
         cpus,
         unknown,
@@ -401,7 +650,9 @@ def main() -> int:
         args.governor_state,
         args.show_cpus,
     )
-    perf = performance_data(cpus, args)
+    if cpus and args.samples > 1:
+        message += f"; {args.sample_stat} of {args.samples} samples over {args.interval * (args.samples - 1):g}s"
+    perf = performance_data(cpus, policies, args)
 
     output = f"{status_name(status)}: {message}"
     if perf:
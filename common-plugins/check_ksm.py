@@ -4,9 +4,12 @@
 # Exit codes: 0 OK, 1 WARNING, 2 CRITICAL, 3 UNKNOWN
 
 import argparse
+import json
 import os
 import sys
-from typing import Optional, Dict
+import tempfile
+import time
+from typing import Optional, Dict, Tuple
 
 
 OK = 0
@@ -40,6 +43,62 @@ def read_memtotal_bytes() -> Optional[int]:
         return None
 
 
+def read_proc_stat(pid: int) -> Optional[Tuple[int, int]]:
+    """Return (utime + stime, starttime) in clock ticks from /proc/<pid>/stat."""
+    try:
+        with open(f"/proc/{pid}/stat", "r", encoding="utf-8") as f:
+            data = f.read()
+        # comm may contain spaces, the fields after it start at the last ')'
+        fields = data[data.rindex(")") + 2:].split()
+        return int(fields[11]) + int(fields[12]), int(fields[19])
+    except Exception:
+        return None
+
+
+def is_ksmd(pid: int) -> bool:
+    try:
+        with open(f"/proc/{pid}/comm", "r", encoding="utf-8") as f:
+            return f.read().strip() == "ksmd"
+    except Exception:
+        return False
+
+
+def find_ksmd(cached_pid: Optional[int]) -> Optional[int]:
+    if cached_pid and is_ksmd(cached_pid):
+        return cached_pid
+    # ksmd is a kernel thread, so a child of kthreadd (pid 2)
+    try:
+        with open("/proc/2/task/2/children", "r", encoding="utf-8") as f:
+            candidates = [int(pid) for pid in f.read().split()]
+    except Exception:
+        candidates = [int(pid) for pid in os.listdir("/proc") if pid.isdigit()]
+    for pid in candidates:
+        if is_ksmd(pid):
+            return pid
+    return None
+
+
+def load_state(path: str) -> Optional[dict]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        if not isinstance(state, dict) or "time" not in state or "metrics" not in state:
+            return None
+        return state
+    except Exception:
+        return None
+
+
+def save_state(path: str, state: dict) -> None:
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".check_ksm.")
+        with os.fdopen(fd, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+        os.rename(tmp_path, path)
+    except Exception:
+        pass
+
+
 def human_bytes(n: int) -> str:
     # simple IEC-ish formatting
     units = ["B", "KiB", "MiB", "GiB", "TiB", "PiB"]
@@ -58,6 +117,15 @@ def main() -> int:
     p.add_argument("--ksm-path", default="/sys/kernel/mm/ksm", help="Path to KSM sysfs dir (default: /sys/kernel/mm/ksm)")
     p.add_argument("--warn-if-off", action="store_true", default=True, help="Return WARNING if KSM is not enabled (default: true)")
     p.add_argument("--ok-if-off", action="store_true", default=False, help="Override: return OK even if KSM is off")
+    p.add_argument("--state-file", default="/tmp/check_ksm.state", help="Previous sample, for rates since the last run (default: /tmp/check_ksm.state, empty to disable)")
+    p.add_argument("--max-age", type=int, default=3600, help="Ignore a previous sample older than this many seconds (default: 3600)")
+    p.add_argument("--warn-cpu", type=float, default=None, help="WARNING if ksmd uses more than this percent of one CPU")
+    p.add_argument("--crit-cpu", type=float, default=None, help="CRITICAL if ksmd uses more than this percent of one CPU")
+    p.add_argument("--warn-efficiency", type=float, default=None, help="WARNING if saved MiB per percent of ksmd CPU drops below this")
+    p.add_argument("--crit-efficiency", type=float, default=None, help="CRITICAL if saved MiB per percent of ksmd CPU drops below this")
+    p.add_argument("--efficiency-min-cpu", type=float, default=1.0, help="Only check efficiency while ksmd uses at least this percent of one CPU (default: 1)")
+    p.add_argument("--warn-unshared-ratio", type=float, default=None, help="WARNING if pages_unshared/pages_sharing exceeds this (wasted scanning)")
+    p.add_argument("--crit-unshared-ratio", type=float, default=None, help="CRITICAL if pages_unshared/pages_sharing exceeds this")
     args = p.parse_args()
 
     ksm_path = args.ksm_path
@@ -103,6 +171,50 @@ def main() -> int:
     if mem_total and mem_total > 0:
         saved_pct = (saved_bytes / mem_total) * 100.0
 
+    # Rates since the previous run
+    now = time.time()
+    state = load_state(args.state_file) if args.state_file else None
+    ksmd_pid = find_ksmd(state.get("ksmd_pid") if state else None)
+    ksmd_stat = read_proc_stat(ksmd_pid) if ksmd_pid else None
+
+    rates: Dict[str, float] = {}
+    if state and 0 < now - state["time"] <= args.max_age:
+        interval = now - state["time"]
+        prev = state["metrics"]
+        scanned = metrics.get("pages_scanned")
+        full_scans = metrics.get("full_scans")
+        # counters go backwards after a reboot or when KSM is stopped with run=2
+        if scanned is not None and prev.get("pages_scanned") is not None and scanned >= prev["pages_scanned"]:
+            rates["pages_scanned_per_s"] = (scanned - prev["pages_scanned"]) / interval
+        if full_scans is not None and prev.get("full_scans") is not None and full_scans >= prev["full_scans"]:
+            rates["full_scans_per_hour"] = (full_scans - prev["full_scans"]) * 3600.0 / interval
+        if state.get("saved_bytes") is not None:
+            rates["saved_bytes_delta"] = saved_bytes - state["saved_bytes"]
+        if ksmd_stat and state.get("ksmd_pid") == ksmd_pid and state.get("ksmd_start") == ksmd_stat[1]:
+            ticks = ksmd_stat[0] - state["ksmd_ticks"]
+            rates["ksmd_cpu_pct"] = ticks * 100.0 / os.sysconf("SC_CLK_TCK") / interval
+
+    if args.state_file:
+        save_state(args.state_file, {
+            "time": now,
+            "metrics": metrics,
+            "saved_bytes": saved_bytes,
+            "ksmd_pid": ksmd_pid,
+            "ksmd_ticks": ksmd_stat[0] if ksmd_stat else None,
+            "ksmd_start": ksmd_stat[1] if ksmd_stat else None,
+        })
+
+    # saved MiB per percent of one CPU spent in ksmd
+    efficiency = None
+    ksmd_cpu = rates.get("ksmd_cpu_pct")
+    if ksmd_cpu is not None and ksmd_cpu > 0 and ksmd_cpu >= args.efficiency_min_cpu:
+        efficiency = saved_bytes / (1024.0 * 1024.0) / ksmd_cpu
+
+    unshared_ratio = None
+    pages_unshared = metrics.get("pages_unshared")
+    if pages_unshared is not None and pages_sharing > 0:
+        unshared_ratio = pages_unshared / float(pages_sharing)
+
     # Status logic
     is_on = (run == 1)
     if args.ok_if_off:
@@ -116,6 +228,26 @@ def main() -> int:
             status = WARNING if args.warn_if_off else OK
             status_txt = "WARNING" if status == WARNING else "OK"
 
+    # Efficiency thresholds, only meaningful while ksmd is running
+    problems = []
+    if is_on:
+        checks = [
+            ("ksmd_cpu", ksmd_cpu, args.warn_cpu, args.crit_cpu, False, "%"),
+            ("efficiency", efficiency, args.warn_efficiency, args.crit_efficiency, True, "MiB/%cpu"),
+            ("unshared_ratio", unshared_ratio, args.warn_unshared_ratio, args.crit_unshared_ratio, False, ""),
+        ]
+        for name, value, warn, crit, below, unit in checks:
+            if value is None:
+                continue
+            for code, threshold in ((CRITICAL, crit), (WARNING, warn)):
+                if threshold is None:
+                    continue
+                if (value < threshold) if below else (value > threshold):
+                    problems.append(f"{name}={value:.2f}{unit} {'<' if below else '>'} {threshold:g}")
+                    status = max(status, code)
+                    break
+        status_txt = {OK: "OK", WARNING: "WARNING", CRITICAL: "CRITICAL"}[status]
+
     # Compose message
     parts = []
     parts.append(f"run={run}")
@@ -145,6 +277,20 @@ def main() -> int:
     add_if("merge_across_nodes")
     add_if("stable_node_chains")
 
+    if "pages_scanned_per_s" in rates:
+        parts.append(f"scan_rate={rates['pages_scanned_per_s']:.0f}pages/s")
+    if "full_scans_per_hour" in rates:
+        parts.append(f"full_scan_rate={rates['full_scans_per_hour']:.2f}/h")
+    if "saved_bytes_delta" in rates:
+        delta = rates["saved_bytes_delta"]
+        parts.append(f"saved_change={'-' if delta < 0 else '+'}{human_bytes(abs(int(delta)))}")
+    if ksmd_cpu is not None:
+        parts.append(f"ksmd_cpu={ksmd_cpu:.2f}%")
+    if efficiency is not None:
+        parts.append(f"efficiency={efficiency:.2f}MiB/%cpu")
+    if problems:
+        parts.insert(0, "; ".join(problems) + ";")
+
     message = f"{status_txt} - KSM {'ON' if is_on else 'OFF'}; " + " ".join(parts)
 
     # Perfdata (good for graphs)
@@ -166,6 +312,19 @@ def main() -> int:
         # units are approximate per kernel docs formula; keep as raw counter with B suffix for consistency
         perf.append(f"general_profit={gp}B")
 
+    if "pages_scanned_per_s" in rates:
+        perf.append(f"pages_scanned_per_s={rates['pages_scanned_per_s']:.2f}")
+    if "full_scans_per_hour" in rates:
+        perf.append(f"full_scans_per_hour={rates['full_scans_per_hour']:.2f}")
+    if "saved_bytes_delta" in rates:
+        perf.append(f"saved_bytes_delta={int(rates['saved_bytes_delta'])}B")
+    if ksmd_cpu is not None:
+        perf.append(f"ksmd_cpu={ksmd_cpu:.2f}%;{'' if args.warn_cpu is None else args.warn_cpu};{'' if args.crit_cpu is None else args.crit_cpu};0;")
+    if efficiency is not None:
+        perf.append(f"efficiency={efficiency:.2f};{'' if args.warn_efficiency is None else f'{args.warn_efficiency}:'};{'' if args.crit_efficiency is None else f'{args.crit_efficiency}:'};0;")
+    if unshared_ratio is not None:
+        perf.append(f"unshared_ratio={unshared_ratio:.2f};{'' if args.warn_unshared_ratio is None else args.warn_unshared_ratio};{'' if args.crit_unshared_ratio is None else args.crit_unshared_ratio};0;")
+
     print(message + " | " + " ".join(perf))
     return status
 
@@ -5,11 +5,19 @@
 import os
 import re
 import sys
+import json
+import time
 import argparse
 
 parser = argparse.ArgumentParser()
 parser.add_argument('-s', '--shift', metavar='SHIFT', default=-15, help='Shifts the thresholds for critical and warning. Default: -15')
 parser.add_argument('-e', '--exe', metavar='EXE', default='/usr/bin/sensors', help='Path to sensors. Default: /usr/bin/sensors')
+parser.add_argument('-b', '--backend', choices=['auto', 'sysfs', 'sensors'], default='auto', help='Read hwmon sysfs directly, or run sensors. Default: auto (sysfs when hwmon sensors are found)')
+parser.add_argument('--hwmon', metavar='DIR', default='/sys/class/hwmon', help='hwmon sysfs directory. Default: /sys/class/hwmon')
+parser.add_argument('--fans', action='store_true', help='sysfs: also check fans against their minimum speed')
+parser.add_argument('--voltages', action='store_true', help='sysfs: also check voltages against their min/max')
+parser.add_argument('--cache-file', metavar='FILE', default='/tmp/check_sensors.cache', help='sysfs: cache sensor names, labels and limits in FILE. Default: /tmp/check_sensors.cache, empty to disable')
+parser.add_argument('--cache-ttl', metavar='SECONDS', type=int, default=3600, help='sysfs: seconds before the cache is rebuilt. Default: 3600')
 args = parser.parse_args()
 
 # Threshold shift
@@ -26,7 +34,199 @@ STATE = "OK"
 MESSAGE = "All sensors are normal."
 GRAPHS = ""
 
-if os.path.isfile(SENSORS_BIN) and os.access(SENSORS_BIN, os.X_OK):
+HWMON_INPUT_RE = re.compile(r'^(temp|fan|in)([0-9]+)_input$')
+
+
+def read_value(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def read_number(path):
+    value = read_value(path)
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def hwmon_chip_id(chip_dir):
+    """Name a chip by its driver and device (eg. coretemp.0), which unlike hwmonN is stable across boots."""
+    name = read_value(os.path.join(chip_dir, 'name')) or os.path.basename(chip_dir)
+    device = os.path.realpath(os.path.join(chip_dir, 'device'))
+    if os.path.exists(os.path.join(chip_dir, 'device')):
+        return name, os.path.basename(device)
+    return name, os.path.basename(chip_dir)
+
+
+def sensor_name(chip, device, label, used):
+    # same names as the sensors backend: CPU<package>_Core<n> and the label with spaces replaced
+    if chip == 'coretemp' and label.startswith('Core'):
+        package = device.rsplit('.', 1)[-1] if '.' in device else '0'
+        name = 'CPU' + package + '_' + label.replace(' ', '')
+    else:
+        name = label.replace(' ', '_')
+    if name in used:
+        name = name + '_' + device.replace(' ', '_')
+    used.add(name)
+    return name
+
+
+def scan_hwmon(hwmon_dir):
+    """List the sensors below hwmon_dir with their static label and limits.
+
+    Returns dicts with name, kind, the input file and the limits: temperatures
+    in degrees (max, crit), fans in RPM (min), voltages in volts (min, max).
+    """
+    sensors = []
+    used = set()
+    chips = []
+    for entry in os.listdir(hwmon_dir):
+        chip_dir = os.path.join(hwmon_dir, entry)
+        chip, device = hwmon_chip_id(chip_dir)
+        # older drivers keep the attributes in the device directory
+        if not os.path.exists(os.path.join(chip_dir, 'name')) and os.path.exists(os.path.join(chip_dir, 'device', 'name')):
+            chip_dir = os.path.join(chip_dir, 'device')
+        chips.append((chip, device, chip_dir))
+    for chip, device, chip_dir in sorted(chips):
+        inputs = []
+        for entry in os.listdir(chip_dir):
+            match = HWMON_INPUT_RE.match(entry)
+            if match:
+                inputs.append((match.group(1), int(match.group(2))))
+        for kind, number in sorted(inputs):
+            prefix = os.path.join(chip_dir, kind + str(number) + '_')
+            label = read_value(prefix + 'label') or (kind + str(number))
+            scale = 1.0 if kind == 'fan' else 1000.0
+            limits = {}
+            for limit in ('min', 'max', 'crit'):
+                value = read_number(prefix + limit)
+                if value is not None:
+                    limits[limit] = value / scale
+            sensors.append({
+                'name': sensor_name(chip, device, label, used),
+                'kind': kind,
+                'input': prefix + 'input',
+                'scale': scale,
+                'limits': limits,
+            })
+    return sensors
+
+
+def load_hwmon_sensors(hwmon_dir):
+    key = {
+        'hwmon': os.path.abspath(hwmon_dir),
+        'chips': sorted(os.listdir(hwmon_dir)),
+        'boot_id': read_value('/proc/sys/kernel/random/boot_id'),
+    }
+    if args.cache_file:
+        try:
+            with open(args.cache_file, 'r') as f:
+                cache = json.load(f)
+            if cache['key'] == key and 0 <= time.time() - cache['time'] <= args.cache_ttl:
+                return cache['sensors']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+    sensors = scan_hwmon(hwmon_dir)
+    if args.cache_file:
+        tmp_file = args.cache_file + '.' + str(os.getpid())
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump({'key': key, 'time': time.time(), 'sensors': sensors}, f)
+            os.rename(tmp_file, args.cache_file)
+        except (IOError, OSError):
+            pass
+    return sensors
+
+
+def use_sysfs():
+    if args.backend == 'sensors':
+        return False
+    try:
+        return args.backend == 'sysfs' or len(os.listdir(args.hwmon)) > 0
+    except OSError:
+        return False
+
+
+if use_sysfs():
+
+    try:
+        hwmon_sensors = load_hwmon_sensors(args.hwmon)
+    except OSError:
+        hwmon_sensors = []
+        STATE = "UNKNOWN"
+        MESSAGE = "Unable to read '" + args.hwmon + "'."
+
+    problems = {"WARNING": [], "CRITICAL": []}
+    for hwmon_sensor in hwmon_sensors:
+        kind = hwmon_sensor['kind']
+        limits = hwmon_sensor['limits']
+        if (kind == 'fan' and not args.fans) or (kind == 'in' and not args.voltages):
+            continue
+        raw = read_number(hwmon_sensor['input'])
+        if raw is None:
+            continue
+        value = raw / hwmon_sensor['scale']
+        sensor = hwmon_sensor['name']
+        level = "OK"
+
+        if kind == 'temp':
+            # like the sensors backend, thresholds come from the high (max) and crit limits
+            if 'max' in limits and 'crit' in limits:
+                warn = limits['max'] + TSHIFT
+                crit = limits['crit'] + TSHIFT
+                GRAPHS = GRAPHS + sensor + "=" + str(value) + ";" + str(warn) + ";" + str(crit) + "; "
+                if value >= crit:
+                    level = "CRITICAL"
+                    problem = sensor + " above the critical level"
+                elif value >= warn:
+                    level = "WARNING"
+                    problem = sensor + " above the warning level"
+            else:
+                GRAPHS = GRAPHS + sensor + "=" + str(value) + ";;; "
+        elif kind == 'fan':
+            minimum = limits.get('min', 0)
+            GRAPHS = GRAPHS + sensor + "=" + str(int(value)) + ";;" + (str(int(minimum)) + ":" if minimum else "") + "; "
+            if minimum and value < minimum:
+                level = "CRITICAL"
+                problem = sensor + " below the minimum of " + str(int(minimum)) + " RPM"
+        else:
+            # threshold range: min:max, max alone (0..max) or min: (at least min)
+            low = limits.get('min')
+            high = limits.get('max') or None
+            if low is not None and high is not None:
+                voltage_range = str(low) + ":" + str(high)
+            elif high is not None:
+                voltage_range = str(high)
+            elif low is not None:
+                voltage_range = str(low) + ":"
+            else:
+                voltage_range = ""
+            GRAPHS = GRAPHS + sensor + "=" + str(value) + "V;" + voltage_range + ";; "
+            if low is not None and value < low:
+                level = "WARNING"
+                problem = sensor + " below the minimum of " + str(low) + " V"
+            elif high is not None and value > high:
+                level = "WARNING"
+                problem = sensor + " above the maximum of " + str(high) + " V"
+
+        if level != "OK":
+            problems[level].append(problem)
+
+    if problems["CRITICAL"]:
+        STATE = "CRITICAL"
+        MESSAGE = "Some of the sensors are critical: " + ", ".join(problems["CRITICAL"] + problems["WARNING"]) + "."
+    elif problems["WARNING"]:
+        STATE = "WARNING"
+        MESSAGE = "Some of the sensors are at warning level, but not yet critical: " + ", ".join(problems["WARNING"]) + "."
+    elif not hwmon_sensors and STATE == "OK":
+        STATE = "UNKNOWN"
+        MESSAGE = "No hwmon sensors found in '" + args.hwmon + "'."
+
+elif os.path.isfile(SENSORS_BIN) and os.access(SENSORS_BIN, os.X_OK):
 
     _current_cpu = "0"
 
@@ -1,4 +1,4 @@
-#! /usr/bin/env python2
+#! /usr/bin/env python3
 #
 # This is a multi-threaded RBL lookup check for Icinga / Nagios.
 # Copyright (C) 2012 Frode Egeland <egeland[at]gmail.com>
@@ -30,18 +30,18 @@ import os
 import getopt
 import socket
 import string
-if sys.version_info[0] == 3:
-    import queue as Queue
-else:
-    import Queue
-import threading
+import asyncio
 import ipaddress
 import timeit
+import json
+import random
+import struct
+import time
 
 # Python version check
-rv = (2, 6)
-if rv >= sys.version_info:
-    print("ERROR: Requires Python 2.6 or greater")
+rv = (3, 5)
+if rv > sys.version_info:
+    print("ERROR: Requires Python 3.5 or greater")
     sys.exit(3)
 
 # List of DNS blacklists
@@ -102,36 +102,342 @@ serverlist = [
 
 ####
 
-queue = Queue.Queue()
 debug = False
-global on_blacklist
-on_blacklist = []
 
 
-class ThreadRBL(threading.Thread):
-    def __init__(self, queue):
-        threading.Thread.__init__(self)
-        self.queue = queue
+# ##### asyncio resolver
+#
+# Queries go straight to the nameserver over UDP, so every DNSBL gets its own
+# timeout and retry budget instead of blocking in the libc resolver.
+
+QTYPE_A = 1
+QTYPE_TXT = 16
+QTYPE_SOA = 6
+RCODE_NXDOMAIN = 3
+# Used when an NXDOMAIN answer carries no SOA record to take the negative TTL from
+DEFAULT_NEGATIVE_TTL = 300
+MAX_CACHE_TTL = 86400
+# Largest network accepted in a bulk file
+MAX_BULK_NETWORK = 65536
+
+# Meaning of the 127.0.0.x return codes of the zones that document them
+return_codes = {
+    "zen.spamhaus.org": {
+        "127.0.0.2": "SBL", "127.0.0.3": "SBL CSS",
+        "127.0.0.4": "XBL", "127.0.0.5": "XBL", "127.0.0.6": "XBL", "127.0.0.7": "XBL",
+        "127.0.0.9": "DROP", "127.0.0.10": "PBL ISP", "127.0.0.11": "PBL Spamhaus",
+    },
+    "bl.spamhaus.org": {"127.0.0.2": "SBL", "127.0.0.3": "SBL CSS", "127.0.0.9": "DROP"},
+    "xbl.spamhaus.org": {"127.0.0.4": "XBL"},
+    "dnsbl.sorbs.net": {
+        "127.0.0.2": "HTTP proxy", "127.0.0.3": "SOCKS proxy", "127.0.0.4": "MISC proxy",
+        "127.0.0.5": "SMTP relay", "127.0.0.6": "spam source", "127.0.0.7": "web vulnerability",
+        "127.0.0.8": "block", "127.0.0.9": "zombie", "127.0.0.10": "dynamic IP",
+    },
+    "b.barracudacentral.org": {"127.0.0.2": "listed"},
+    "cbl.abuseat.org": {"127.0.0.2": "CBL"},
+}
+
+
+def read_nameserver():
+    try:
+        with open("/etc/resolv.conf") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] == "nameserver":
+                    return fields[1]
+    except IOError:
+        pass
+    return "127.0.0.1"
+
+
+def build_query(query_id, name, qtype):
+    header = struct.pack("!HHHHHH", query_id, 0x0100, 1, 0, 0, 0)
+    qname = b"".join(struct.pack("B", len(label)) + label.encode("ascii")
+                     for label in name.rstrip(".").split("."))
+    return header + qname + b"\0" + struct.pack("!HH", qtype, 1)
+
+
+def skip_name(data, offset):
+    while True:
+        length = data[offset]
+        if length == 0:
+            return offset + 1
+        if length & 0xc0 == 0xc0:
+            return offset + 2
+        offset += length + 1
+
+
+def read_name(data, offset):
+    """Return the dotted name starting at offset, following compression pointers."""
+    labels = []
+    for _ in range(128):
+        length = data[offset]
+        if length == 0:
+            return ".".join(labels)
+        if length & 0xc0 == 0xc0:
+            offset = ((length & 0x3f) << 8) | data[offset + 1]
+            continue
+        labels.append(data[offset + 1:offset + 1 + length].decode("ascii", "replace"))
+        offset += length + 1
+    raise IndexError("name compression loop")
+
+
+def parse_response(data):
+    """Return (query id, question, rcode, [(type, ttl, value)], negative ttl) of a DNS response.
+
+    The question is the (name, type) of the first question entry, or None when there is none.
+    """
+    query_id, flags, qdcount, ancount, nscount, _ = struct.unpack("!HHHHHH", data[:12])
+    offset = 12
+    question = None
+    for _ in range(qdcount):
+        name = read_name(data, offset)
+        offset = skip_name(data, offset)
+        if question is None:
+            question = (name, struct.unpack("!H", data[offset:offset + 2])[0])
+        offset += 4
+    answers = []
+    negative_ttl = None
+    for section in range(ancount + nscount):
+        offset = skip_name(data, offset)
+        rtype, _, ttl, rdlength = struct.unpack("!HHIH", data[offset:offset + 10])
+        offset += 10
+        rdata = data[offset:offset + rdlength]
+        offset += rdlength
+        if section < ancount and rtype == QTYPE_A and rdlength == 4:
+            answers.append((rtype, ttl, socket.inet_ntoa(rdata)))
+        elif section < ancount and rtype == QTYPE_TXT:
+            strings = []
+            i = 0
+            while i < len(rdata):
+                strings.append(rdata[i + 1:i + 1 + rdata[i]].decode("utf-8", "replace"))
+                i += 1 + rdata[i]
+            answers.append((rtype, ttl, "".join(strings)))
+        elif section >= ancount and rtype == QTYPE_SOA:
+            # RFC 2308: the negative TTL is the lower of the SOA TTL and its minimum field
+            minimum = struct.unpack("!I", rdata[-4:])[0]
+            negative_ttl = min(ttl, minimum)
+    return query_id, question, flags & 0x0f, answers, negative_ttl
+
+
+class DNSClientProtocol(object):
+    """Datagram protocol that hands each response to the future waiting for its query id.
+
+    A response whose question differs from the one sent under that id (a late answer to an
+    earlier query that reused the id) is ignored.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        try:
+            response = parse_response(data)
+        except (struct.error, IndexError):
+            return
+        entry = self.pending.get(response[0])
+        if entry is None:
+            return
+        future, name, qtype = entry
+        question = response[1]
+        if question is None or question[1] != qtype or \
+                question[0].rstrip(".").lower() != name.rstrip(".").lower():
+            return
+        del self.pending[response[0]]
+        if not future.done():
+            future.set_result(response)
+
+    def error_received(self, exc):
+        pass
+
+    def connection_lost(self, exc):
+        pass
+
+
+class AsyncRBL(object):
+    """Look up names in DNSBL zones with asyncio, caching answers on disk for their TTL."""
+
+    def __init__(self, nameserver, port=53, timeout=2.0, retries=2, cache_file=None, zone_rate=None):
+        self.nameserver = nameserver
+        self.port = port
+        self.timeout = timeout
+        self.retries = retries
+        self.cache_file = cache_file
+        self.cache = {}
+        # per zone rate limit (queries per second) and the time the next query may be sent
+        self.zone_rate = zone_rate
+        self.zone_next = {}
+        self.protocol = None
+        self.transport = None
+        self.load_cache()
+
+    def load_cache(self):
+        if not self.cache_file:
+            return
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+            now = time.time()
+            self.cache = dict((k, v) for k, v in cache.items() if v["expires"] > now)
+        except (IOError, OSError, ValueError, KeyError, TypeError, AttributeError):
+            self.cache = {}
+
+    def save_cache(self):
+        if not self.cache_file:
+            return
+        tmp_file = "%s.%d" % (self.cache_file, os.getpid())
+        try:
+            with open(tmp_file, "w") as f:
+                json.dump(self.cache, f)
+            os.rename(tmp_file, self.cache_file)
+        except (IOError, OSError):
+            pass
+
+    async def open(self):
+        loop = asyncio.get_event_loop()
+        family = socket.AF_INET6 if ":" in self.nameserver else socket.AF_INET
+        self.transport, self.protocol = await loop.create_datagram_endpoint(
+            DNSClientProtocol, remote_addr=(self.nameserver, self.port), family=family)
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+        self.save_cache()
+
+    async def throttle(self, zone):
+        now = asyncio.get_event_loop().time()
+        slot = max(self.zone_next.get(zone, now), now)
+        self.zone_next[zone] = slot + 1.0 / self.zone_rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def query(self, name, qtype, zone=None):
+        """Return (rcode, [(type, ttl, value)]) or None when all tries timed out."""
+        key = "%s/%d" % (name, qtype)
+        cached = self.cache.get(key)
+        if cached is not None and cached["expires"] > time.time():
+            return cached["rcode"], [tuple(answer) for answer in cached["answers"]]
+        loop = asyncio.get_event_loop()
+        for attempt in range(self.retries + 1):
+            if self.zone_rate and zone:
+                await self.throttle(zone)
+            query_id = random.randint(0, 0xffff)
+            while query_id in self.protocol.pending:
+                query_id = random.randint(0, 0xffff)
+            future = loop.create_future() if hasattr(loop, "create_future") else asyncio.Future(loop=loop)
+            self.protocol.pending[query_id] = (future, name, qtype)
+            self.transport.sendto(build_query(query_id, name, qtype))
+            try:
+                _, _, rcode, answers, negative_ttl = await asyncio.wait_for(future, self.timeout)
+            except asyncio.TimeoutError:
+                self.protocol.pending.pop(query_id, None)
+                continue
+            if answers:
+                ttl = min(answer[1] for answer in answers)
+            else:
+                ttl = negative_ttl if negative_ttl is not None else DEFAULT_NEGATIVE_TTL
+            # only cache definite answers, not SERVFAIL and the like
+            if rcode in (0, RCODE_NXDOMAIN):
+                self.cache[key] = {"expires": time.time() + min(ttl, MAX_CACHE_TTL),
+                                   "rcode": rcode, "answers": answers}
+            return rcode, answers
+        return None
+
+    async def lookup(self, check_name, zone, txt_when_listed=False):
+        """Look up check_name in zone.
+
+        Returns (zone, state, codes, reason) where state is 'listed', 'clean'
+        or 'error', codes the 127.0.0.x answers with their meaning and reason
+        the TXT record, if any. With txt_when_listed the TXT record is only
+        asked for once the A record shows a listing.
+        """
+        name = "%s.%s" % (check_name, zone)
+        start_time = timeit.default_timer()
+        if txt_when_listed:
+            a_result = await self.query(name, QTYPE_A, zone)
+            txt_result = None
+            if a_result is not None and any(value.startswith("127.0.0.") for rtype, _, value in a_result[1] if rtype == QTYPE_A):
+                txt_result = await self.query(name, QTYPE_TXT, zone)
+        else:
+            a_result, txt_result = await asyncio.gather(self.query(name, QTYPE_A, zone), self.query(name, QTYPE_TXT, zone))
+        if debug:
+            print("It took %s seconds to get a response from the DNSBL %s" % (timeit.default_timer() - start_time, zone))
+        if a_result is None:
+            return zone, "error", [], "timed out"
+        rcode, answers = a_result
+        addresses = [value for rtype, _, value in answers if rtype == QTYPE_A]
+        listed = [a for a in addresses if a.startswith("127.0.0.")]
+        if not listed:
+            if rcode not in (0, RCODE_NXDOMAIN):
+                return zone, "error", [], "rcode %d" % rcode
+            if addresses and addresses[0].startswith("127.255.255."):
+                # Spamhaus style refusal, eg. when queried through a public resolver
+                return zone, "error", addresses, "query refused"
+            return zone, "clean", [], None
+        meanings = return_codes.get(zone, {})
+        codes = ["%s %s" % (a, meanings[a]) if a in meanings else a for a in listed]
+        reason = None
+        if txt_result is not None:
+            reason = "; ".join(value for rtype, _, value in txt_result[1] if rtype == QTYPE_TXT) or None
+        return zone, "listed", codes, reason
+
+
+def async_lookup_all(check_name, zones, nameserver, port, timeout, retries, cache_file):
+    rbl = AsyncRBL(nameserver, port, timeout, retries, cache_file)
+
+    async def run():
+        await rbl.open()
+        return await asyncio.gather(*[rbl.lookup(check_name, zone) for zone in zones])
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(run())
+    finally:
+        rbl.close()
+        loop.close()
 
-    def run(self):
+
+def async_lookup_bulk(check_names, zones, nameserver, port, timeout, retries, cache_file, concurrency, zone_rate):
+    """Look up every name in every zone, return {check_name: [lookup results]}.
+
+    A fixed number of workers take (name, zone) pairs from a queue, which
+    bounds the queries in flight and the memory used however many
+    addresses there are.
+    """
+    rbl = AsyncRBL(nameserver, port, timeout, retries, cache_file, zone_rate)
+    results = dict((name, []) for name in check_names)
+
+    async def worker(queue):
         while True:
-            # Grab hosts from queue
-            hostname, root_name = self.queue.get()
-            check_host = "%s.%s" % (hostname, root_name)
-            start_time = timeit.default_timer()
             try:
-                check_addr = socket.gethostbyname(check_host)
-            except socket.error:
-                check_addr = None
-            if check_addr is not None and "127.0.0." in check_addr:
-                on_blacklist.append(root_name)
+                name, zone = queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            results[name].append(await rbl.lookup(name, zone, txt_when_listed=True))
 
-            elapsed = timeit.default_timer() - start_time
-            # If debug option is set it prints the time it took to get an answer from each RBL
-            if debug: print("It took %s seconds to get a response from the DNSBL %s" % (elapsed,root_name))
+    async def run():
+        await rbl.open()
+        queue = asyncio.Queue()
+        # zones vary fastest, so the per zone rate limits spread the queries out
+        for name in check_names:
+            for zone in zones:
+                queue.put_nowait((name, zone))
+        await asyncio.gather(*[worker(queue) for _ in range(max(1, concurrency))])
 
-            # Signal queue that job is done
-            self.queue.task_done()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(run())
+    finally:
+        rbl.close()
+        loop.close()
+    return results
 
 
 def usage(argv0):
@@ -139,20 +445,131 @@ def usage(argv0):
     print(" or")
     print("%s -w <WARN level> -c <CRIT level> -a <ip address> [-d|--debug]" % argv0)
     print(" add -4 or -6 to force IPv4/IPv6 hostname lookups")
+    print(" -s <nameserver[:port]>  nameserver to query (default: first nameserver in /etc/resolv.conf)")
+    print(" -t <seconds>            timeout per query (default: 2)")
+    print(" -r <retries>            retries per query after a timeout (default: 2)")
+    print(" -C <file>               cache answers for their TTL in file, '' to disable (default: /tmp/check_rbl.cache)")
+    print(" or")
+    print("%s -w <WARN level> -c <CRIT level> -B <file> [-o <spool file>] [--service <name>]" % argv0)
+    print(" to check every address or CIDR in file (one per line, optionally followed by the host name to")
+    print(" submit the result for) and spool a passive check result per host, or print them after the")
+    print(" summary line when no spool file is given")
+    print(" --concurrency <n>       lookups in flight at once (default: 200)")
+    print(" --zone-rate <n>         queries per second sent to any one DNSBL (default: 50)")
+
+
+def reverse_name(addr):
+    """Return the DNSBL query name of an address, eg. 2.0.0.127 for 127.0.0.2."""
+    ip = ipaddress.ip_address(addr)
+    if (ip.version == 6):
+        addr_exploded = ip.exploded
+        return '.'.join([c for c in addr_exploded if c != ':'])[::-1]
+    addr_parts = str(ip).split('.')
+    addr_parts.reverse()
+    return '.'.join(addr_parts)
+
+
+def read_bulk_file(filename):
+    """Return [(address, host name)] for the addresses and networks listed in filename."""
+    entries = []
+    with open(filename) as f:
+        for line in f:
+            fields = line.split('#', 1)[0].split()
+            if not fields:
+                continue
+            network = ipaddress.ip_network(fields[0], strict=False)
+            if network.num_addresses > MAX_BULK_NETWORK:
+                raise ValueError('%s has more than %d addresses' % (fields[0], MAX_BULK_NETWORK))
+            addresses = [network.network_address] if network.num_addresses == 1 else network.hosts()
+            for address in addresses:
+                entries.append((str(address), fields[1] if len(fields) > 1 and network.num_addresses == 1 else str(address)))
+    return entries
+
+
+def evaluate(host, results, warn_limit, crit_limit, zones):
+    """Return (status code, output) for the lookup results of one address."""
+    listed = []
+    details = []
+    failed = []
+    for zone, state, codes, reason in results:
+        if state == 'listed':
+            listed.append(zone)
+            details.append('%s: %s%s' % (zone, ', '.join(codes), ' (%s)' % reason if reason else ''))
+        elif state == 'error':
+            failed.append('%s (%s)' % (zone, reason))
+
+    if len(failed) == len(zones):
+        return 3, 'UNKNOWN: no DNSBL answered for %s' % host
+    note = ''
+    if failed:
+        note = ' (%d blacklist(s) did not answer: %s)' % (len(failed), ', '.join(failed))
+    long_output = ''.join('\n' + line for line in details)
+
+    if listed:
+        output = '%s on %s blacklist(s): %s%s%s' % (
+            host, len(listed), ', '.join(listed), note, long_output)
+        if len(listed) >= crit_limit:
+            return 2, 'CRITICAL: %s' % output
+        if len(listed) >= warn_limit:
+            return 1, 'WARNING: %s' % output
+        # Status is OK and host is blacklisted
+        return 0, 'OK: %s' % output
+    # Status is OK and host is not blacklisted
+    return 0, 'OK: %s not on any known blacklists%s' % (host, note)
+
+
+# CRITICAL before WARNING before UNKNOWN before OK
+SEVERITY = {0: 0, 3: 1, 1: 2, 2: 3}
+
+
+def host_result(host_name, evaluated):
+    """Combine the (status code, output) of all addresses of a host into one."""
+    if len(evaluated) == 1:
+        return evaluated[0]
+    code = max((code for code, output in evaluated), key=SEVERITY.get)
+    # report every address that is listed or could not be checked
+    problems = [output.split(': ', 1)[1] for output_code, output in evaluated
+                if output_code != 0 or ' blacklist(s): ' in output]
+    label = {0: 'OK', 1: 'WARNING', 2: 'CRITICAL', 3: 'UNKNOWN'}[code]
+    if not problems:
+        return code, '%s: %s: none of %d addresses on any known blacklists' % (label, host_name, len(evaluated))
+    return code, '%s: %s: %d of %d addresses with findings\n%s' % (
+        label, host_name, len(problems), len(evaluated), '\n'.join(problems))
+
+
+def parse_nameserver(value):
+    """Split "host", "host:port" or "[v6 address]:port"."""
+    if value.startswith('['):
+        host, _, port = value[1:].partition(']:')
+        return host.rstrip(']'), int(port or 53)
+    if value.count(':') == 1:
+        host, port = value.split(':')
+        return host, int(port)
+    return value, 53
+
 
 def main(argv, environ):
     options, remainder = getopt.getopt(argv[1:],
-                                       "w:c:h:a:d46",
-                                       ["warn=", "crit=", "host=", "address=","debug", "ipv4", "ipv6"])
+                                       "w:c:h:a:d46s:t:r:C:B:o:",
+                                       ["warn=", "crit=", "host=", "address=","debug", "ipv4", "ipv6",
+                                        "server=", "timeout=", "retries=", "cache-file=",
+                                        "bulk=", "spool=", "service=", "concurrency=", "zone-rate="])
     status = {'OK': 0, 'WARNING': 1, 'CRITICAL': 2, 'UNKNOWN': 3}
     host = None
     addr = None
     force_ipv4 = False
     force_ipv6 = False
-
-    if len(options) > 4 or len(options) < 3:
-        usage(argv[0])
-        sys.exit(status['UNKNOWN'])
+    warn_limit = None
+    crit_limit = None
+    nameserver = None
+    timeout = 2.0
+    retries = 2
+    cache_file = '/tmp/check_rbl.cache'
+    bulk_file = None
+    spool = None
+    service = 'RBL'
+    concurrency = 200
+    zone_rate = 50.0
 
     for field, val in options:
         if field in ('-w', '--warn'):
@@ -170,10 +587,39 @@ def main(argv, environ):
         elif field in ('-d', '--debug'):
             global debug
             debug = True
+        elif field in ('-s', '--server'):
+            nameserver = val
+        elif field in ('-t', '--timeout'):
+            timeout = float(val)
+        elif field in ('-r', '--retries'):
+            retries = int(val)
+        elif field in ('-C', '--cache-file'):
+            cache_file = val
+        elif field in ('-B', '--bulk'):
+            bulk_file = val
+        elif field in ('-o', '--spool'):
+            spool = val
+        elif field == '--service':
+            service = val
+        elif field == '--concurrency':
+            concurrency = int(val)
+        elif field == '--zone-rate':
+            zone_rate = float(val)
         else:
             usage(argv[0])
             sys.exit(status['UNKNOWN'])
 
+    if warn_limit is None or crit_limit is None or not (host or addr or bulk_file):
+        usage(argv[0])
+        sys.exit(status['UNKNOWN'])
+
+    if bulk_file:
+        if host or addr:
+            print("ERROR: Cannot use a bulk file together with a host or address.")
+            sys.exit(status['UNKNOWN'])
+        bulk(bulk_file, spool, service, warn_limit, crit_limit, nameserver, timeout, retries,
+             cache_file, concurrency, zone_rate)
+
     if host and addr:
         print("ERROR: Cannot use both host and address. Please choose one.")
         sys.exit(status['UNKNOWN'])
@@ -196,57 +642,79 @@ def main(argv, environ):
             print("ERROR resolving '%s': %s" % (host, e))
             sys.exit(status['UNKNOWN'])
 
-    if sys.version_info[0] >= 3:
-        ip = ipaddress.ip_address(addr)
-    else:
-        ip = ipaddress.ip_address(unicode(addr))
-    if (ip.version == 6):
-        addr_exploded = ip.exploded
-        check_name = '.'.join([c for c in addr_exploded if c != ':'])[::-1]
-    else:
-        addr_parts = addr.split('.')
-        addr_parts.reverse()
-        check_name = '.'.join(addr_parts)
+    check_name = reverse_name(addr)
     # Make host and addr the same thing to simplify output functions below
     host = addr
 
-# ##### Start thread stuff
+    ns_host, ns_port = parse_nameserver(nameserver or read_nameserver())
+    results = async_lookup_all(check_name, serverlist, ns_host, ns_port, timeout, retries, cache_file)
 
-    # Spawn a pool of threads then pass them the queue
-    for i in range(10):
-        t = ThreadRBL(queue)
-        t.setDaemon(True)
-        t.start()
+# Create output
+    code, output = evaluate(host, results, warn_limit, crit_limit, serverlist)
+    if code == status['UNKNOWN']:
+        output += ', is %s reachable?' % ns_host
+    print(output)
+    sys.exit(code)
 
-    # Populate the queue
-    for blhost in serverlist:
-        queue.put((check_name, blhost))
 
-    # Wait for everything in the queue to be processed
-    queue.join()
+def bulk(bulk_file, spool, service, warn_limit, crit_limit, nameserver, timeout, retries,
+         cache_file, concurrency, zone_rate):
+    """Check all addresses of bulk_file in one run and emit passive check results."""
+    status = {'OK': 0, 'WARNING': 1, 'CRITICAL': 2, 'UNKNOWN': 3}
+    try:
+        entries = read_bulk_file(bulk_file)
+    except (IOError, OSError, ValueError) as e:
+        print("UNKNOWN: cannot read bulk file '%s': %s" % (bulk_file, e))
+        sys.exit(status['UNKNOWN'])
 
-# ##### End thread stuff
+    # the same address may be listed twice or inside two networks, look it up once
+    names = {}
+    for address, host_name in entries:
+        names.setdefault(reverse_name(address), []).append((address, host_name))
 
-# Create output
-    if on_blacklist:
-        output = '%s on %s blacklist(s): %s' % (
-            host, len(on_blacklist), ', '.join(on_blacklist))
-        # Status is CRITICAL
-        if len(on_blacklist) >= crit_limit:
-            print('CRITICAL: %s' % output)
-            sys.exit(status['CRITICAL'])
-        # Status is WARNING
-        if len(on_blacklist) >= warn_limit:
-            print('WARNING: %s' % output)
-            sys.exit(status['WARNING'])
-        else:
-            # Status is OK and host is blacklisted
-            print('OK: %s' % output)
-            sys.exit(status['OK'])
+    ns_host, ns_port = parse_nameserver(nameserver or read_nameserver())
+    start_time = timeit.default_timer()
+    results = async_lookup_bulk(sorted(names), serverlist, ns_host, ns_port, timeout, retries,
+                                cache_file, concurrency, zone_rate)
+
+    # a host may have several addresses: its result is the worst of them
+    evaluated = dict((check_name, evaluate(addresses[0][0], results[check_name], warn_limit, crit_limit,
+                                           serverlist))
+                     for check_name, addresses in names.items())
+    hosts = {}
+    for address, host_name in entries:
+        check_name = reverse_name(address)
+        if check_name not in hosts.setdefault(host_name, []):
+            hosts[host_name].append(check_name)
+
+    lines = []
+    counts = dict((code, 0) for code in status.values())
+    for host_name in sorted(hosts):
+        code, output = host_result(host_name, [evaluated[check_name] for check_name in hosts[host_name]])
+        counts[code] += 1
+        # passive results carry one line of output
+        lines.append('[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s' % (
+            time.time(), host_name, service, code, output.replace('\n', '; ')))
+
+    summary = ('OK: Bulk: %d hosts, %d addresses, %d lookups in %.1fs, %d OK, %d WARNING, %d CRITICAL, %d UNKNOWN'
+               ' | ok=%d warning=%d critical=%d unknown=%d' % (
+                   len(lines), len(names), len(names) * len(serverlist), timeit.default_timer() - start_time,
+                   counts[0], counts[1], counts[2], counts[3], counts[0], counts[1], counts[2], counts[3]))
+    if spool:
+        tmp_file = '%s.%d' % (spool, os.getpid())
+        try:
+            with open(tmp_file, 'w') as f:
+                f.write(''.join(line + '\n' for line in lines))
+            os.rename(tmp_file, spool)
+        except (IOError, OSError) as e:
+            print("UNKNOWN: cannot write spool file '%s': %s" % (spool, e))
+            sys.exit(status['UNKNOWN'])
+        print(summary)
     else:
-        # Status is OK and host is not blacklisted
-        print('OK: %s not on any known blacklists' % host)
-        sys.exit(status['OK'])
+        # the plugin output comes first, the external command lines follow as long text
+        print(summary)
+        print('\n'.join(lines))
+    sys.exit(status['OK'])
 
 if __name__ == "__main__":
     main(sys.argv, os.environ)
@@ -35,19 +35,45 @@ import re
 import os
 import numbers
 import socket
+import atexit
 
-try:
-    import pymongo
-except ImportError as e:
-    print(e)
-    sys.exit(2)
+_process_start = time.time()
+_profile = []
+profile_enabled = False
 
-# As of pymongo v 1.9 the SON API is part of the BSON package, therefore attempt
-# to import from there and fall back to pymongo in cases of older pymongo
-if pymongo.version >= "1.9":
-    import bson.son as son
-else:
-    import pymongo.son as son
+# pymongo and bson are only imported once the options have been parsed, see
+# load_pymongo(). Invalid command lines and --help never pay for them.
+pymongo = None
+son = None
+
+
+def load_pymongo():
+    global pymongo, son
+    try:
+        import pymongo
+    except ImportError as e:
+        print(e)
+        sys.exit(2)
+
+    # As of pymongo v 1.9 the SON API is part of the BSON package, therefore attempt
+    # to import from there and fall back to pymongo in cases of older pymongo
+    if pymongo.version >= "1.9":
+        import bson.son as son
+    else:
+        import pymongo.son as son
+
+
+def profile_mark(label):
+    _profile.append((label, time.time()))
+
+
+def print_profile():
+    """ Print the time spent in each startup phase to stderr (--profile) """
+    previous = _process_start
+    for label, ts in _profile:
+        sys.stderr.write("profile: %-10s %8.2f ms\n" % (label, (ts - previous) * 1000))
+        previous = ts
+    sys.stderr.write("profile: %-10s %8.2f ms\n" % ("total", (previous - _process_start) * 1000))
 
 
 #
@@ -115,12 +141,48 @@ def check_levels(param, warning, critical, message, ok=[]):
         return 2
 
 
-def get_server_status(con):
+#
+# Top level serverStatus sections the server builds by default. get_server_status()
+# excludes every one of them the calling action does not read, wiredTiger,
+# tcmalloc and metrics alone can be hundreds of KB on a busy server.
+#
+SERVER_STATUS_SECTIONS = ('asserts', 'backgroundFlushing', 'connections', 'dur', 'electionMetrics', 'extra_info',
+                          'flowControl', 'globalLock', 'indexCounters', 'locks', 'logicalSessionRecordCache', 'mem',
+                          'metrics', 'network', 'opLatencies', 'opReadConcernCounters', 'opcounters', 'opcountersRepl',
+                          'oplogTruncation', 'recordStats', 'repl', 'security', 'storageEngine', 'tcmalloc',
+                          'transactions', 'transportSecurity', 'twoPhaseCommitCoordinator', 'wiredTiger', 'writeBacksQueued')
+
+
+def server_status_command(sections=None):
+    command = [('serverStatus', 1)]
+    if sections is not None:
+        command += [(section, 0) for section in SERVER_STATUS_SECTIONS if section not in sections]
+    return command
+
+
+def get_server_status(con, sections=None):
+    """ Run serverStatus, limited to the given top level sections when sections is set
+
+    With --profile the same command is fetched as raw BSON, so the payload size,
+    the fetch and the decode time can be reported apart on stderr """
+    command = server_status_command(sections)
+    kwargs = {}
+    if profile_enabled:
+        from bson.codec_options import CodecOptions
+        from bson.raw_bson import RawBSONDocument
+        kwargs['codec_options'] = CodecOptions(document_class=RawBSONDocument)
+    start = time.time()
     try:
         set_read_preference(con.admin)
-        data = con.admin.command(pymongo.son_manipulator.SON([('serverStatus', 1)]))
+        data = con.admin.command(pymongo.son_manipulator.SON(command), **kwargs)
     except:
-        data = con.admin.command(son.SON([('serverStatus', 1)]))
+        data = con.admin.command(son.SON(command), **kwargs)
+    if profile_enabled:
+        import bson
+        fetched = time.time()
+        raw, data = data.raw, bson.BSON(data.raw).decode()
+        sys.stderr.write("profile: serverStatus %d bytes, %d sections, fetch %.2f ms, decode %.2f ms\n" %
+                         (len(raw), len(data), (fetched - start) * 1000, (time.time() - fetched) * 1000))
     return data
 
 def split_host_port(string):
@@ -133,6 +195,7 @@ def split_host_port(string):
 
 
 def main(argv):
+    global profile_enabled
     p = optparse.OptionParser(conflict_handler="resolve", description="This Nagios plugin checks the health of mongodb.")
 
     p.add_option('-H', '--host', action='store', type='string', dest='host', default='127.0.0.1', help='The hostname you want to connect to')
@@ -168,8 +231,16 @@ def main(argv):
     p.add_option('-m','--auth-mechanism', action='store', type='choice', dest='auth_mechanism', default=None, help='Auth mechanism used for auth with mongodb',
     choices=['MONGODB-X509','SCRAM-SHA-256','SCRAM-SHA-1'])
     p.add_option('--disable_retry_writes', dest='retry_writes_disabled', default=False, action='callback', callback=optional_arg(True), help='Disable retryWrites feature')
+    p.add_option('--version-cache-ttl', action='store', type='int', dest='version_cache_ttl', default=3600, help='Seconds to reuse the server version cached in the state dir, 0 asks the server every time')
+    p.add_option('--profile', action='store_true', dest='profile', default=False, help='Print the time spent in each startup phase to stderr')
 
     options, arguments = p.parse_args()
+    if options.profile:
+        profile_enabled = True
+        atexit.register(print_profile)
+    profile_mark("options")
+    load_pymongo()
+    profile_mark("import")
     host = options.host
     host_to_check = options.host_to_check if options.host_to_check else options.host
     rdns_lookup = options.rdns_lookup
@@ -216,11 +287,13 @@ def main(argv):
     err, con = mongo_connect(host, port, ssl, user, passwd, replicaset, authdb, insecure, ssl_ca_cert_file, cert_file, auth_mechanism, retry_writes_disabled=retry_writes_disabled)
     if err != 0:
         return err
+    profile_mark("connect")
 
-    # Autodetect mongo-version and force pymongo to let us know if it can connect or not.
-    err, mongo_version = check_version(con)
+    # Autodetect mongo-version, mongo_connect() already made sure the server answers.
+    err, mongo_version = check_version(con, host, port, options.version_cache_ttl)
     if err != 0:
         return err
+    profile_mark("version")
 
     conn_time = time.time() - start
 
@@ -393,11 +466,34 @@ def set_read_preference(db):
     else:
         db.read_preference = pymongo.ReadPreference.SECONDARY
 
-def check_version(con):
+def check_version(con, host=None, port=None, cache_ttl=0):
+    """ Return the major server version, reusing the copy kept in the state dir
+    for cache_ttl seconds instead of a server_info() round trip """
+    file_name = build_file_name(host, port, "version") if host and cache_ttl > 0 else None
+    if file_name:
+        try:
+            fresh = time.time() - os.path.getmtime(file_name) < cache_ttl
+        except OSError:
+            fresh = False
+        err, version = (read_values(file_name) or (2, None)) if fresh else (1, None)
+        if err == 0 and version:
+            command_cache(con)['server_info'] = {'version': version.strip()}
     try:
-        server_info = con.server_info()
+        server_info = get_server_info(con)
     except Exception as e:
         return exit_with_general_critical(e), None
+    if file_name and not fresh:
+        # The copy only saves a round trip, failing to write it must not fail the check.
+        # Write it aside and rename, so a concurrent run never reads half a version.
+        tmp_name = "%s.%d" % (file_name, os.getpid())
+        try:
+            write_values(tmp_name, server_info['version'])
+            os.rename(tmp_name, file_name)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp_name)
+            except OSError:
+                pass
     return 0, int(server_info['version'].split('.')[0].strip())
 
 def check_connect(host, port, warning, critical, perf_data, user, passwd, conn_time):
@@ -413,7 +509,7 @@ def check_connections(con, warning, critical, perf_data):
     warning = warning or 80
     critical = critical or 95
     try:
-        data = get_server_status(con)
+        data = get_server_status(con, ('connections',))
 
         current = float(data['connections']['current'])
         available = float(data['connections']['available'])
@@ -432,11 +528,12 @@ def check_connections(con, warning, critical, perf_data):
 def check_rep_lag(con, host, port, rdns_lookup, warning, critical, percent, perf_data, max_lag, ssl=False, user=None, passwd=None, replicaset=None, authdb="admin", insecure=None, ssl_ca_cert_file=None, cert_file=None, auth_mechanism=None, retry_writes_disabled=False):
     # Get mongo to tell us replica set member name when connecting locally
     if "127.0.0.1" == host:
-        if not "me" in list(con.admin.command("ismaster","1").keys()):
+        ismaster = con.admin.command("ismaster", "1")
+        if not "me" in list(ismaster.keys()):
             print("UNKNOWN - This is not replicated MongoDB")
             return 3
 
-        host = con.admin.command("ismaster","1")["me"].split(':')[0]
+        host = ismaster["me"].split(':')[0]
 
     if percent:
         warning = warning or 50
@@ -446,17 +543,29 @@ def check_rep_lag(con, host, port, rdns_lookup, warning, critical, percent, perf
         critical = critical or 3600
     rs_status = {}
     slaveDelays = {}
+
+    def primary_time_diff(primary_name):
+        # The oplog window of the primary is only reachable through a second
+        # connection when we are not already talking to it
+        if rs_status.get('myState') == 1:
+            return 0, replication_get_time_diff(con)
+        primary_host, primary_port = split_host_port(primary_name)
+        err, primary_con = mongo_connect(primary_host, int(primary_port), ssl, user, passwd, replicaset, authdb, insecure, ssl_ca_cert_file, cert_file, auth_mechanism, retry_writes_disabled=retry_writes_disabled)
+        if err != 0:
+            return err, None
+        return 0, replication_get_time_diff(primary_con)
+
     try:
         #set_read_preference(con.admin)
 
         # Get replica set status
         try:
-            rs_status = con.admin.command("replSetGetStatus")
+            rs_status = get_rs_status(con)
         except pymongo.errors.OperationFailure as e:
             if ((e.code == None and str(e).find('failed: not running with --replSet"')) or (e.code == 76 and str(e).find('not running with --replSet"'))):
                 print("UNKNOWN - Not running with replSet")
                 return 3
-        serverVersion = tuple(con.server_info()['version'].split('.'))
+        serverVersion = tuple(get_server_info(con)['version'].split('.'))
         if serverVersion >= tuple("2.0.0".split(".")):
             #
             # check for version greater then 2.0
@@ -513,10 +622,9 @@ def check_rep_lag(con, host, port, rdns_lookup, warning, critical, percent, perf
                             data = data + member['name'] + " lag=%d;" % replicationLag
                             maximal_lag = max(maximal_lag, replicationLag)
                     if percent:
-                        err, con = mongo_connect(split_host_port(primary_node['name'])[0], int(split_host_port(primary_node['name'])[1]), ssl, user, passwd, replicaset, authdb, insecure, ssl_ca_cert_file, cert_file, auth_mechanism, retry_writes_disabled=retry_writes_disabled)
+                        err, primary_timediff = primary_time_diff(primary_node['name'])
                         if err != 0:
                             return err
-                        primary_timediff = replication_get_time_diff(con)
                         maximal_lag = int(float(maximal_lag) / float(primary_timediff) * 100)
                         message = "Maximal lag is " + str(maximal_lag) + " percents"
                         message += performance_data(perf_data, [(maximal_lag, "replication_lag_percent", warning, critical)])
@@ -545,10 +653,9 @@ def check_rep_lag(con, host, port, rdns_lookup, warning, critical, percent, perf
                 lag = float(optime_lag.seconds + optime_lag.days * 24 * 3600)
 
             if percent:
-                err, con = mongo_connect(split_host_port(primary_node['name'])[0], int(split_host_port(primary_node['name'])[1]), ssl, user, passwd, replicaset, authdb, insecure, ssl_ca_cert_file, cert_file, auth_mechanism, retry_writes_disabled=retry_writes_disabled)
+                err, primary_timediff = primary_time_diff(primary_node['name'])
                 if err != 0:
                     return err
-                primary_timediff = replication_get_time_diff(con)
                 if primary_timediff != 0:
                     lag = int(float(lag) / float(primary_timediff) * 100)
                 else:
@@ -563,9 +670,6 @@ def check_rep_lag(con, host, port, rdns_lookup, warning, critical, percent, perf
             #
             # less than 2.0 check
             #
-            # Get replica set status
-            rs_status = con.admin.command("replSetGetStatus")
-
             # Find the primary and/or the current node
             primary_node = None
             host_node = None
@@ -589,10 +693,9 @@ def check_rep_lag(con, host, port, rdns_lookup, warning, critical, percent, perf
             optime_lag = abs(primary_node[1] - host_node["optimeDate"])
             lag = optime_lag.seconds
             if percent:
-                err, con = mongo_connect(split_host_port(primary_node['name'])[0], int(split_host_port(primary_node['name'])[1]), ssl, user, passwd, replicaset, authdb, insecure, ssl_ca_cert_file, cert_file, auth_mechanism, retry_writes_disabled=retry_writes_disabled)
+                err, primary_timediff = primary_time_diff(primary_node[0])
                 if err != 0:
                     return err
-                primary_timediff = replication_get_time_diff(con)
                 lag = int(float(lag) / float(primary_timediff) * 100)
                 message = "Lag is " + str(lag) + " percents"
                 message += performance_data(perf_data, [(lag, "replication_lag_percent", warning, critical)])
@@ -634,7 +737,7 @@ def check_memory(con, warning, critical, perf_data, mapped_memory, host):
     #print "mem total: {0}kb, warn: {1}GB, crit: {2}GB".format(mem_total_kB,warning, critical)
 
     try:
-        data = get_server_status(con)
+        data = get_server_status(con, ('mem',))
         if not data['mem']['supported'] and not mapped_memory:
             print("OK - Platform not supported for memory info")
             return 0
@@ -684,7 +787,7 @@ def check_memory_mapped(con, warning, critical, perf_data):
     warning = warning or 8
     critical = critical or 16
     try:
-        data = get_server_status(con)
+        data = get_server_status(con, ('mem',))
         if not data['mem']['supported']:
             print("OK - Platform not supported for memory info")
             return 0
@@ -723,7 +826,7 @@ def check_lock(con, warning, critical, perf_data, mongo_version):
     critical = critical or 30
     if mongo_version == 2:
         try:
-            data = get_server_status(con)
+            data = get_server_status(con, ('globalLock',))
             lockTime = data['globalLock']['lockTime']
             totalTime = data['globalLock']['totalTime']
             #
@@ -752,7 +855,7 @@ def check_flushing(con, warning, critical, avg, perf_data):
     warning = warning or 5000
     critical = critical or 15000
     try:
-        data = get_server_status(con)
+        data = get_server_status(con, ('backgroundFlushing',))
         try:
             data['backgroundFlushing']
             if avg:
@@ -778,11 +881,11 @@ def index_miss_ratio(con, warning, critical, perf_data):
     warning = warning or 10
     critical = critical or 30
     try:
-        data = get_server_status(con)
+        data = get_server_status(con, ('indexCounters',))
 
         try:
             data['indexCounters']
-            serverVersion = tuple(con.server_info()['version'].split('.'))
+            serverVersion = tuple(get_server_info(con)['version'].split('.'))
             if serverVersion >= tuple("2.4.0".split(".")):
                 miss_ratio = float(data['indexCounters']['missRatio'])
             else:
@@ -1072,7 +1175,7 @@ def check_queues(con, warning, critical, perf_data):
     warning = warning or 10
     critical = critical or 30
     try:
-        data = get_server_status(con)
+        data = get_server_status(con, ('globalLock',))
 
         total_queues = float(data['globalLock']['currentQueue']['total'])
         readers_queues = float(data['globalLock']['currentQueue']['readers'])
@@ -1141,7 +1244,7 @@ def check_queries_per_second(con, query_type, warning, critical, perf_data, mong
 
     try:
         db = con.local
-        data = get_server_status(con)
+        data = get_server_status(con, ('opcounters',))
 
         # grab the count
         num = int(data['opcounters'][query_type])
@@ -1202,31 +1305,13 @@ def check_oplog(con, warning, critical, perf_data):
     warning = warning or 24
     critical = critical or 4
     try:
-        db = con.local
-        ol = db.listCollections.find_one({"name": "local.oplog.rs"})
-        if (db.listCollections.find_one({"name": "local.oplog.rs"}) != None):
-            oplog = "oplog.rs"
-        else:
-            ol = db.listCollections.find_one({"name": "local.oplog.$main"})
-            if (db.listCollections.find_one({"name": "local.oplog.$main"}) != None):
-                oplog = "oplog.$main"
-            else:
-                message = "neither master/slave nor replica set replication detected"
-                return check_levels(None, warning, critical, message)
+        window = get_oplog_window(con)
+        if window is None:
+            message = "neither master/slave nor replica set replication detected"
+            return check_levels(None, warning, critical, message)
 
-        try:
-                set_read_preference(con.admin)
-                data = con.local.command(pymongo.son_manipulator.SON([('collstats', oplog)]))
-        except:
-                data = con.admin.command(son.SON([('collstats', oplog)]))
-
-        ol_size = data['size']
-        ol_storage_size = data['storageSize']
-        ol_used_storage = int(float(ol_size) / ol_storage_size * 100 + 1)
-        ol = con.local[oplog]
-        firstc = ol.find().sort("$natural", pymongo.ASCENDING).limit(1)[0]['ts']
-        lastc = ol.find().sort("$natural", pymongo.DESCENDING).limit(1)[0]['ts']
-        time_in_oplog = (lastc.as_datetime() - firstc.as_datetime())
+        ol_used_storage = int(float(window['size']) / window['storageSize'] * 100 + 1)
+        time_in_oplog = (window['last'].as_datetime() - window['first'].as_datetime())
         message = "Oplog saves " + str(time_in_oplog) + " %d%% used" % ol_used_storage
         try:  # work starting from python2.7
             hours_in_oplog = time_in_oplog.total_seconds() / 60 / 60
@@ -1248,7 +1333,7 @@ Under very high write situations it is normal for this value to be nonzero.  """
     warning = warning or 10
     critical = critical or 40
     try:
-        data = get_server_status(con)
+        data = get_server_status(con, ('dur',))
         j_commits_in_wl = data['dur']['commitsInWriteLock']
         message = "Journal commits in DB write lock : %d" % j_commits_in_wl
         message += performance_data(perf_data, [(j_commits_in_wl, "j_commits_in_wl", warning, critical)])
@@ -1264,7 +1349,7 @@ def check_journaled(con, warning, critical, perf_data):
     warning = warning or 20
     critical = critical or 40
     try:
-        data = get_server_status(con)
+        data = get_server_status(con, ('dur',))
         journaled = data['dur']['journaledMB']
         message = "Journaled : %.2f MB" % journaled
         message += performance_data(perf_data, [("%.2f" % journaled, "journaled", warning, critical)])
@@ -1281,7 +1366,7 @@ than the amount physically written to disk."""
     warning = warning or 20
     critical = critical or 40
     try:
-        data = get_server_status(con)
+        data = get_server_status(con, ('dur',))
         writes = data['dur']['writeToDataFilesMB']
         message = "Write to data files : %.2f MB" % writes
         message += performance_data(perf_data, [("%.2f" % writes, "write_to_data_files", warning, critical)])
@@ -1311,7 +1396,7 @@ def check_opcounters(con, host, port, warning, critical, perf_data):
     warning = warning or 10000
     critical = critical or 15000
 
-    data = get_server_status(con)
+    data = get_server_status(con, ('opcounters', 'opcountersRepl'))
     err1, delta_opcounters = get_opcounters(data, 'opcounters', host, port)
     err2, delta_opcounters_repl = get_opcounters(data, 'opcountersRepl', host, port)
     if err1 == 0 and err2 == 0:
@@ -1332,7 +1417,7 @@ def check_current_lock(con, host, port, warning, critical, perf_data):
     """ A function to get current lock percentage and not a global one, as check_lock function does"""
     warning = warning or 10
     critical = critical or 30
-    data = get_server_status(con)
+    data = get_server_status(con, ('globalLock',))
 
     lockTime = float(data['globalLock']['lockTime'])
     totalTime = float(data['globalLock']['totalTime'])
@@ -1351,7 +1436,7 @@ def check_page_faults(con, host, port, warning, critical, perf_data):
     """ A function to get page_faults per second from the system"""
     warning = warning or 10
     critical = critical or 30
-    data = get_server_status(con)
+    data = get_server_status(con, ('extra_info',))
 
     try:
         page_faults = float(data['extra_info']['page_faults'])
@@ -1373,7 +1458,7 @@ def check_asserts(con, host, port, warning, critical, perf_data):
     """ A function to get asserts from the system"""
     warning = warning or 1
     critical = critical or 10
-    data = get_server_status(con)
+    data = get_server_status(con, ('asserts',))
 
     asserts = data['asserts']
 
@@ -1428,7 +1513,7 @@ def check_replica_primary(con, host, warning, critical, perf_data, replicaset, m
     primary_status = 0
     message = "Primary server has not changed"
     db = con["nagios"]
-    data = get_server_status(con)
+    data = get_server_status(con, ('repl',))
     if replicaset != data['repl'].get('setName'):
         message = "Replica set requested: %s differs from the one found: %s" % (replicaset, data['repl'].get('setName'))
         primary_status = 2
@@ -1454,15 +1539,9 @@ def check_page_faults(con, sample_time, warning, critical, perf_data):
     warning = warning or 10
     critical = critical or 20
     try:
-        try:
-            set_read_preference(con.admin)
-            data1 = con.admin.command(pymongo.son_manipulator.SON([('serverStatus', 1)]))
-            time.sleep(sample_time)
-            data2 = con.admin.command(pymongo.son_manipulator.SON([('serverStatus', 1)]))
-        except:
-            data1 = con.admin.command(son.SON([('serverStatus', 1)]))
-            time.sleep(sample_time)
-            data2 = con.admin.command(son.SON([('serverStatus', 1)]))
+        data1 = get_server_status(con, ('extra_info',))
+        time.sleep(sample_time)
+        data2 = get_server_status(con, ('extra_info',))
 
         try:
             #on linux servers only
@@ -1653,20 +1732,87 @@ def maintain_delta(new_vals, host, port, action):
     return err + write_res, delta
 
 
+#
+# Oplog / replication helpers shared by the oplog and replication_lag actions.
+# Everything is memoized per connection, so one run never asks the same server
+# twice for server_info, replSetGetStatus, collstats or the oplog bounds. The
+# memo lives on the client object itself, so a reconnected client never sees
+# the answers of an earlier one.
+#
+def command_cache(con):
+    cache = getattr(con, '_check_mongodb_cache', None)
+    if cache is None:
+        cache = con._check_mongodb_cache = {}
+    return cache
+
+
+def cached_command(con, key, fetch):
+    entry = command_cache(con)
+    if key not in entry:
+        entry[key] = fetch()
+    return entry[key]
+
+
+def get_server_info(con):
+    return cached_command(con, 'server_info', con.server_info)
+
+
+def get_rs_status(con):
+    return cached_command(con, 'rs_status', lambda: con.admin.command("replSetGetStatus"))
+
+
+def member_optime_ts(member):
+    """ Return the optime Timestamp of a replSetGetStatus member (pv0 and pv1) """
+    optime = member.get('optime')
+    if isinstance(optime, dict):
+        return optime.get('ts')
+    return optime
+
+
+def find_oplog(con):
+    """ Return the (name, collstats) of the oplog collection, or (None, None) """
+    def fetch():
+        for name in ("oplog.rs", "oplog.$main"):
+            try:
+                stats = con.local.command("collstats", name)
+            except pymongo.errors.OperationFailure:
+                continue
+            # recent servers answer collstats on a missing collection with an empty document
+            if stats.get('capped') or stats.get('storageSize'):
+                return name, stats
+        return None, None
+    return cached_command(con, 'oplog_stats', fetch)
+
+
+def get_oplog_window(con):
+    """ Return name, size, storageSize and the first/last ts of the oplog, or None
+
+    The last ts comes from our own optime in an already fetched replSetGetStatus
+    when there is one, so only the first entry has to be read from the oplog."""
+    def fetch():
+        name, stats = find_oplog(con)
+        if name is None:
+            return None
+        ol = con.local[name]
+        projection = {'ts': 1, '_id': 0}
+        first = next(ol.find({}, projection).sort("$natural", pymongo.ASCENDING).limit(1))['ts']
+        last = None
+        rs_status = command_cache(con).get('rs_status')
+        if rs_status:
+            for member in rs_status.get('members', []):
+                if member.get('self'):
+                    last = member_optime_ts(member)
+        if last is None:
+            last = next(ol.find({}, projection).sort("$natural", pymongo.DESCENDING).limit(1))['ts']
+        return {'name': name, 'size': stats['size'], 'storageSize': stats['storageSize'], 'first': first, 'last': last}
+    return cached_command(con, 'oplog_window', fetch)
+
+
 def replication_get_time_diff(con):
-    col = 'oplog.rs'
-    local = con.local
-    ol = local.listCollections.find_one({"name": "local.oplog.$main"})
-    if ol:
-        col = 'oplog.$main'
-    firstc = local[col].find().sort("$natural", 1).limit(1)
-    lastc = local[col].find().sort("$natural", -1).limit(1)
-    first = next(firstc)
-    last = next(lastc)
-    tfirst = first["ts"]
-    tlast = last["ts"]
-    delta = tlast.time - tfirst.time
-    return delta
+    window = get_oplog_window(con)
+    if window is None:
+        return 0
+    return window['last'].time - window['first'].time
 
 #
 # main app
@@ -8,8 +8,12 @@
 # https://exchange.icinga.com/barbarossatm/check_conntrack_size - https://raw.githubusercontent.com/BarbarossaTM/icinga2-plugins/refs/heads/main/check_conntrack_size/check_conntrack_size
 
 import argparse
+import array
+import json
 import os.path
 import sys
+import tempfile
+import time
 
 code = 0
 msg = ""
@@ -19,9 +23,44 @@ parser = argparse.ArgumentParser (description = 'check netfilter conntrack table
 parser.add_argument ('--warn', '-w', help = "Warning conntrack table usage (percent)", default = "70", type = int)
 parser.add_argument ('--crit', '-c', help = "Critical conntrack table usage (percent)", default = "85", type = int)
 parser.add_argument ('--no-conntrack', help = "Return code when no conntrack is loaded.", default = "ok", choices = [ "ok", "warn", "crit", "unkn" ])
+parser.add_argument ('--state-file', help = "Count of the previous run, for the growth rate and time to full (empty to disable, default /var/tmp/check_conntrack_size.json, or /var/tmp/check_conntrack_size.cpustats.json with --cpu-stats)", default = None)
+parser.add_argument ('--max-age', help = "Ignore a previous count older than this many seconds", default = 3600, type = int)
+parser.add_argument ('--ttf-warn', help = "Warning if the table is predicted to be full within this many minutes", default = None, type = float)
+parser.add_argument ('--ttf-crit', help = "Critical if the table is predicted to be full within this many minutes", default = None, type = float)
+parser.add_argument ('--breakdown', help = "Read the conntrack table and break it down by protocol, state, zone and source", action = "store_true")
+parser.add_argument ('--top', help = "Number of top sources shown with --breakdown", default = 5, type = int)
+parser.add_argument ('--conntrack-file', help = "Conntrack table read with --breakdown", default = "/proc/net/nf_conntrack")
+parser.add_argument ('--cpu-stats', help = "Report the per second rates of the per-CPU conntrack statistics (needs --state-file)", action = "store_true")
+parser.add_argument ('--stat-file', help = "Per-CPU conntrack statistics read with --cpu-stats", default = "/proc/net/stat/nf_conntrack")
+parser.add_argument ('--stat-warn', help = "Warning if a statistic exceeds RATE per second, eg. drop=1 (may be repeated)", action = "append", default = [], metavar = "COLUMN=RATE")
+parser.add_argument ('--stat-crit', help = "Critical if a statistic exceeds RATE per second, eg. drop=10 (may be repeated)", action = "append", default = [], metavar = "COLUMN=RATE")
 
 args = parser.parse_args ()
 
+# Statistics reported with --cpu-stats, and their default thresholds (per second)
+STAT_COLUMNS = [ 'insert_failed', 'drop', 'early_drop', 'search_restart' ]
+stat_warn = { 'insert_failed' : 1.0, 'drop' : 1.0 }
+stat_crit = { 'insert_failed' : 10.0, 'drop' : 10.0 }
+
+for thresholds, values in ((stat_warn, args.stat_warn), (stat_crit, args.stat_crit)):
+	for value in values:
+		try:
+			column, rate = value.split ('=', 1)
+			rate = float (rate)
+		except ValueError:
+			parser.error ("threshold %s: expected COLUMN=RATE" % value)
+		if column not in STAT_COLUMNS:
+			parser.error ("threshold %s: COLUMN must be one of %s" % (value, ", ".join (STAT_COLUMNS)))
+		thresholds[column] = rate
+
+# Each mode keeps its own state, so services checked at different intervals
+# do not take over each other's baselines
+if args.state_file is None:
+	args.state_file = "/var/tmp/check_conntrack_size.cpustats.json" if args.cpu_stats else "/var/tmp/check_conntrack_size.json"
+
+if args.cpu_stats and not args.state_file:
+	parser.error ("--cpu-stats needs a --state-file for its rates")
+
 ret_map = {
 	'ok' : 0,
 	'warn' : 1,
@@ -39,8 +78,85 @@ def read_int (path):
 		print ("conntrack seems not to be loaded.")
 		sys.exit (ret_map[args.no_conntrack])
 
+def load_state (path):
+	"""Previous run's state, None if missing, unreadable or not in the expected form."""
+	try:
+		with open (path, 'r') as fh:
+			state = json.load (fh)
+	except (IOError, ValueError):
+		return None
+	if not isinstance (state, dict):
+		return None
+	if not all (isinstance (state.get (key), (int, float)) for key in ('time', 'count')):
+		return None
+	return state
+
+def save_state (path, state):
+	try:
+		fd, tmp_path = tempfile.mkstemp (dir = os.path.dirname (os.path.abspath (path)), prefix = ".check_conntrack_size.")
+		with os.fdopen (fd, 'w') as fh:
+			json.dump (state, fh)
+		os.rename (tmp_path, path)
+	except (IOError, OSError):
+		pass
+
+def prune (counter, size):
+	"""Keep the size largest counts, so the source counter stays bounded during a flood."""
+	for key in sorted (counter, key = counter.get)[:len (counter) - size]:
+		del counter[key]
+
+def read_conntrack_table (path, top):
+	"""Stream the conntrack table once, counting entries by protocol/state, zone and source.
+
+	Only counters are kept in memory. Source counts are pruned to the most
+	frequent ones, so they are exact for heavy hitters and approximate for
+	sources that were pruned along the way.
+	"""
+	by_proto = {}
+	by_zone = {}
+	by_src = {}
+	src_limit = max (1000, top * 100)
+	with open (path, 'r') as fh:
+		for line in fh:
+			# ipv4 2 tcp 6 431999 ESTABLISHED src=10.0.0.1 dst=10.0.0.2 sport=... [ASSURED] mark=0 zone=1 use=2
+			fields = line.split (None, 7)
+			if len (fields) < 7:
+				continue
+			if '=' in fields[5]:
+				key = fields[2]
+				src = fields[5]
+			else:
+				key = fields[2] + '/' + fields[5]
+				src = fields[6]
+			by_proto[key] = by_proto.get (key, 0) + 1
+			by_src[src] = by_src.get (src, 0) + 1
+			if len (by_src) > src_limit * 2:
+				prune (by_src, src_limit)
+			zone = '0'
+			pos = line.find (' zone=')
+			if pos >= 0:
+				zone = line[pos + 6:].split (None, 1)[0]
+			by_zone[zone] = by_zone.get (zone, 0) + 1
+	top_src = sorted (by_src.items (), key = lambda item: -item[1])[:top]
+	return by_proto, by_zone, [(src[4:], count) for src, count in top_src]
+
+def read_conntrack_stats (path):
+	"""Read the per-CPU statistics into one array per column, indexed by CPU.
+
+	The file has a header line with the column names and one line of hex
+	values per possible CPU.
+	"""
+	with open (path, 'r') as fh:
+		names = fh.readline ().split ()
+		columns = dict ((name, array.array ('L')) for name in names)
+		for line in fh:
+			for name, value in zip (names, line.split ()):
+				columns[name].append (int (value, 16))
+	return columns
+
 num_entries = read_int ("/proc/sys/net/netfilter/nf_conntrack_count")
 max_entries = read_int ("/proc/sys/net/netfilter/nf_conntrack_max")
+now = time.time ()
 
 usage = num_entries / max_entries * 100
 
@@ -50,6 +166,60 @@ crit_entries = int (max_entries / 100 * args.crit)
 
 perf_string = "'count'=%d;%d;%d" % (num_entries, warn_entries, crit_entries)
 
+# Growth rate since the previous run and the predicted time until the table is full
+growth = None
+ttf = None
+stats = None
+stat_rates = None
+if args.cpu_stats:
+	try:
+		stats = read_conntrack_stats (args.stat_file)
+	except IOError:
+		print ("Cannot read %s" % args.stat_file)
+		sys.exit (3)
+if args.state_file:
+	state = load_state (args.state_file)
+	new_state = { 'time' : now, 'count' : num_entries }
+	if stats is not None:
+		new_state['stats'] = dict ((name, stats[name].tolist ()) for name in STAT_COLUMNS if name in stats)
+	if state and 0 < now - state['time'] <= args.max_age:
+		interval = now - state['time']
+		growth = (num_entries - state['count']) / interval
+		if growth > 0:
+			ttf = (max_entries - num_entries) / growth / 60
+		if 'stats' in new_state and isinstance (state.get ('stats'), dict):
+			# per column rates summed over the CPUs, and the rate of the busiest CPU
+			stat_rates = {}
+			for name, values in new_state['stats'].items ():
+				previous = state['stats'].get (name)
+				if previous is None or len (previous) != len (values):
+					continue
+				deltas = [ max (now_value - then_value, 0) for now_value, then_value in zip (values, previous) ]
+				busiest = max (range (len (deltas)), key = deltas.__getitem__)
+				stat_rates[name] = (sum (deltas) / interval, busiest, deltas[busiest] / interval)
+	save_state (args.state_file, new_state)
+
+if growth is not None:
+	perf_string += " 'growth'=%.2f" % growth
+if ttf is not None:
+	perf_string += " 'time_to_full'=%.1fmin;%s;%s;0" % (ttf, '' if args.ttf_warn is None else '%s:' % args.ttf_warn, '' if args.ttf_crit is None else '%s:' % args.ttf_crit)
+
+breakdown = ""
+if args.breakdown:
+	try:
+		by_proto, by_zone, top_src = read_conntrack_table (args.conntrack_file, args.top)
+	except IOError:
+		print ("Cannot read %s" % args.conntrack_file)
+		sys.exit (3)
+	if by_proto:
+		breakdown = "; " + ", ".join ("%s=%d" % item for item in sorted (by_proto.items (), key = lambda item: -item[1]))
+	if len (by_zone) > 1:
+		breakdown += "; zones " + ", ".join ("%s=%d" % item for item in sorted (by_zone.items (), key = lambda item: -item[1]))
+	if top_src:
+		breakdown += "; top sources " + ", ".join ("%s=%d" % item for item in top_src)
+	for key, count in sorted (by_proto.items ()):
+		perf_string += " '%s'=%d" % (key, count)
+
 
 if usage >= args.crit:
 	code = 2
@@ -67,5 +237,40 @@ else:
 	code = 3
 	msg = "WTF? Please examine the situation manually and kindly do the needful!"
 
+if ttf is not None:
+	if args.ttf_crit is not None and ttf <= args.ttf_crit:
+		code = max (code, 2)
+		msg += ", full in %.0f min (< %s) at %.1f/s" % (ttf, args.ttf_crit, growth)
+	elif args.ttf_warn is not None and ttf <= args.ttf_warn:
+		code = max (code, 1)
+		msg += ", full in %.0f min (< %s) at %.1f/s" % (ttf, args.ttf_warn, growth)
+	else:
+		msg += ", full in %.0f min at %.1f/s" % (ttf, growth)
+elif growth is not None:
+	msg += ", growth %.1f/s" % growth
+
+if args.cpu_stats and stat_rates is None:
+	msg += ", no previous statistics yet"
+elif stat_rates:
+	stat_msgs = []
+	for name in STAT_COLUMNS:
+		if name not in stat_rates:
+			continue
+		rate, busiest, busiest_rate = stat_rates[name]
+		text = "%s=%.2f/s" % (name, rate)
+		if rate > 0:
+			text += " (cpu%d %.2f/s)" % (busiest, busiest_rate)
+		if name in stat_crit and rate > stat_crit[name]:
+			code = max (code, 2)
+			text += " > %s" % stat_crit[name]
+		elif name in stat_warn and rate > stat_warn[name]:
+			code = max (code, 1)
+			text += " > %s" % stat_warn[name]
+		stat_msgs.append (text)
+		perf_string += " '%s'=%.2f;%s;%s;0" % (name, rate, stat_warn.get (name, ''), stat_crit.get (name, ''))
+	msg += "; " + ", ".join (stat_msgs)
+
+msg += breakdown
+
 print ("%s | %s" % (msg, perf_string))
 sys.exit (code)
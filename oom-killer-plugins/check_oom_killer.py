@@ -5,9 +5,13 @@ import sys
 sys.dont_write_bytecode = True
 
 import argparse
+import errno
+import fnmatch
+import json
 import os
-import subprocess
 import re
+import tempfile
+import time
 from munch import munchify, Munch
 
 config = {}
@@ -36,6 +40,29 @@ parser.add_argument('--verbose', action='store_true', dest="verbose",
                     help='Show verbose output from demsg about OOM Killer events')
 parser.add_argument('--exclude', action='store', dest="exclude", required=False, type=str,
                     help='Exclude process')
+parser.add_argument('--state-file', action='store', dest="state_file", required=False, type=str,
+                    default='/var/tmp/check_oom_killer.json',
+                    help='Kernel log cursor and rolling OOM event log')
+parser.add_argument('--retention', action='store', dest="retention", required=False, type=int, default=604800,
+                    help='Seconds OOM events are kept in the event log')
+parser.add_argument('--max-events', action='store', dest="max_events", required=False, type=int, default=1000,
+                    help='Maximum number of OOM events kept in the event log')
+parser.add_argument('--all-boots', action='store_true', dest="all_boots",
+                    help='Count the OOM events of earlier boots still in the event log too, '
+                         'not only those since the last boot')
+parser.add_argument('--cgroup', action='store', dest="cgroup", required=False, type=str,
+                    help='Count OOM kills from the cgroup v2 memory.events of this subtree (eg. / or machine.slice) '
+                         'instead of the kernel log')
+parser.add_argument('--cgroup-root', action='store', dest="cgroup_root", required=False, type=str,
+                    default='/sys/fs/cgroup', help='cgroup v2 mount point')
+parser.add_argument('--cgroup-depth', action='store', dest="cgroup_depth", required=False, type=int, default=0,
+                    help='How deep to walk below --cgroup, 0 for no limit')
+parser.add_argument('--cgroup-state-file', action='store', dest="cgroup_state_file", required=False, type=str,
+                    default='/var/tmp/check_oom_killer-cgroups.json',
+                    help='memory.events counters of the previous run')
+parser.add_argument('--cgroup-threshold', action='append', dest="cgroup_thresholds", required=False, type=str,
+                    default=[], metavar='PATTERN:WARNING:CRITICAL',
+                    help='Warning and critical OOM kills for the cgroups matching the glob PATTERN, may be repeated')
 
 args = parser.parse_args()
 # args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
@@ -50,9 +77,27 @@ config['level']['critical'] = args.level_critical
 config['check'] = {}
 config['check']['short'] = args.short_check
 config['check']['verbose'] = args.verbose
+config['check']['all_boots'] = args.all_boots
 
 config['oom_killer']={}
-config['oom_killer']['check_command'] = "LC_ALL=C /bin/dmesg --ctime | /usr/bin/awk '/invoked oom-killer:/ || /Killed process/'"
+config['oom_killer']['kmsg'] = '/dev/kmsg'
+config['oom_killer']['state_file'] = args.state_file
+config['oom_killer']['retention'] = args.retention
+config['oom_killer']['max_events'] = args.max_events
+config['oom_killer']['short_period'] = 86400
+
+config['cgroup'] = {}
+config['cgroup']['subtree'] = args.cgroup
+config['cgroup']['root'] = args.cgroup_root
+config['cgroup']['depth'] = args.cgroup_depth
+config['cgroup']['state_file'] = args.cgroup_state_file
+config['cgroup']['thresholds'] = []
+for threshold in args.cgroup_thresholds:
+    try:
+        pattern, warning, critical = threshold.rsplit(':', 2)
+        config['cgroup']['thresholds'].append({'pattern': pattern, 'warning': int(warning), 'critical': int(critical)})
+    except ValueError:
+        parser.error(f"--cgroup-threshold {threshold}: expected PATTERN:WARNING:CRITICAL")
 
 config['exclude'] = []
 if args.exclude:
@@ -62,17 +107,54 @@ if args.exclude:
 config = munchify(config)
 
 oom_killer_exluded_logs_count = len(config.exclude)
-if oom_killer_exluded_logs_count > 0:
-    config['oom_killer']['check_command'] += " | grep -Evw '"
-    for exclude in config.exclude:
-        config['oom_killer']['check_command'] += exclude
-        config['oom_killer']['check_command'] += "|"
 
-    config['oom_killer']['check_command'] += "'"
+# Kernel messages of an OOM kill, see mm/oom_kill.c
+OOM_INVOKED_RE = re.compile(r'^(?P<invoker>.+?) invoked oom-killer: ')
+OOM_KILL_RE = re.compile(r'^oom-kill:(?P<fields>\S+)')
+OOM_KILLED_RE = re.compile(r'Killed process (?P<pid>\d+) \((?P<victim>.*?)\)(?P<rest>.*)$')
+OOM_RSS_RE = re.compile(r'(anon|file|shmem)-rss:(\d+)kB')
+
+
+def read_text(path):
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def boot_time():
+    with open('/proc/stat', 'r') as f:
+        for line in f:
+            if line.startswith('btime '):
+                return int(line.split()[1])
+    return time.time() - float(read_text('/proc/uptime').split()[0])
+
 
-# execute commands
-def execute_cmd(cmd_query):
-    return subprocess.Popen(cmd_query, stdout=subprocess.PIPE, shell=True).stdout.read().strip().decode('utf8')
+def parse_kmsg_record(record):
+    """Split a /dev/kmsg record "prio,seq,usec,flags;message" into (seq, usec, message)."""
+    header, _, text = record.decode('utf8', 'replace').partition(';')
+    fields = header.split(',')
+    # continuation lines (" SUBSYSTEM=...") carry no message text
+    return int(fields[1]), int(fields[2]), text.split('\n', 1)[0]
+
+
+def load_json(filename, default):
+    try:
+        with open(filename, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def save_json(filename, contents):
+    try:
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), prefix='.check_oom_killer.')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(contents, f)
+        os.rename(tmp_file, filename)
+    except OSError:
+        pass
 
 
 class OOMKillerMonitor:
@@ -80,32 +162,116 @@ class OOMKillerMonitor:
         self.config = config
         self.oom_killer_logs_count = self.check_oom_killer()
 
-    def check_dmesg(self):
-        return execute_cmd(cmd_query="dmesg > /dev/null; echo $?")
+    def read_kmsg(self, cursor):
+        """Yield (seq, usec, message) for the kernel log records after sequence number cursor.
 
-    def check_oom_killer(self):
-        if self.check_dmesg() == "0":
-            self.dmesg_logs = execute_cmd(cmd_query=self.config.oom_killer.check_command)
-            dmesg_logs_list = str.split(self.dmesg_logs, '\n')
-            self.dmesg_logs_full_list = dmesg_logs_list
-            counter = 0
-
-            while '' in dmesg_logs_list:
-                dmesg_logs_list.remove('')
-
-            if (self.config.check.short):
-                for line in dmesg_logs_list:
-                    last_error = float(re.sub(r'[\[\]]', '', line.split()[0]))
-                    with open('/proc/uptime', 'r') as f:
-                        uptime_seconds = float(f.readline().split()[0])
-                    if (uptime_seconds - last_error <= 86400):
-                        counter += 1
+        /dev/kmsg returns one record per read and EAGAIN at the end when opened
+        non-blocking, so no dmesg or shell is needed. EPIPE means the record
+        about to be read was overwritten; reading on continues with the oldest
+        record still in the ring buffer.
+        """
+        fd = os.open(self.config.oom_killer.kmsg, os.O_RDONLY | os.O_NONBLOCK)
+        try:
+            while True:
+                try:
+                    record = os.read(fd, 8192)
+                except OSError as e:
+                    if e.errno == errno.EPIPE:
+                        continue
+                    if e.errno == errno.EAGAIN:
+                        break
+                    raise
+                if not record:
+                    break
+                seq, usec, message = parse_kmsg_record(record)
+                if seq > cursor:
+                    yield seq, usec, message
+        finally:
+            os.close(fd)
+
+    def parse_oom_events(self, records, btime):
+        """Collect OOM kill events from kernel log records.
+
+        An event starts at "... invoked oom-killer:" and ends at "Killed process ...".
+        Returns (events, seq of the last complete record); a partly logged event
+        is read again by the next run.
+        """
+        events = []
+        pending = None
+        last_seq = None
+        for seq, usec, message in records:
+            invoked = OOM_INVOKED_RE.match(message)
+            if invoked:
+                pending = {'seq': seq, 'invoker': invoked.group('invoker')}
+            elif message.startswith('oom-kill:'):
+                if pending is None:
+                    pending = {'seq': seq}
+                fields = dict(f.split('=', 1) for f in OOM_KILL_RE.match(message).group('fields').split(',') if '=' in f)
+                pending['cgroup'] = fields.get('task_memcg')
+                pending['constraint'] = fields.get('constraint')
             else:
-                counter = len(dmesg_logs_list)
-        else:
-            counter = -1
+                killed = OOM_KILLED_RE.search(message)
+                if killed:
+                    event = pending or {'seq': seq}
+                    pending = None
+                    event['time'] = btime + usec / 1000000.0
+                    event['pid'] = int(killed.group('pid'))
+                    event['victim'] = killed.group('victim')
+                    event['rss_kb'] = sum(int(kb) for _, kb in OOM_RSS_RE.findall(killed.group('rest')))
+                    event['message'] = message
+                    events.append(event)
+            if pending is None:
+                last_seq = seq
+        if pending is not None:
+            last_seq = pending['seq'] - 1
+        return events, last_seq
+
+    def is_excluded(self, event):
+        text = ' '.join(str(event.get(key) or '') for key in ('invoker', 'victim', 'cgroup', 'message'))
+        return any(re.search(r'(?<!\w)' + re.escape(word) + r'(?!\w)', text) for word in self.config.exclude)
+
+    def check_oom_killer(self):
+        state_file = self.config.oom_killer.state_file
+        state = load_json(state_file, {})
+        boot_id = read_text('/proc/sys/kernel/random/boot_id')
+        # sequence numbers restart at boot, the event log carries on
+        cursor = state.get('seq', -1) if state.get('boot_id') == boot_id else -1
+        events = state.get('events', [])
+        for event in events:
+            # events saved before they were tagged belong to the boot of the state file
+            event.setdefault('boot_id', state.get('boot_id'))
 
-        return counter
+        try:
+            new_events, last_seq = self.parse_oom_events(self.read_kmsg(cursor), boot_time())
+        except OSError:
+            return -1
+        for event in new_events:
+            event['boot_id'] = boot_id
+
+        now = time.time()
+        events = [e for e in events + new_events if now - e['time'] <= self.config.oom_killer.retention]
+        events = events[-self.config.oom_killer.max_events:]
+        save_json(state_file, {
+            'boot_id': boot_id,
+            'seq': cursor if last_seq is None else last_seq,
+            'events': events,
+        })
+
+        events = [e for e in events if not self.is_excluded(e)]
+        if self.config.check.short:
+            events = [e for e in events if now - e['time'] <= self.config.oom_killer.short_period]
+        # like dmesg, an alert clears with a reboot; older events stay listed with --verbose
+        counted = [e for e in events if self.config.check.all_boots or e['boot_id'] == boot_id]
+        self.dmesg_logs_full_list = [
+            ('' if e['boot_id'] == boot_id else 'earlier boot: ')
+            + f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(e['time']))} "
+            f"killed {e['victim']} (pid {e['pid']}, rss {e['rss_kb']}kB"
+            + (f", cgroup {e['cgroup']}" if e.get('cgroup') else '')
+            + (f", invoked by {e['invoker']}" if e.get('invoker') else '')
+            + ')'
+            for e in events
+        ]
+        return len(counted)
 
     def get_exit_code(self, level):
         exit_code = munchify({
@@ -140,21 +306,21 @@ class OOMKillerMonitor:
             if oom_killer_exluded_logs_count > 0:
                 self.exit_code_stats += f" | There are {oom_killer_exluded_logs_count} excluded OOM Killer logs"
             if self.config.check.verbose:
-                self.exit_code_stats += f"\nLogs:\n{self.dmesg_logs_full_list}"
+                self.exit_code_stats += "\nLogs:\n" + "\n".join(self.dmesg_logs_full_list)
         elif self.oom_killer_logs_count > self.config.level.warning and self.oom_killer_logs_count < self.config.level.critical:
             level = "warning"
             self.exit_code_stats = f"There are {self.oom_killer_logs_count} OOM Killer logs"
             if oom_killer_exluded_logs_count > 0:
                 self.exit_code_stats += f" | There are {oom_killer_exluded_logs_count} excluded OOM Killer logs"
             if self.config.check.verbose:
-                self.exit_code_stats += f"\nLogs:\n{self.dmesg_logs_full_list}"
+                self.exit_code_stats += "\nLogs:\n" + "\n".join(self.dmesg_logs_full_list)
         elif self.oom_killer_logs_count > self.config.level.warning and self.oom_killer_logs_count >= self.config.level.critical:
             level = "critical"
             self.exit_code_stats = f"There are {self.oom_killer_logs_count} OOM Killer logs"
             if oom_killer_exluded_logs_count > 0:
                 self.exit_code_stats += f" | There are {oom_killer_exluded_logs_count} excluded OOM Killer logs"
             if self.config.check.verbose:
-                self.exit_code_stats += f"\nLogs:\n{self.dmesg_logs_full_list}"
+                self.exit_code_stats += "\nLogs:\n" + "\n".join(self.dmesg_logs_full_list)
         else:
             level = "unknown"
             self.exit_code_stats = f"Error! Check failed."
@@ -164,8 +330,125 @@ class OOMKillerMonitor:
         sys.exit(self.get_exit_code(level).code)
 
 
+class CgroupOOMMonitor(OOMKillerMonitor):
+    """Exact OOM accounting from the cgroup v2 memory.events counters.
+
+    Every cgroup below the subtree is compared with its counters from the
+    previous run, and its own thresholds decide its level.
+    """
+
+    def walk_cgroups(self):
+        root = os.path.join(self.config.cgroup.root, self.config.cgroup.subtree.strip('/'))
+        todo = [(root, 0)]
+        while todo:
+            path, depth = todo.pop()
+            yield path
+            if self.config.cgroup.depth and depth >= self.config.cgroup.depth:
+                continue
+            try:
+                with os.scandir(path) as entries:
+                    todo.extend((entry.path, depth + 1) for entry in entries if entry.is_dir(follow_symlinks=False))
+            except OSError:
+                pass
+
+    def read_memory_events(self, path):
+        """Return {'oom': n, 'oom_kill': n} for this cgroup alone, or None.
+
+        memory.events.local leaves out the descendants, so kills are not counted
+        again for every parent; older kernels only have memory.events.
+        """
+        for name in ('memory.events.local', 'memory.events'):
+            text = read_text(os.path.join(path, name))
+            if text is not None:
+                counters = dict(line.split() for line in text.splitlines() if line)
+                return {key: int(counters.get(key, 0)) for key in ('oom', 'oom_kill')}
+        return None
+
+    def cgroup_name(self, path):
+        name = os.path.relpath(path, self.config.cgroup.root)
+        return '/' if name == '.' else '/' + name
+
+    def is_excluded_cgroup(self, name):
+        return any(fnmatch.fnmatch(name, word) or word in name.split('/') for word in self.config.exclude)
+
+    def thresholds(self, name):
+        for threshold in self.config.cgroup.thresholds:
+            if fnmatch.fnmatch(name, threshold.pattern):
+                return threshold.warning, threshold.critical
+        return self.config.level.warning, self.config.level.critical
+
+    def check_oom_killer(self):
+        state = load_json(self.config.cgroup.state_file, {})
+        boot_id = read_text('/proc/sys/kernel/random/boot_id')
+        previous = state.get('cgroups') if state.get('boot_id') == boot_id else None
+
+        counters = {}
+        for path in self.walk_cgroups():
+            events = self.read_memory_events(path)
+            if events is not None:
+                counters[self.cgroup_name(path)] = events
+        if not counters:
+            return -1
+        save_json(self.config.cgroup.state_file, {'boot_id': boot_id, 'cgroups': counters})
+
+        self.oom_events = 0
+        self.excluded = 0
+        self.cgroups = []
+        for name, events in sorted(counters.items()):
+            if previous is None:
+                # first run: the counters are the baseline
+                continue
+            before = previous.get(name, {'oom': 0, 'oom_kill': 0})
+            # a cgroup that was removed and created again starts from zero
+            delta = {key: events[key] - before[key] if events[key] >= before[key] else events[key] for key in events}
+            if not delta['oom_kill'] and not delta['oom']:
+                continue
+            if self.is_excluded_cgroup(name):
+                self.excluded += delta['oom_kill']
+                continue
+            self.oom_events += delta['oom']
+            warning, critical = self.thresholds(name)
+            if delta['oom_kill'] >= critical and delta['oom_kill'] > warning:
+                level = 'critical'
+            elif delta['oom_kill'] > warning:
+                level = 'warning'
+            else:
+                level = 'ok'
+            self.cgroups.append(munchify({'name': name, 'oom': delta['oom'], 'oom_kill': delta['oom_kill'], 'level': level}))
+        return sum(cgroup.oom_kill for cgroup in self.cgroups)
+
+    def monitor_status(self):
+        kills = [c for c in self.cgroups if c.oom_kill] if self.oom_killer_logs_count != -1 else []
+        if self.oom_killer_logs_count == -1:
+            level = "unknown"
+            self.exit_code_stats = f"no memory.events found below {self.config.cgroup.root}/{self.config.cgroup.subtree.strip('/')}"
+        else:
+            levels = [c.level for c in self.cgroups]
+            level = 'critical' if 'critical' in levels else 'warning' if 'warning' in levels else 'ok'
+            if kills:
+                self.exit_code_stats = f"There are {self.oom_killer_logs_count} OOM kills in {len(kills)} cgroups since the last check: " \
+                    + ", ".join(f"{c.name}={c.oom_kill}" for c in kills[:10])
+                if len(kills) > 10:
+                    self.exit_code_stats += ", ..."
+            else:
+                self.exit_code_stats = f"There aren't any OOM kills since the last check"
+            if self.excluded > 0:
+                self.exit_code_stats += f" | There are {self.excluded} excluded OOM kills"
+            if self.config.check.verbose and self.cgroups:
+                self.exit_code_stats += "\nCgroups:\n" + "\n".join(
+                    f"{c.name} oom={c.oom} oom_kill={c.oom_kill} {c.level.upper()}" for c in self.cgroups)
+
+        performance_data = f"oom_kills={max(self.oom_killer_logs_count, 0)}, oom_events={getattr(self, 'oom_events', 0)}, " \
+            f"oom_cgroups={len(kills)}, oom_excluded_kills={getattr(self, 'excluded', 0)}"
+        print(f"{self.get_exit_code(level).description} | {performance_data}")
+        sys.exit(self.get_exit_code(level).code)
+
+
 def main():
-    oom_killer_monitor = OOMKillerMonitor(config)
+    if config.cgroup.subtree:
+        oom_killer_monitor = CgroupOOMMonitor(config)
+    else:
+        oom_killer_monitor = OOMKillerMonitor(config)
 
     oom_killer_monitor.monitor_status()
 
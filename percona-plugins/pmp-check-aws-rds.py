@@ -9,13 +9,22 @@ Copyright 2014-2015 Percona LLC and/or its affiliates
 """
 
 import datetime
+import fcntl
+import json
 import optparse
+import os
 import pprint
 import sys
+import tempfile
+import time
+import urlparse
+from multiprocessing.pool import ThreadPool
+from xml.etree import ElementTree
 
 import boto
 import boto.rds
 import boto.ec2.cloudwatch
+from boto.regioninfo import RegionInfo
 
 # Nagios status codes
 OK = 0
@@ -24,15 +33,100 @@ CRITICAL = 2
 UNKNOWN = 3
 
 
+class CloudWatch(object):
+
+    """Batched CloudWatch collector
+
+    Metric queries for any number of DB instances and periods are queued with
+    add() and fetched by fetch() in GetMetricData requests over a single
+    connection, instead of one GetMetricStatistics call and connection each."""
+
+    # GetMetricData accepts at most 500 queries per request
+    max_queries = 500
+
+    def __init__(self, region, profile=None, endpoint=None):
+        if endpoint:
+            # e.g. a local stub standing in for CloudWatch
+            url = urlparse.urlparse(endpoint)
+            self.conn = boto.ec2.cloudwatch.CloudWatchConnection(
+                region=RegionInfo(name=region, endpoint=url.hostname), port=url.port,
+                is_secure=url.scheme == 'https', profile_name=profile)
+        else:
+            self.conn = boto.ec2.cloudwatch.connect_to_region(region, profile_name=profile)
+        self.queries = []
+
+    def add(self, identifier, metric, period, stat='Average'):
+        """Queue a query, return its id in the fetch() result"""
+        query_id = 'q%d' % len(self.queries)
+        self.queries.append((query_id, identifier, metric, period, stat))
+        return query_id
+
+    def fetch(self, start_time, end_time):
+        """Run all queued queries, return {query id: last point or None}"""
+        results = dict((query[0], None) for query in self.queries)
+        for i in range(0, len(self.queries), self.max_queries):
+            params = {
+                'StartTime': start_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'EndTime': end_time.strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'ScanBy': 'TimestampDescending',
+            }
+            for n, query in enumerate(self.queries[i:i + self.max_queries], 1):
+                query_id, identifier, metric, period, stat = query
+                prefix = 'MetricDataQueries.member.%d.' % n
+                params[prefix + 'Id'] = query_id
+                params[prefix + 'MetricStat.Metric.Namespace'] = 'AWS/RDS'
+                params[prefix + 'MetricStat.Metric.MetricName'] = metric
+                params[prefix + 'MetricStat.Metric.Dimensions.member.1.Name'] = 'DBInstanceIdentifier'
+                params[prefix + 'MetricStat.Metric.Dimensions.member.1.Value'] = identifier
+                params[prefix + 'MetricStat.Period'] = period
+                params[prefix + 'MetricStat.Stat'] = stat
+
+            while True:
+                debug('GetMetricData: %s' % params)
+                response = self.conn.make_request('GetMetricData', params, verb='POST')
+                body = response.read()
+                if response.status != 200:
+                    raise self.conn.ResponseError(response.status, response.reason, body)
+                next_token = self.parse(body, results)
+                if not next_token:
+                    break
+                params['NextToken'] = next_token
+
+        self.queries = []
+        return results
+
+    @staticmethod
+    def parse(body, results):
+        """Store the newest point of each MetricDataResults member, return NextToken"""
+        next_token = None
+        for elem in ElementTree.fromstring(body).iter():
+            tag = elem.tag.split('}')[-1]
+            if tag == 'NextToken':
+                next_token = elem.text
+            elif tag == 'MetricDataResults':
+                for member in elem:
+                    fields = dict((child.tag.split('}')[-1], child) for child in member)
+                    values = fields.get('Values')
+                    query_id = fields['Id'].text
+                    # ScanBy=TimestampDescending: the first value is the last point
+                    if values is not None and len(values) and results.get(query_id) is None:
+                        results[query_id] = float('%.2f' % float(values[0].text))
+        return next_token
+
+
 class RDS(object):
 
     """RDS connection class"""
 
-    def __init__(self, region, profile=None, identifier=None):
+    def __init__(self, region, profile=None, identifier=None, endpoint=None, cache_file=None, cache_ttl=0):
         """Get RDS instance details"""
         self.region = region
         self.profile = profile
         self.identifier = identifier
+        self.endpoint = endpoint
+        self.cloudwatch = None
+        self.cache_file = cache_file
+        self.cache_ttl = cache_ttl
 
         if self.region == 'all':
             self.regions_list = [reg.name for reg in boto.rds.regions()]
@@ -40,58 +134,187 @@ class RDS(object):
             self.regions_list = [self.region]
 
         self.info = None
+        self.cached = False
         if self.identifier:
-            for reg in self.regions_list:
-                try:
-                    rds = boto.rds.connect_to_region(reg, profile_name=self.profile)
-                    self.info = rds.get_all_dbinstances(self.identifier)
-                except (boto.provider.ProfileNotFoundError, boto.exception.BotoServerError) as msg:
-                    debug(msg)
-                else:
-                    # Exit on the first region and identifier match
-                    self.region = reg
-                    break
+            # A fresh cache entry tells the region of the instance, so only
+            # that one region is asked for it
+            entry = self.cache_lookup()
+            if entry:
+                self.region = entry['region']
+                self.cached = True
+            else:
+                self.discover()
+
+    def cache_key(self):
+        return '%s/%s' % (self.profile or '', self.identifier)
+
+    def cache_lookup(self):
+        """Cached region entry of the instance, None when missing or expired"""
+        if not self.cache_file or self.cache_ttl <= 0:
+            return None
+        entry = load_json(self.cache_file).get(self.cache_key())
+        if not entry or not 0 <= time.time() - entry['ts'] <= self.cache_ttl:
+            return None
+        if entry['region'] not in self.regions_list:
+            return None
+        debug('cache hit: %s' % entry)
+        return entry
+
+    def cache_identifiers(self, region):
+        """Identifiers of this profile cached in region, whatever their age"""
+        if not self.cache_file:
+            return []
+        prefix = '%s/' % (self.profile or '')
+        return sorted(key[len(prefix):] for key, entry in load_json(self.cache_file).items()
+                      if key.startswith(prefix) and isinstance(entry, dict) and entry.get('region') == region)
+
+    def cache_store(self, infos):
+        """Save the region of each instance of the given {region: [DBInstance]}
+
+        Only the region is cached: class and storage change on a scale-up and
+        are always read from the live instance."""
+        if not self.cache_file or self.cache_ttl <= 0:
+            return
+        try:
+            lock_file = open(self.cache_file + '.lock', 'a')
+        except IOError as msg:
+            debug('Unable to open %s.lock: %s' % (self.cache_file, msg))
+            return
+        try:
+            # Concurrent checks must not drop each other's entries
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            cache = load_json(self.cache_file)
+            for reg, instances in infos.items():
+                for info in instances or []:
+                    cache['%s/%s' % (self.profile or '', info.id)] = {'region': reg, 'ts': time.time()}
+            save_json(self.cache_file, cache)
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
+
+    def discover(self):
+        """Find the region hosting the instance, probing all regions at once"""
+        found = probe_regions(self.regions_list, self.profile, self.identifier)
+        for reg in self.regions_list:
+            # Keep the first region and identifier match
+            if found.get(reg):
+                self.region = reg
+                self.info = found[reg]
+                self.cache_store({reg: self.info})
+                break
 
     def get_info(self):
         """Get RDS instance info"""
+        if self.info is None and self.cached:
+            # Known region from the cache, ask only that one
+            self.info = probe_regions([self.region], self.profile, self.identifier).get(self.region)
         if self.info:
             return self.info[0]
         else:
             return None
 
-    def get_list(self):
-        """Get list of available instances by region(s)"""
-        result = dict()
-        for reg in self.regions_list:
-            try:
-                rds = boto.rds.connect_to_region(reg, profile_name=self.profile)
-                result[reg] = rds.get_all_dbinstances()
-            except (boto.provider.ProfileNotFoundError, boto.exception.BotoServerError) as msg:
-                debug(msg)
-
+    def get_details(self):
+        """Get instance class and allocated storage of the live instance"""
+        info = self.get_info()
+        if info:
+            return {'region': self.region, 'instance_class': info.instance_class,
+                    'allocated_storage': info.allocated_storage}
+        return None
+
+    def get_list(self, errors=None):
+        """Get list of available instances by region(s)
+
+        Regions that could not be listed are left out, with their error in
+        errors when a dict is given."""
+        result = dict((reg, info) for reg, info in probe_regions(self.regions_list, self.profile,
+                                                                 errors=errors).items()
+                      if info is not None)
+        self.cache_store(result)
         return result
 
+    def get_cloudwatch(self):
+        """CloudWatch collector, created once and reused for every metric"""
+        if self.cloudwatch is None:
+            self.cloudwatch = CloudWatch(self.region, self.profile, self.endpoint)
+        return self.cloudwatch
+
+    def get_metrics(self, queries, start_time, end_time):
+        """Get several RDS metrics from CloudWatch in one batched request
+
+        queries is a list of (metric, period) pairs, the result holds the
+        last point of each of them (or None) in the same order."""
+        cw = self.get_cloudwatch()
+        ids = [cw.add(self.identifier, metric, step) for metric, step in queries]
+        result = cw.fetch(start_time, end_time)
+        return [result[query_id] for query_id in ids]
+
     def get_metric(self, metric, start_time, end_time, step):
         """Get RDS metric from CloudWatch"""
-        cw_conn = boto.ec2.cloudwatch.connect_to_region(self.region, profile_name=self.profile)
-        result = cw_conn.get_metric_statistics(
-            step,
-            start_time,
-            end_time,
-            metric,
-            'AWS/RDS',
-            'Average',
-            dimensions={'DBInstanceIdentifier': [self.identifier]}
-        )
-        if result:
-            if len(result) > 1:
-                # Get the last point
-                result = sorted(result, key=lambda k: k['Timestamp'])
-                result.reverse()
-
-            result = float('%.2f' % result[0]['Average'])
+        return self.get_metrics([(metric, step)], start_time, end_time)[0]
 
-        return result
+
+def probe_regions(regions, profile=None, identifier=None, errors=None):
+    """Run get_all_dbinstances in all regions concurrently, return {region: result or None}
+
+    Without identifier every page of instances is read. The error of each
+    region that failed is stored in errors when a dict is given."""
+    def probe(reg):
+        try:
+            rds = boto.rds.connect_to_region(reg, profile_name=profile)
+            if identifier:
+                return reg, rds.get_all_dbinstances(identifier)
+            # DescribeDBInstances returns at most 100 instances per call
+            instances = []
+            marker = None
+            while True:
+                page = rds.get_all_dbinstances(max_records=100, marker=marker)
+                instances.extend(page)
+                marker = getattr(page, 'marker', None)
+                if not marker:
+                    return reg, instances
+        except (boto.provider.ProfileNotFoundError, boto.exception.BotoServerError) as msg:
+            debug(msg)
+            if errors is not None:
+                # Single line, it ends up in the fleet summary and spool
+                errors[reg] = ' '.join(str(getattr(msg, 'error_message', None) or getattr(msg, 'reason', None)
+                                           or msg).split())
+            return reg, None
+
+    if len(regions) == 1:
+        return dict([probe(regions[0])])
+    pool = ThreadPool(min(len(regions), 16))
+    try:
+        return dict(pool.map(probe, regions))
+    finally:
+        pool.close()
+
+
+def load_json(filename):
+    """Load a JSON dict, empty if the file is missing or broken"""
+    try:
+        with open(filename) as fileObject:
+            data = json.load(fileObject)
+    except (IOError, ValueError):
+        return {}
+    return data if isinstance(data, dict) else {}
+
+
+def save_json(filename, data):
+    """Atomically replace filename with data as JSON"""
+    return save_text(filename, json.dumps(data, separators=(',', ':')))
+
+
+def save_text(filename, text):
+    """Atomically replace filename with text, return False on failure"""
+    try:
+        fd, tmp_name = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(filename) or os.curdir)
+        with os.fdopen(fd, 'w') as fileObject:
+            fileObject.write(text)
+        os.rename(tmp_name, filename)
+    except (IOError, OSError) as msg:
+        debug('Unable to save %s: %s' % (filename, msg))
+        return False
+    return True
 
 
 def debug(val):
@@ -101,59 +324,228 @@ def debug(val):
         print 'DEBUG: %s' % val
 
 
+SHORT_STATUS = {
+    OK: 'OK',
+    WARNING: 'WARN',
+    CRITICAL: 'CRIT',
+    UNKNOWN: 'UNK'
+}
+
+# DB instance classes as listed on
+# http://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/Concepts.DBInstanceClass.html
+DB_CLASSES = {
+    'db.t1.micro': 0.615,
+    'db.m1.small': 1.7,
+    'db.m1.medium': 3.75,
+    'db.m1.large': 7.5,
+    'db.m1.xlarge': 15,
+    'db.m4.large': 8,
+    'db.m4.xlarge': 16,
+    'db.m4.2xlarge': 32,
+    'db.m4.4xlarge': 64,
+    'db.m4.10xlarge': 160,
+    'db.r3.large': 15,
+    'db.r3.xlarge': 30.5,
+    'db.r3.2xlarge': 61,
+    'db.r3.4xlarge': 122,
+    'db.r3.8xlarge': 244,
+    'db.t2.micro': 1,
+    'db.t2.small': 2,
+    'db.t2.medium': 4,
+    'db.t2.large': 8,
+    'db.m3.medium': 3.75,
+    'db.m3.large': 7.5,
+    'db.m3.xlarge': 15,
+    'db.m3.2xlarge': 30,
+    'db.m2.xlarge': 17.1,
+    'db.m2.2xlarge': 34.2,
+    'db.m2.4xlarge': 68.4,
+    'db.cr1.8xlarge': 244,
+}
+
+# RDS metrics http://docs.aws.amazon.com/AmazonCloudWatch/latest/DeveloperGuide/rds-metricscollected.html
+METRICS = {
+    'status': 'RDS availability',
+    'load': 'CPUUtilization',
+    'memory': 'FreeableMemory',
+    'storage': 'FreeStorageSpace'
+}
+
+UNITS = ('percent', 'GB')
+
+# Periods in minutes of the load averages
+LOAD_PERIODS = (1, 5, 15)
+
+# Service descriptions of the fleet mode passive results, as in the
+# CONFIGURATION example below
+SERVICES = {
+    'status': 'RDS Status',
+    'load': 'RDS Load Average',
+    'storage': 'RDS Free Storage',
+    'memory': 'RDS Free Memory'
+}
+
+
+def parse_thresholds(metric, warn, crit):
+    """Parse warning/critical thresholds of a metric, raise ValueError on bad ones
+
+    Returns lists of 3 numbers for "load", numbers for "storage" and "memory"."""
+    if metric == 'load':
+        try:
+            warns = [float(x) for x in warn.split(',')]
+            crits = [float(x) for x in crit.split(',')]
+        except:
+            warns = crits = []
+        if len(warns) + len(crits) != 6:
+            raise ValueError('Warning and critical thresholds should be 3 comma separated numbers, e.g. 20,15,10')
+        if [w for w, c in zip(warns, crits) if w > c]:
+            raise ValueError('Parameter inconsistency: warning threshold is greater than critical.')
+        return warns, crits
+
+    try:
+        warn = float(warn)
+        crit = float(crit)
+    except:
+        raise ValueError('Warning and critical thresholds should be integers.')
+    if crit > warn:
+        raise ValueError('Parameter inconsistency: critical threshold is greater than warning.')
+    return warn, crit
+
+
+def evaluate_status(info):
+    """RDS Status, returns (status, note, perf_data)"""
+    if not info:
+        return UNKNOWN, 'Unable to get RDS instance', None
+    try:
+        version = info.EngineVersion
+    except:
+        version = info.engine_version
+
+    return OK, '%s %s. Status: %s' % (info.engine, version, info.status), None
+
+
+def evaluate_load(loads, warns, crits):
+    """RDS Load Average of the LOAD_PERIODS points, returns (status, note, perf_data)"""
+    if not all(loads):
+        return UNKNOWN, 'Unable to get RDS statistics', None
+
+    status = OK
+    perf_data = []
+    for j, i in enumerate(LOAD_PERIODS):
+        load = loads[j]
+        perf_data.append('load%s=%s;%s;%s;0;100' % (i, load, warns[j], crits[j]))
+
+        # Compare thresholds
+        if status != CRITICAL:
+            if load >= crits[j]:
+                status = CRITICAL
+            elif load >= warns[j]:
+                status = WARNING
+
+    note = 'Load average: %s%%' % '%, '.join(str(load) for load in loads)
+    return status, note, ' '.join(perf_data)
+
+
+def evaluate_free(metric, details, free, warn, crit, unit):
+    """RDS Free Storage / Memory, returns (status, note, perf_data)"""
+    if not details or not free:
+        return UNKNOWN, 'Unable to get RDS details and statistics', None
+
+    if metric == 'storage':
+        storage = float(details['allocated_storage'])
+    elif metric == 'memory':
+        try:
+            storage = DB_CLASSES[details['instance_class']]
+        except:
+            return CRITICAL, 'Unknown DB instance class "%s"' % details['instance_class'], None
+
+    free = '%.2f' % (free / 1024 ** 3)
+    free_pct = '%.2f' % (float(free) / storage * 100)
+    if unit == 'percent':
+        val = float(free_pct)
+        val_max = 100
+    elif unit == 'GB':
+        val = float(free)
+        val_max = storage
+
+    # Compare thresholds
+    status = OK
+    if val <= crit:
+        status = CRITICAL
+    elif val <= warn:
+        status = WARNING
+
+    note = 'Free %s: %s GB (%.0f%%) of %s GB' % (metric, free, float(free_pct), storage)
+    perf_data = 'free_%s=%s;%s;%s;0;%s' % (metric, val, warn, crit, val_max)
+    return status, note, perf_data
+
+
+def format_result(status, note, perf_data, forceunknown=False):
+    """Plugin output line and exit status of a result"""
+    if status != UNKNOWN and perf_data:
+        return status, '%s %s | %s' % (SHORT_STATUS[status], note, perf_data)
+    elif status == UNKNOWN and not forceunknown:
+        return OK, '%s %s | null' % ('OK', note)
+    else:
+        return status, '%s %s' % (SHORT_STATUS[status], note)
+
+
+def run_fleet(rds, thresholds, options):
+    """Evaluate every DB instance in one go, return (passive check result lines, failed regions)
+
+    Instances are listed once, then the metrics of all instances of a region
+    are fetched in batched GetMetricData requests, so the API calls no longer
+    grow with instances x metrics. A region that cannot be listed gets an
+    UNKNOWN status result for each instance the cache knows there."""
+    now = datetime.datetime.utcnow()
+    start_time = now - datetime.timedelta(seconds=max(max(LOAD_PERIODS), options.time) * 60)
+    lines = []
+    failed = {}
+    for reg, instances in sorted(rds.get_list(failed).items()):
+        cw = CloudWatch(reg, options.profile, options.endpoint)
+        queries = []
+        for info in instances:
+            ids = {}
+            if 'load' in thresholds:
+                ids['load'] = [cw.add(info.id, METRICS['load'], i * 60) for i in LOAD_PERIODS]
+            for metric in ('storage', 'memory'):
+                if metric in thresholds:
+                    ids[metric] = cw.add(info.id, METRICS[metric], options.avg * 60)
+            queries.append((info, ids))
+
+        values = cw.fetch(start_time, now) if cw.queries else {}
+
+        for info, ids in queries:
+            details = {'instance_class': info.instance_class, 'allocated_storage': info.allocated_storage}
+            results = [('status', evaluate_status(info))]
+            if 'load' in ids:
+                warns, crits = thresholds['load']
+                results.append(('load', evaluate_load([values.get(i) for i in ids['load']], warns, crits)))
+            for metric in ('storage', 'memory'):
+                if metric in ids:
+                    warn, crit = thresholds[metric]
+                    results.append((metric, evaluate_free(metric, details, values.get(ids[metric]), warn, crit,
+                                                          options.unit)))
+
+            for metric, result in results:
+                status, output = format_result(*result, forceunknown=options.forceunknown)
+                lines.append('[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s' % (
+                    time.time(), info.id, SERVICES[metric], status, output))
+
+    for reg, msg in sorted(failed.items()):
+        for identifier in rds.cache_identifiers(reg):
+            lines.append('[%d] PROCESS_SERVICE_CHECK_RESULT;%s;%s;%d;%s' % (
+                time.time(), identifier, SERVICES['status'], UNKNOWN,
+                'UNK Unable to list DB instances in %s: %s' % (reg, msg)))
+
+    return lines, failed
+
+
+
 def main():
     """Main function"""
     global options
 
-    short_status = {
-        OK: 'OK',
-        WARNING: 'WARN',
-        CRITICAL: 'CRIT',
-        UNKNOWN: 'UNK'
-    }
-
-    # DB instance classes as listed on
-    # http://docs.aws.amazon.com/AmazonRDS/latest/UserGuide/Concepts.DBInstanceClass.html
-    db_classes = {
-        'db.t1.micro': 0.615,
-        'db.m1.small': 1.7,
-        'db.m1.medium': 3.75,
-        'db.m1.large': 7.5,
-        'db.m1.xlarge': 15,
-        'db.m4.large': 8,
-        'db.m4.xlarge': 16,
-        'db.m4.2xlarge': 32,
-        'db.m4.4xlarge': 64,
-        'db.m4.10xlarge': 160,
-        'db.r3.large': 15,
-        'db.r3.xlarge': 30.5,
-        'db.r3.2xlarge': 61,
-        'db.r3.4xlarge': 122,
-        'db.r3.8xlarge': 244,
-        'db.t2.micro': 1,
-        'db.t2.small': 2,
-        'db.t2.medium': 4,
-        'db.t2.large': 8,
-        'db.m3.medium': 3.75,
-        'db.m3.large': 7.5,
-        'db.m3.xlarge': 15,
-        'db.m3.2xlarge': 30,
-        'db.m2.xlarge': 17.1,
-        'db.m2.2xlarge': 34.2,
-        'db.m2.4xlarge': 68.4,
-        'db.cr1.8xlarge': 244,
-    }
-
-    # RDS metrics http://docs.aws.amazon.com/AmazonCloudWatch/latest/DeveloperGuide/rds-metricscollected.html
-    metrics = {
-        'status': 'RDS availability',
-        'load': 'CPUUtilization',
-        'memory': 'FreeableMemory',
-        'storage': 'FreeStorageSpace'
-    }
-
-    units = ('percent', 'GB')
-
     # Parse options
     parser = optparse.OptionParser()
     parser.add_option('-l', '--list', help='list of all DB instances',
@@ -166,11 +558,11 @@ def main():
     parser.add_option('-i', '--ident', help='DB instance identifier')
     parser.add_option('-p', '--print', help='print status and other details for a given DB instance',
                       action='store_true', default=False, dest='printinfo')
-    parser.add_option('-m', '--metric', help='metric to check: [%s]' % ', '.join(metrics.keys()))
+    parser.add_option('-m', '--metric', help='metric to check: [%s]' % ', '.join(METRICS.keys()))
     parser.add_option('-w', '--warn', help='warning threshold')
     parser.add_option('-c', '--crit', help='critical threshold')
     parser.add_option('-u', '--unit', help='unit of thresholds for "storage" and "memory" metrics: [%s].'
-                      'Default: percent' % ', '.join(units), default='percent')
+                      'Default: percent' % ', '.join(UNITS), default='percent')
     parser.add_option('-t', '--time', help='time period in minutes to query. Default: 5',
                       type='int', default=5)
     parser.add_option('-a', '--avg', help='time average in minutes to request. Default: 1',
@@ -178,6 +570,20 @@ def main():
     parser.add_option('-f', '--forceunknown', help='force alerts on unknown status. This prevents issues related to '
                       'AWS Cloudwatch throttling limits Default: False',
                       action='store_true', default=False)
+    parser.add_option('-F', '--fleet', help='evaluate all DB instances of the region(s) and print or spool '
+                      'passive check results for them', action='store_true', default=False)
+    parser.add_option('-T', '--thresholds', action='append', default=[],
+                      help='fleet mode thresholds of a metric as METRIC:WARN:CRIT, e.g. load:90,85,80:98,95,90 or '
+                           'storage:10:5. Repeat for each metric, "status" is always checked')
+    parser.add_option('-s', '--spool', help='fleet mode: write the results to this file instead of stdout')
+    parser.add_option('--cache-file', default='/tmp/pmp-check-aws-rds.cache',
+                      help='file caching the region of each DB instance. '
+                           'Default: /tmp/pmp-check-aws-rds.cache')
+    parser.add_option('--cache-ttl', type='int', default=3600,
+                      help='seconds a cache entry is used instead of probing the regions, 0 disables the cache. '
+                           'Default: 3600')
+    parser.add_option('-e', '--endpoint', help='CloudWatch endpoint URL to use instead of the region default, '
+                      'e.g. http://127.0.0.1:8080 for a local stub')
     parser.add_option('-d', '--debug', help='enable debug output',
                       action='store_true', default=False)
     options, _ = parser.parse_args()
@@ -185,7 +591,8 @@ def main():
     if options.debug:
         boto.set_stream_logger('boto')
 
-    rds = RDS(region=options.region, profile=options.profile, identifier=options.ident)
+    rds = RDS(region=options.region, profile=options.profile, identifier=options.ident, endpoint=options.endpoint,
+              cache_file=options.cache_file, cache_ttl=options.cache_ttl)
 
     # Check args
     if len(sys.argv) == 1:
@@ -196,6 +603,39 @@ def main():
         print 'List of all DB instances in %s region(s):' % (options.region,)
         pprint.pprint(info)
         sys.exit()
+    elif options.fleet:
+        if options.unit not in UNITS:
+            parser.error('Unit is not valid.')
+        thresholds = dict()
+        for spec in options.thresholds:
+            try:
+                metric, warn, crit = spec.split(':')
+                if metric not in ('load', 'storage', 'memory'):
+                    raise ValueError('Metric "%s" has no thresholds.' % metric)
+                thresholds[metric] = parse_thresholds(metric, warn, crit)
+            except ValueError as msg:
+                parser.error('Bad thresholds "%s": %s' % (spec, msg))
+
+        lines, failed = run_fleet(rds, thresholds, options)
+        counts = dict((code, 0) for code in SHORT_STATUS)
+        for line in lines:
+            counts[int(line.split(';')[3])] += 1
+        status = UNKNOWN if failed else OK
+        summary = '%s Fleet: %d results, %s%s | %s' % (
+            SHORT_STATUS[status], len(lines),
+            ', '.join('%d %s' % (counts[code], SHORT_STATUS[code]) for code in sorted(counts)),
+            ''.join('; region %s failed: %s' % (reg, msg) for reg, msg in sorted(failed.items())),
+            ' '.join('%s=%d' % (SHORT_STATUS[code].lower(), counts[code]) for code in sorted(counts)))
+        if options.spool:
+            if not save_text(options.spool, ''.join(line + '\n' for line in lines)):
+                print 'UNK Unable to write spool file %s' % options.spool
+                sys.exit(UNKNOWN)
+            print summary
+        else:
+            # the plugin output comes first, the external command lines follow as long text
+            print summary
+            print '\n'.join(lines)
+        sys.exit(status)
     elif not options.ident:
         parser.print_help()
         parser.error('DB identifier is not set.')
@@ -207,7 +647,7 @@ def main():
             print 'No DB instance "%s" found on your AWS account and %s region(s).' % (options.ident, options.region)
 
         sys.exit()
-    elif not options.metric or options.metric not in metrics.keys():
+    elif not options.metric or options.metric not in METRICS.keys():
         parser.print_help()
         parser.error('Metric is not set or not valid.')
     elif not options.warn and options.metric != 'status':
@@ -224,142 +664,45 @@ def main():
         parser.error('Time must be greater than zero.')
 
     now = datetime.datetime.utcnow()
-    status = None
-    note = ''
-    perf_data = None
 
     # RDS Status
     if options.metric == 'status':
-        info = rds.get_info()
-        if not info:
-            status = UNKNOWN
-            note = 'Unable to get RDS instance'
-        else:
-            status = OK
-            try:
-                version = info.EngineVersion
-            except:
-                version = info.engine_version
-
-            note = '%s %s. Status: %s' % (info.engine, version, info.status)
+        status, note, perf_data = evaluate_status(rds.get_info())
 
     # RDS Load Average
     elif options.metric == 'load':
-        # Check thresholds
         try:
-            warns = [float(x) for x in options.warn.split(',')]
-            crits = [float(x) for x in options.crit.split(',')]
-            fail = len(warns) + len(crits)
-        except:
-            fail = 0
-
-        if fail != 6:
-            parser.error('Warning and critical thresholds should be 3 comma separated numbers, e.g. 20,15,10')
-
-        loads = []
-        fail = False
-        j = 0
-        perf_data = []
-        for i in [1, 5, 15]:
-            if i == 1:
-                # Some stats are delaying to update on CloudWatch.
-                # Let's pick a few points for 1-min load avg and get the last point.
-                points = 5
-            else:
-                points = i
-
-            load = rds.get_metric(metrics[options.metric], now - datetime.timedelta(seconds=points * 60), now, i * 60)
-            if not load:
-                status = UNKNOWN
-                note = 'Unable to get RDS statistics'
-                perf_data = None
-                break
-
-            loads.append(str(load))
-            perf_data.append('load%s=%s;%s;%s;0;100' % (i, load, warns[j], crits[j]))
+            warns, crits = parse_thresholds(options.metric, options.warn, options.crit)
+        except ValueError as msg:
+            parser.error(msg)
 
-            # Compare thresholds
-            if not fail:
-                if warns[j] > crits[j]:
-                    parser.error('Parameter inconsistency: warning threshold is greater than critical.')
-                elif load >= crits[j]:
-                    status = CRITICAL
-                    fail = True
-                elif load >= warns[j]:
-                    status = WARNING
-
-            j = j + 1
-
-        if status != UNKNOWN:
-            if status is None:
-                status = OK
-
-            note = 'Load average: %s%%' % '%, '.join(loads)
-            perf_data = ' '.join(perf_data)
+        # All three averages come from one batched request. Some stats are delaying to
+        # update on CloudWatch, the window covers a few points for 1-min load avg and
+        # we get the last point of each.
+        loads = rds.get_metrics([(METRICS[options.metric], i * 60) for i in LOAD_PERIODS],
+                                now - datetime.timedelta(seconds=max(LOAD_PERIODS) * 60), now)
+        status, note, perf_data = evaluate_load(loads, warns, crits)
 
     # RDS Free Storage
     # RDS Free Memory
     elif options.metric in ['storage', 'memory']:
-        # Check thresholds
         try:
-            warn = float(options.warn)
-            crit = float(options.crit)
-        except:
-            parser.error('Warning and critical thresholds should be integers.')
-
-        if crit > warn:
-            parser.error('Parameter inconsistency: critical threshold is greater than warning.')
+            warn, crit = parse_thresholds(options.metric, options.warn, options.crit)
+        except ValueError as msg:
+            parser.error(msg)
 
-        if options.unit not in units:
+        if options.unit not in UNITS:
             parser.print_help()
             parser.error('Unit is not valid.')
 
-        info = rds.get_info()
-        free = rds.get_metric(metrics[options.metric], now - datetime.timedelta(seconds=options.time * 60),
+        details = rds.get_details()
+        free = rds.get_metric(METRICS[options.metric], now - datetime.timedelta(seconds=options.time * 60),
                               now, options.avg * 60)
-        if not info or not free:
-            status = UNKNOWN
-            note = 'Unable to get RDS details and statistics'
-        else:
-            if options.metric == 'storage':
-                storage = float(info.allocated_storage)
-            elif options.metric == 'memory':
-                try:
-                    storage = db_classes[info.instance_class]
-                except:
-                    print 'Unknown DB instance class "%s"' % info.instance_class
-                    sys.exit(CRITICAL)
-
-            free = '%.2f' % (free / 1024 ** 3)
-            free_pct = '%.2f' % (float(free) / storage * 100)
-            if options.unit == 'percent':
-                val = float(free_pct)
-                val_max = 100
-            elif options.unit == 'GB':
-                val = float(free)
-                val_max = storage
-
-            # Compare thresholds
-            if val <= crit:
-                status = CRITICAL
-            elif val <= warn:
-                status = WARNING
-
-            if status is None:
-                status = OK
-
-            note = 'Free %s: %s GB (%.0f%%) of %s GB' % (options.metric, free, float(free_pct), storage)
-            perf_data = 'free_%s=%s;%s;%s;0;%s' % (options.metric, val, warn, crit, val_max)
+        status, note, perf_data = evaluate_free(options.metric, details, free, warn, crit, options.unit)
 
     # Final output
-    if status != UNKNOWN and perf_data:
-        print '%s %s | %s' % (short_status[status], note, perf_data)
-    elif status == UNKNOWN and not options.forceunknown:
-        print '%s %s | null' % ('OK', note)
-        sys.exit(0)
-    else:
-        print '%s %s' % (short_status[status], note)
-
+    status, output = format_result(status, note, perf_data, options.forceunknown)
+    print output
     sys.exit(status)
 
 
@@ -404,6 +747,24 @@ pmp-check-aws-rds.py - Check Amazon RDS metrics.
     -f, --forceunknown    force alerts on unknown status. This prevents issues
                           related to AWS Cloudwatch throttling limits Default:
                           False
+    -F, --fleet           evaluate all DB instances of the region(s) and print or
+                          spool passive check results for them
+    -T THRESHOLDS, --thresholds=THRESHOLDS
+                          fleet mode thresholds of a metric as METRIC:WARN:CRIT,
+                          e.g. load:90,85,80:98,95,90 or storage:10:5. Repeat
+                          for each metric, "status" is always checked
+    -s SPOOL, --spool=SPOOL
+                          fleet mode: write the results to this file instead of
+                          stdout
+    --cache-file=CACHE_FILE
+                          file caching the region of each DB instance.
+                          Default: /tmp/pmp-check-aws-rds.cache
+    --cache-ttl=CACHE_TTL
+                          seconds a cache entry is used instead of probing the
+                          regions, 0 disables the cache. Default: 3600
+    -e ENDPOINT, --endpoint=ENDPOINT
+                          CloudWatch endpoint URL to use instead of the region
+                          default, e.g. http://127.0.0.1:8080 for a local stub
     -d, --debug           enable debug output
 
 =head1 REQUIREMENTS
@@ -485,6 +846,19 @@ The following command will show the status for the first instance identified as
   # ./pmp-check-aws-rds.py -r all -i blackbox -p
 
 Remember, scanning regions are slower operation than specifying it explicitly.
+All regions are probed concurrently, and the region of every instance found is
+kept in C<--cache-file> for C<--cache-ttl> seconds, so later checks of the same
+instance ask only that region. Instance class and allocated storage are always
+read from the live instance.
+
+To check a whole fleet at once, use the fleet mode. It lists the instances once,
+fetches the metrics of all of them in batched CloudWatch requests and writes one
+PROCESS_SERVICE_CHECK_RESULT external command per instance and metric, with the
+instance identifier as host name and the service descriptions used in the
+configuration below, for a passive check feeder to submit:
+
+  # ./pmp-check-aws-rds.py -r all -F -T load:90,85,80:98,95,90 -T storage:10:5 -T memory:5:2 -s /var/spool/rds.cmd
+  OK Fleet: 1200 results, 1187 OK, 9 WARN, 4 CRIT, 0 UNK | ok=1187 warn=9 crit=4 unk=0
 
 =head1 CONFIGURATION
 
@@ -12,8 +12,10 @@ import sys
 import time
 import optparse
 import os
-import stat
-import pickle
+import math
+import json
+import fcntl
+import tempfile
 import traceback
 import pprint
 
@@ -34,6 +36,23 @@ if pymongo.version >= "1.9":
 else:
     import pymongo.son as son
 
+# Default location of the per-host status snapshots
+STATUS_DIR = '/tmp/pmp-check-mongo_data'
+
+# --read-preference names mapped to pymongo.ReadPreference attributes
+READ_PREFERENCES = {
+    'primary': 'PRIMARY',
+    'primaryPreferred': 'PRIMARY_PREFERRED',
+    'secondary': 'SECONDARY',
+    'secondaryPreferred': 'SECONDARY_PREFERRED',
+    'nearest': 'NEAREST',
+}
+
+# The bulky top level serverStatus sections, none of them is kept in the
+# snapshot (see STATUS_SECTIONS) so they are excluded from the request
+EXCLUDED_STATUS_SECTIONS = ('locks', 'metrics', 'network', 'opLatencies', 'repl', 'storageEngine', 'tcmalloc',
+                            'transactions', 'wiredTiger')
+
 
 # Adding special behavior for optparse
 class OptionParsingError(RuntimeError):
@@ -69,10 +88,17 @@ def parse_options(args):
     p.add_option('-c', '--collection', action='store', dest='collection', default='foo', help='Specify the collection in check_cannary_test')
     p.add_option('-d', '--database', action='store', dest='database', default='tmp', help='Specify the database in check_cannary_test')
     p.add_option('-q', '--query', action='store', dest='query', default='{"_id":1}', help='Specify the query     in check_cannary_test')
-    p.add_option('--statusfile', action='store', dest='status_filename', default='status.dat', help='File to current store state data in for delta checks')
-    p.add_option('--backup-statusfile', action='store', dest='status_filename_backup', default='status_backup.dat',
-                 help='File to previous store state data in for delta checks')
-    p.add_option('--max-stale', action='store', dest='max_stale', type='int', default=60, help='Age of status file to make new checks (seconds)')
+    p.add_option('--probes', action='store', dest='probes', type='int', default=5, help='Number of queries timed by check_cannary_test')
+    p.add_option('--read-preference', action='store', type='choice', dest='read_preference', default='primary',
+                 choices=READ_PREFERENCES.keys(), help='Read preference of the check_cannary_test queries (%s)' % ", ".join(sorted(READ_PREFERENCES.keys())))
+    p.add_option('--canary-history', action='store', dest='canary_history', type='int', default=60,
+                 help='Number of past check_cannary_test runs kept for the trend perfdata')
+    p.add_option('--statusfile', action='store', dest='status_filename', default=None,
+                 help='JSON file holding the current and previous status snapshots for delta checks (default: %s/<host>-<port>.json)' % STATUS_DIR)
+    p.add_option('--backup-statusfile', action='store', dest='status_filename_backup', default=None,
+                 help='Deprecated, the previous snapshot is kept in --statusfile')
+    p.add_option('--max-stale', action='store', dest='max_stale', type='int', default=60, help='Age of the status snapshot to make new checks (seconds)')
+    p.add_option('--profile', action='store_true', dest='profile', default=False, help='Print serverStatus payload size and decode time to stderr')
     # Add options for output stat file
     try:
         result = p.parse_args()
@@ -85,6 +111,12 @@ def parse_options(args):
     return result
 
 
+def percentile(values, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    rank = int(math.ceil(pct / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
 def return_result(result_type, message):
     if result_type == "ok":
         print "OK - " + message
@@ -133,17 +165,20 @@ class NagiosMongoChecks:
         self.collection = 'foo'
         self.database = 'tmp'
         self.query = '{"_id":1}'
-        self.status_filename = 'status.dat'
-        self.status_filename_backup = 'status_backup.dat'
+        self.probes = 5
+        self.read_preference = 'primary'
+        self.canary_history = 60
+        self.status_filename = None
         self.max_stale = 60
+        self.profile = False
 
         for option in vars(args):
             setattr(self, option, getattr(args, option))
 
-        # Fix filepaths to be relative
-        if not self.status_filename.startswith("/") or not self.status_filename.startswith(".."):
-            self.status_filename_backup = "%s/%s" % (os.curdir, self.status_filename_backup)
-            self.status_filename = "%s/%s" % (os.curdir, self.status_filename)
+        # One snapshot file per monitored server, so checks against different
+        # hosts never share or overwrite each other's state
+        if self.status_filename is None:
+            self.status_filename = "%s/%s-%s.json" % (STATUS_DIR, self.host, self.port)
 
         # ammend known intenal values we will need
         self.current_status = {}
@@ -153,77 +188,111 @@ class NagiosMongoChecks:
         self.pyMongoError = None
 
         self.connect()
+        self.refresh_status()
 
-        if self.file_age(self.status_filename) <= self.max_stale:
-            # Save status_file contents status as current_status
-            self.get_last_status(True)
-            # Save status_filename_backup contents as last_status
-            self.get_last_status(False, self.status_filename_backup)
-        else:
+    def refresh_status(self):
+        """Load current_status/last_status from the snapshot store.
+
+        The store is read and, when its current snapshot is older than
+        max_stale, refreshed and rotated under an exclusive lock: concurrent
+        checks against the same host wait for the one process that queries
+        serverStatus and then reuse its snapshot."""
+        status_dir = os.path.dirname(self.status_filename)
+        if status_dir and not os.path.isdir(status_dir):
+            try:
+                os.makedirs(status_dir)
+            except OSError:
+                pass
+        try:
+            lock_file = open(self.status_filename + ".lock", "a")
+        except IOError, e:
+            sys.exit("UNKNOWN - Unable to open lock file %s.lock: %s" % (self.status_filename, e))
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+            store = self.load_store()
+            current = store.get('current')
+            previous = store.get('previous')
+            if current is not None and 0 <= time.time() - current['ts'] <= self.max_stale:
+                self.current_status = current['status']
+                self.last_status = previous['status'] if previous else {}
+                return
             if self.connection is None:
                 raise pymongo.errors.ConnectionFailure(self.pyMongoError or "No connection Found, did connect fail?")
-            # Get fresh current_status from server
+            # Get fresh current_status from server, the old one becomes last_status
             self.current_status = self.sanatize(self.get_server_status())
-	    # user last status_filename contents as last_status
-            self.get_last_status(False, self.status_filename)
-        # Not yet implemented
-        # self.compute_deltas()
-
-        # get last status
-        # check if needs refresh, refresh if needed
-        # set last/current to self.current_status
-        pass
-
-    def get_last_status(self, returnAsCurrent, forceFile=None):
-        # Open file using self.file
+            self.last_status = current['status'] if current else {}
+            self.save_store({'current': {'ts': time.time(), 'status': self.current_status},
+                             'previous': current})
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+            lock_file.close()
+
+    def load_store(self):
+        return self.load_json(self.status_filename, {})
+
+    def load_json(self, filename, default):
         try:
-            file_name = forceFile if forceFile is not None else self.status_filename
-            fileObject = open(file_name, 'r')
-            if returnAsCurrent is None or returnAsCurrent is False:
-                self.last_status = pickle.load(fileObject)
-            else:
-                self.current_status = pickle.load(fileObject)
+            fileObject = open(filename, 'r')
+            try:
+                contents = json.load(fileObject)
+            finally:
+                fileObject.close()
         except Exception:
-                return False
-        return True
+            return default
+        if not isinstance(contents, type(default)):
+            return default
+        return contents
 
     def get_server_status(self):
+        command = [('serverStatus', 1)]
+        command += [(section, 0) for section in EXCLUDED_STATUS_SECTIONS if section not in self.STATUS_SECTIONS]
+        kwargs = {}
+        if self.profile:
+            # Fetch the raw BSON so payload size and decode time can be told apart
+            from bson.codec_options import CodecOptions
+            from bson.raw_bson import RawBSONDocument
+            kwargs['codec_options'] = CodecOptions(document_class=RawBSONDocument)
+        start = time.time()
         try:
-            data = self.connection['admin'].command(pymongo.son_manipulator.SON([('serverStatus', 1)]))
+            data = self.connection['admin'].command(pymongo.son_manipulator.SON(command), **kwargs)
         except:
             try:
-		data = self.connection['admin'].command(son.SON([('serverStatus', 1)]))
-	    except Exception, e:
-		if type(e).__name__ == "OperationFailure":
-		    sys.exit("UNKNOWN - Not authorized!")
-		else:
-		    sys.exit("UNKNOWN - Unable to run serverStatus: %s::%s" % (type(e).__name__, unicode_truncate(e.message, 45)))
+                data = self.connection['admin'].command(son.SON(command), **kwargs)
+            except Exception, e:
+                if type(e).__name__ == "OperationFailure":
+                    sys.exit("UNKNOWN - Not authorized!")
+                else:
+                    sys.exit("UNKNOWN - Unable to run serverStatus: %s::%s" % (type(e).__name__, unicode_truncate(e.message, 45)))
+        if self.profile:
+            import bson
+            fetched = time.time()
+            raw, data = data.raw, bson.BSON(data.raw).decode()
+            sys.stderr.write("profile: serverStatus %d bytes, %d sections, fetch %.2f ms, decode %.2f ms\n" %
+                             (len(raw), len(data), (fetched - start) * 1000, (time.time() - fetched) * 1000))
 
         if self.current_status is None:
             self.current_status = data
 
         return data
 
-    # figure out how to use this one later
-    def rotate_files(self):
-        # 1)this needs to rename  self.status_filename to status_filename_backup
-        # 2) Save current_status to  self.status_filename ( new file )
-        if self.last_status == {}:
-            # Build the last status file for future deltas from current data
-            self.save_file(self.status_filename_backup, self.current_status)
-            # Set the current status file to empty to set the aging clock
-            self.save_file(self.status_filename, {})
-            sys.exit("UNKNOWN - No status data present, please try again in %s seconds" % self.max_stale)
-	else:
-	    self.save_file(self.status_filename_backup, self.last_status)
-	    self.save_file(self.status_filename, self.current_status)
-
-
-    def save_file(self, filename, contents):
+    def save_store(self, store):
+        self.save_json(self.status_filename, store)
+
+    def save_json(self, filename, contents):
+        # Write to a temporary file next to the target and rename it over the
+        # old one, so readers only ever see a complete file
+        try:
+            fd, tmp_name = tempfile.mkstemp(prefix=".", suffix=".tmp", dir=os.path.dirname(filename) or os.curdir)
             try:
-                pickle.dump(contents, open(filename, "wb"))
-            except Exception, e:
-                sys.exit("UNKNOWN - Error saving stat file %s: %s" % (filename, e.message))
+                fileObject = os.fdopen(fd, "w")
+                json.dump(contents, fileObject, separators=(',', ':'))
+                fileObject.close()
+                os.rename(tmp_name, filename)
+            except Exception:
+                os.unlink(tmp_name)
+                raise
+        except Exception, e:
+            sys.exit("UNKNOWN - Error saving stat file %s: %s" % (filename, e))
 
     # TODO - Fill in all check defaults
     def get_default(self, key, level):
@@ -259,16 +328,17 @@ class NagiosMongoChecks:
     #    self.delta_data = deltas
     #    return True
 
-    def file_age(self, filename):
-        try:
-            age = time.time() - os.stat(filename)[stat.ST_CTIME]
-        except OSError:
-            age = 999999
-        return age
+    # serverStatus sections read by the checks, everything else is dropped
+    # before the snapshot is stored
+    STATUS_SECTIONS = ('connections', 'globalLock', 'backgroundFlushing', 'indexCounters')
 
-    # TODO - Add meat to this if needed, here for future planning
     def sanatize(self, status_output):
-        return status_output
+        snapshot = {}
+        for section in self.STATUS_SECTIONS:
+            if section in status_output:
+                snapshot[section] = status_output[section]
+        # Round trip through JSON so a fresh snapshot looks exactly like a stored one
+        return json.loads(json.dumps(snapshot, default=str))
 
     def connect(self):
         start_time = time.time()
@@ -330,6 +400,8 @@ class NagiosMongoChecks:
         critical_level = critical_level or self.get_default('check_lock_pct', 'critical')
         if self.mongo_version >= ('2', '7', '0'):
             return "ok",  "Mongo 3.0 and above do not have lock %"
+        if 'globalLock' not in self.last_status:
+            return "unknown", "No previous status data present, please try again in %s seconds" % self.max_stale
         lockTime = self.current_status['globalLock']['lockTime'] - self.last_status['globalLock']['lockTime']
         totalTime = self.current_status['globalLock']['totalTime'] - self.last_status['globalLock']['totalTime']
         lock_percent = int((lockTime / totalTime) * 100)
@@ -469,19 +541,46 @@ class NagiosMongoChecks:
             return "critcal", "Shards are not balanced by chunk and need review"
 
     def check_cannary_test(self, args, warning_level, critical_level):
-        warning_level = warning_level or self.get_default('check_cannary_test', 'warning')
-        critical_level = critical_level or self.get_default('check_cannary_test', 'critical')
+        warning_level = float(warning_level or self.get_default('check_cannary_test', 'warning'))
+        critical_level = float(critical_level or self.get_default('check_cannary_test', 'critical'))
         # this does not check for a timeout, we assume NRPE or Nagios will alert on that timeout.
         try:
-            start = time.time()
-            self.connection[self.database][self.collection].find_one(self.query)
-            time_range = (time.time() - start).total_seconds
-            message = "Collection %s.%s  query took: %d s" % (self.database, self.collection, time_range)
-            return self.check_levels(time_range, warning_level, critical_level, message)
+            query = json.loads(self.query)
+            read_preference = getattr(pymongo.ReadPreference, READ_PREFERENCES[self.read_preference])
+            collection = self.connection[self.database].get_collection(self.collection, read_preference=read_preference)
+            latencies = []
+            for probe in range(max(self.probes, 1)):
+                start = time.time()
+                collection.find_one(query)
+                latencies.append((time.time() - start) * 1000)
         except Exception, e:
             message = "Collection %s.%s  query FAILED: %s" % (self.database, self.collection, e)
             return "critical", message
 
+        latencies.sort()
+        p50 = percentile(latencies, 50)
+        p95 = percentile(latencies, 95)
+        history = self.update_canary_history(p50, p95, latencies[-1])
+        trend_p95 = sum(entry[2] for entry in history) / len(history)
+
+        message = "Collection %s.%s %d queries (%s) p50 %.2f ms p95 %.2f ms max %.2f ms" % (
+            self.database, self.collection, len(latencies), self.read_preference, p50, p95, latencies[-1])
+        message += " | p50=%.2fms p95=%.2fms;%s;%s max=%.2fms p95_avg=%.2fms" % (
+            p50, p95, warning_level, critical_level, latencies[-1], trend_p95)
+        return self.check_levels(p95, warning_level, critical_level, message)
+
+    def update_canary_history(self, p50, p95, maximum):
+        """Append this run to the on-disk ring buffer of canary results.
+
+        Entries are [timestamp, p50, p95, max], only the newest canary_history
+        are kept. Returns the updated buffer."""
+        filename = "%s.canary-%s-%s.json" % (os.path.splitext(self.status_filename)[0], self.database, self.collection)
+        history = self.load_json(filename, [])
+        history.append([time.time(), p50, p95, maximum])
+        history = history[-max(self.canary_history, 1):]
+        self.save_json(filename, history)
+        return history
+
     def check_repl_lag(self, args, warning_level, critical_level):
         warning_level = warning_level or self.get_default('check_repl_lag', 'warning')
         critical_level = critical_level or self.get_default('check_repl_lag', 'critical')
@@ -563,12 +662,26 @@ pmp-check-mongo.py - MongoDB Nagios check script.
                           Specify the database in check_cannary_test
     -q QUERY, --query=QUERY
                           Specify the query     in check_cannary_test
+    --probes=PROBES       Number of queries timed by check_cannary_test
+    --read-preference=READ_PREFERENCE
+                          Read preference of the check_cannary_test queries
+                          (nearest, primary, primaryPreferred, secondary,
+                          secondaryPreferred)
+    --canary-history=CANARY_HISTORY
+                          Number of past check_cannary_test runs kept for the
+                          trend perfdata
     --statusfile=STATUS_FILENAME
-                          File to current store state data in for delta checks
+                          JSON file holding the current and previous status
+                          snapshots for delta checks (default:
+                          /tmp/pmp-check-mongo_data/<host>-<port>.json)
     --backup-statusfile=STATUS_FILENAME_BACKUP
-                          File to previous store state data in for delta checks
+                          Deprecated, the previous snapshot is kept in
+                          --statusfile
     --max-stale=MAX_STALE
-                          Age of status file to make new checks (seconds)
+                          Age of the status snapshot to make new checks
+                          (seconds)
+    --profile             Print serverStatus payload size and decode time to
+                          stderr
 
 =head1 COPYRIGHT, LICENSE, AND WARRANTY
 
@@ -6,10 +6,18 @@ check_patroni - Nagios/Icinga2 plugin for monitoring a Patroni cluster.
 Queries the Patroni REST API '/cluster' endpoint (any reachable node returns
 the full topology) and evaluates overall cluster health:
 
+  * Several member endpoints can be given; all are queried in parallel and
+    the first valid answer is used, so a slow or dead node does not delay
+    the check. Answers arriving shortly after are cross-checked for a split
+    view (members disagreeing about the leader or the membership).
+
   * Presence of exactly one leader (CRITICAL if none -> no failover target).
   * Split-brain detection (more than one leader / standby_leader).
   * Member states (running / streaming vs. stopped / crashed / starting).
   * Replication lag against WARNING / CRITICAL byte thresholds.
+  * Lag trend: a per-member lag history is kept in a state file, giving the
+    lag velocity (bytes/s) and the time until a falling-behind replica hits
+    the CRITICAL lag, or until a lagging one has caught up.
   * Minimum number of healthy replicas (redundancy).
   * Patroni maintenance/pause mode (autofailover disabled).
 
@@ -22,8 +30,13 @@ import json
 import argparse
 import urllib.request
 import urllib.error
+import os
 import ssl
 import base64
+import tempfile
+import queue
+import threading
+import time
 
 OK, WARNING, CRITICAL, UNKNOWN = 0, 1, 2, 3
 STATUS_TEXT = {OK: "OK", WARNING: "WARNING", CRITICAL: "CRITICAL", UNKNOWN: "UNKNOWN"}
@@ -61,19 +74,29 @@ Examples:
   # HTTPS API with self-signed certificate
   ./check_patroni.py -H 10.0.0.11 -S https -k
 
+  # Ask all members at once, use the fastest answer, compare their views
+  ./check_patroni.py -H 10.0.0.11,10.0.0.12,10.0.0.13
+
 Note: /cluster returns the full topology, so the plugin can be pointed at any
-single node, a VIP, or HAProxy. Pointing it at one fixed node only fails the
-check if that exact node's REST API is unreachable.
+single node, a VIP, or HAProxy. With several endpoints the check only fails
+to read the topology if none of them answers within --timeout; members that
+do not answer or report a different leader are flagged.
 """)
 
-    p.add_argument("-H", "--host", required=True,
-                   help="Patroni node hostname or IP (or VIP/HAProxy).")
+    p.add_argument("-H", "--host", required=True, action="append",
+                   help="Patroni node hostname or IP (or VIP/HAProxy), "
+                        "optionally host:port. Repeat or comma-separate "
+                        "to query several members in parallel.")
     p.add_argument("-p", "--port", type=int, default=8008,
                    help="Patroni REST API port (default: 8008).")
     p.add_argument("-S", "--scheme", choices=["http", "https"], default="http",
                    help="REST API scheme (default: http).")
     p.add_argument("-t", "--timeout", type=float, default=10.0,
                    help="Connection/read timeout in seconds (default: 10).")
+    p.add_argument("--consensus-wait", type=float, default=1.0,
+                   help="With several endpoints, seconds to keep collecting "
+                        "answers after the first one to cross-check the "
+                        "topology (default: 1, 0 = take the first answer).")
 
     p.add_argument("-u", "--user", default=None,
                    help="Username for Patroni REST basic auth (optional).")
@@ -89,6 +112,29 @@ check if that exact node's REST API is unreachable.
                    help="Replication lag CRITICAL threshold in bytes "
                         "(default: 10485760 = 10 MiB).")
 
+    p.add_argument("--state-file", default="/var/tmp/check_patroni.json",
+                   help="File keeping the lag history between runs "
+                        "(default: /var/tmp/check_patroni.json, '' = "
+                        "disable lag trend checks).")
+    p.add_argument("--history", type=int, default=900,
+                   help="Seconds of lag history used for the trend "
+                        "(default: 900).")
+    p.add_argument("--min-span", type=int, default=60,
+                   help="Minimum seconds of history before a trend is "
+                        "reported (default: 60).")
+    p.add_argument("--rate-warning", type=float, default=None,
+                   help="Lag growth WARNING threshold in bytes/s "
+                        "(default: disabled).")
+    p.add_argument("--rate-critical", type=float, default=None,
+                   help="Lag growth CRITICAL threshold in bytes/s "
+                        "(default: disabled).")
+    p.add_argument("--eta-warning", type=int, default=1800,
+                   help="WARNING if a growing lag reaches --lag-critical "
+                        "within this many seconds (default: 1800, 0 = off).")
+    p.add_argument("--eta-critical", type=int, default=600,
+                   help="CRITICAL if a growing lag reaches --lag-critical "
+                        "within this many seconds (default: 600, 0 = off).")
+
     p.add_argument("--min-replicas", type=int, default=0,
                    help="Minimum number of healthy replicas expected. "
                         "Below this -> WARNING (default: 0 = disabled).")
@@ -100,8 +146,33 @@ check if that exact node's REST API is unreachable.
     return p.parse_args()
 
 
-def fetch_cluster(args):
-    url = "%s://%s:%d/cluster" % (args.scheme, args.host, args.port)
+def parse_endpoints(args):
+    """Return the /cluster URLs for all --host values, without duplicates."""
+    urls = []
+    for value in args.host:
+        for item in value.split(","):
+            item = item.strip()
+            if not item:
+                continue
+            host, port = item, args.port
+            if item.startswith("["):
+                # [2001:db8::1]:8008
+                host, _, rest = item[1:].partition("]")
+                if rest.startswith(":"):
+                    port = int(rest[1:])
+            elif item.count(":") == 1:
+                host, port = item.split(":")
+                port = int(port)
+            if ":" in host:
+                host = "[%s]" % host
+            url = "%s://%s:%d/cluster" % (args.scheme, host, port)
+            if url not in urls:
+                urls.append(url)
+    return urls
+
+
+def fetch_one(url, args, ctx):
+    """Fetch one /cluster document. Returns (data, None) or (None, (code, error))."""
     req = urllib.request.Request(url, headers={"Accept": "application/json"})
 
     if args.user is not None and args.password is not None:
@@ -109,24 +180,118 @@ def fetch_cluster(args):
             ("%s:%s" % (args.user, args.password)).encode()).decode()
         req.add_header("Authorization", "Basic %s" % token)
 
-    ctx = None
-    if args.scheme == "https":
-        ctx = ssl.create_default_context()
-        if args.insecure:
-            ctx.check_hostname = False
-            ctx.verify_mode = ssl.CERT_NONE
-
     try:
         with urllib.request.urlopen(req, timeout=args.timeout, context=ctx) as r:
-            return json.loads(r.read().decode("utf-8"))
+            data = json.loads(r.read().decode("utf-8"))
     except urllib.error.HTTPError as e:
         # 503 from Patroni health endpoints can be normal, but /cluster should
         # answer 200; any HTTP error here means we cannot read the topology.
-        finish(CRITICAL, "Patroni API HTTP %d from %s" % (e.code, url))
+        return None, (CRITICAL, "Patroni API HTTP %d from %s" % (e.code, url))
     except urllib.error.URLError as e:
-        finish(CRITICAL, "Cannot reach Patroni API at %s (%s)" % (url, e.reason))
+        return None, (CRITICAL, "Cannot reach Patroni API at %s (%s)" % (url, e.reason))
     except (ValueError, OSError) as e:
-        finish(UNKNOWN, "Invalid response from %s (%s)" % (url, e))
+        return None, (UNKNOWN, "Invalid response from %s (%s)" % (url, e))
+    if not isinstance(data, dict) or not isinstance(data.get("members", []), list):
+        return None, (UNKNOWN, "Invalid response from %s (no member list)" % url)
+    return data, None
+
+
+def fetch_cluster(args):
+    """Query all endpoints in parallel.
+
+    Returns (data, views, errors, elapsed, total): the first valid answer,
+    all (url, data) answers that arrived within --consensus-wait of it, the
+    (url, error) of endpoints that failed or did not answer in time, the
+    seconds until the first answer and the number of endpoints. Exits if no
+    endpoint answers.
+    """
+    urls = parse_endpoints(args)
+
+    ctx = None
+    if args.scheme == "https":
+        ctx = ssl.create_default_context()
+        if args.insecure:
+            ctx.check_hostname = False
+            ctx.verify_mode = ssl.CERT_NONE
+
+    answers = queue.Queue()
+
+    def worker(url):
+        answers.put((url,) + fetch_one(url, args, ctx))
+
+    start = time.monotonic()
+    # Daemon threads: a hung member must not keep the plugin alive once
+    # another one has answered.
+    for url in urls:
+        threading.Thread(target=worker, args=(url,), daemon=True).start()
+
+    deadline = start + args.timeout
+    views, errors = [], []
+    elapsed = None
+    while len(views) + len(errors) < len(urls):
+        if views:
+            deadline = min(deadline, start + elapsed + args.consensus_wait)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            url, data, error = answers.get(timeout=remaining)
+        except queue.Empty:
+            break
+        if error:
+            errors.append((url, error))
+        else:
+            if not views:
+                elapsed = time.monotonic() - start
+            views.append((url, data))
+
+    # Endpoints still pending when the wait ended count as not answering
+    answered = set(url for url, _ in views + errors)
+    waited = time.monotonic() - start
+    for url in urls:
+        if url not in answered:
+            errors.append((url, (CRITICAL, "No answer from Patroni API at %s within %.1fs"
+                                 % (url, waited))))
+
+    if not views:
+        code = max(code for _, (code, _) in errors)
+        if code == UNKNOWN and any(c == CRITICAL for _, (c, _) in errors):
+            code = CRITICAL
+        finish(code, "; ".join(msg for _, (_, msg) in errors))
+    return views[0][1], views, errors, elapsed, len(urls)
+
+
+def endpoint_name(url):
+    return url.split("://", 1)[1].rsplit("/", 1)[0]
+
+
+def compare_views(views):
+    """Cross-check the topology reported by several endpoints.
+
+    Returns (code, problems). Different leaders are a split view (CRITICAL),
+    a different member list is WARNING.
+    """
+    worst, problems = OK, []
+    leader_views, member_views = {}, {}
+    for url, data in views:
+        members = data.get("members", [])
+        leaders = tuple(sorted(m.get("name", "?") for m in members
+                               if (m.get("role") or "").lower() in LEADER_ROLES))
+        names = tuple(sorted(m.get("name", "?") for m in members))
+        leader_views.setdefault(leaders, []).append(endpoint_name(url))
+        member_views.setdefault(names, []).append(endpoint_name(url))
+
+    if len(leader_views) > 1:
+        worst = CRITICAL
+        problems.append("SPLIT VIEW: %s" % ", ".join(
+            "leader=%s via %s" % ("+".join(leaders) or "NONE", ",".join(eps))
+            for leaders, eps in sorted(leader_views.items())))
+    if len(member_views) > 1:
+        worst = max(worst, WARNING)
+        problems.append("inconsistent membership: %s" % ", ".join(
+            "%d members via %s" % (len(names), ",".join(eps))
+            for names, eps in sorted(member_views.items())))
+    return worst, problems
 
 
 def human_bytes(n):
@@ -140,6 +305,94 @@ def human_bytes(n):
         f /= 1024.0
 
 
+def human_duration(seconds):
+    seconds = int(seconds)
+    if seconds < 120:
+        return "%ds" % seconds
+    if seconds < 7200:
+        return "%dm" % (seconds // 60)
+    return "%.1fh" % (seconds / 3600.0)
+
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            state = json.load(f)
+        return state if isinstance(state, dict) else {}
+    except (OSError, ValueError):
+        return {}
+
+
+def save_state(path, state):
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                   prefix=".check_patroni.")
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f, separators=(",", ":"))
+        os.rename(tmp, path)
+    except OSError:
+        pass
+
+
+def lag_velocity(samples):
+    """Least-squares slope in bytes/s of [[time, lag], ...]."""
+    if len(samples) < 2:
+        return None
+    t0 = samples[0][0]
+    xs = [t - t0 for t, _ in samples]
+    ys = [lag for _, lag in samples]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x <= 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+
+
+def valid_sample(sample):
+    return (isinstance(sample, list) and len(sample) == 2
+            and all(isinstance(v, (int, float)) for v in sample))
+
+
+def track_lag(args, data, views, leader, lags):
+    """Add this run's lags to the history and return {member: velocity}.
+
+    The history is keyed by cluster (scope, or the endpoint list) and
+    dropped when the leader changes, since lag is measured against it.
+    Members with less than --min-span of history get no velocity.
+    """
+    if not args.state_file:
+        return {}
+    now = time.time()
+    key = data.get("scope") or ",".join(sorted(url for url, _ in views))
+    state = load_state(args.state_file)
+    cluster = state.get(key)
+    if (not isinstance(cluster, dict) or cluster.get("leader") != leader
+            or not isinstance(cluster.get("members"), dict)):
+        cluster = {"leader": leader, "members": {}}
+
+    history = {}
+    velocities = {}
+    for name, lag in lags.items():
+        samples = [s for s in cluster["members"].get(name) or []
+                   if valid_sample(s) and now - args.history <= s[0] < now]
+        samples.append([now, lag])
+        history[name] = samples
+        if now - samples[0][0] >= args.min_span:
+            velocities[name] = lag_velocity(samples)
+    cluster["members"] = history
+    state[key] = cluster
+    # forget clusters this state file has not seen for a while
+    for other in [k for k in state if k != key]:
+        members = state[other].get("members") if isinstance(state[other], dict) else None
+        stamps = [s[-1][0] for s in members.values()
+                  if isinstance(s, list) and s and valid_sample(s[-1])] if isinstance(members, dict) else []
+        if not stamps or now - max(stamps) > args.history:
+            del state[other]
+    save_state(args.state_file, state)
+    return dict((name, v) for name, v in velocities.items() if v is not None)
+
+
 def finish(code, summary, perfdata=None, detail=None):
     line = "PATRONI %s - %s" % (STATUS_TEXT[code], summary)
     if perfdata:
@@ -155,8 +408,13 @@ def main():
 
     if args.lag_critical < args.lag_warning:
         finish(UNKNOWN, "--lag-critical must be >= --lag-warning")
+    if (args.rate_warning is not None and args.rate_critical is not None
+            and args.rate_critical < args.rate_warning):
+        finish(UNKNOWN, "--rate-critical must be >= --rate-warning")
+    if args.eta_critical > args.eta_warning > 0:
+        finish(UNKNOWN, "--eta-critical must be <= --eta-warning")
 
-    data = fetch_cluster(args)
+    data, views, errors, elapsed, endpoints = fetch_cluster(args)
     members = data.get("members", [])
     if not members:
         finish(CRITICAL, "Cluster reports no members")
@@ -165,6 +423,7 @@ def main():
     worst = OK
     max_lag = 0
     healthy_replicas = 0
+    lags = {}
 
     for m in members:
         role = (m.get("role") or "").lower()
@@ -197,6 +456,7 @@ def main():
         else:
             try:
                 lag = int(lag)
+                lags[name] = lag
                 max_lag = max(max_lag, lag)
                 if lag >= args.lag_critical:
                     worst = max(worst, CRITICAL)
@@ -218,12 +478,62 @@ def main():
                         % (len(leaders), ", ".join(l.get("name", "?")
                                                    for l in leaders)))
 
+    # --- Lag trend ---
+    trend_leader = leaders[0].get("name") if len(leaders) == 1 else None
+    velocities = track_lag(args, data, views, trend_leader, lags) if trend_leader else {}
+    trend_perf = []
+    trend_detail = {}
+    for name in sorted(velocities):
+        rate, lag = velocities[name], lags[name]
+        label = name if all(c.isalnum() or c in "_.-" for c in name) else "'%s'" % name
+        trend_perf.append("%s_lag=%dB;%d;%d;0" % (label, lag, args.lag_warning, args.lag_critical))
+        trend_perf.append("%s_lag_rate=%.1f;%s;%s" % (
+            label, rate, "" if args.rate_warning is None else args.rate_warning,
+            "" if args.rate_critical is None else args.rate_critical))
+        if rate > 0 and lag < args.lag_critical:
+            eta = (args.lag_critical - lag) / rate
+            # lower is worse, the "N:" ranges alert below N
+            trend_perf.append("%s_eta_critical=%ds;%s;%s;0" % (
+                label, eta, "%d:" % args.eta_warning if args.eta_warning > 0 else "",
+                "%d:" % args.eta_critical if args.eta_critical > 0 else ""))
+            trend_detail[name] = "lag +%s/s, critical in %s" % (human_bytes(rate), human_duration(eta))
+            if 0 < args.eta_critical and eta <= args.eta_critical:
+                worst = max(worst, CRITICAL)
+                problems.append("%s lag %s growing %s/s, critical in %s"
+                                % (name, human_bytes(lag), human_bytes(rate), human_duration(eta)))
+                continue
+            if 0 < args.eta_warning and eta <= args.eta_warning:
+                worst = max(worst, WARNING)
+                problems.append("%s lag %s growing %s/s, critical in %s"
+                                % (name, human_bytes(lag), human_bytes(rate), human_duration(eta)))
+                continue
+        elif rate < 0 and lag > 0:
+            eta = lag / -rate
+            trend_perf.append("%s_catchup=%ds;;;0" % (label, eta))
+            trend_detail[name] = "lag -%s/s, caught up in %s" % (human_bytes(-rate), human_duration(eta))
+        if args.rate_critical is not None and rate >= args.rate_critical:
+            worst = max(worst, CRITICAL)
+            problems.append("%s lag growing %s/s" % (name, human_bytes(rate)))
+        elif args.rate_warning is not None and rate >= args.rate_warning:
+            worst = max(worst, WARNING)
+            problems.append("%s lag growing %s/s" % (name, human_bytes(rate)))
+
     # --- Minimum replica redundancy ---
     if args.min_replicas > 0 and healthy_replicas < args.min_replicas:
         worst = max(worst, WARNING)
         problems.append("only %d/%d healthy replicas"
                         % (healthy_replicas, args.min_replicas))
 
+    # --- Agreement between the endpoints that answered ---
+    code, view_problems = compare_views(views)
+    worst = max(worst, code)
+    problems[:0] = view_problems
+    if errors:
+        worst = max(worst, WARNING)
+        problems.append("%d/%d endpoint(s) not answering: %s"
+                        % (len(errors), endpoints,
+                           ", ".join(endpoint_name(url) for url, _ in errors)))
+
     # --- Maintenance / pause mode ---
     if data.get("pause"):
         if not args.pause_ok:
@@ -247,7 +557,9 @@ def main():
         "healthy_replicas=%d" % healthy_replicas,
         "leaders=%d" % len(leaders),
         "max_lag=%dB;%d;%d;0" % (max_lag, args.lag_warning, args.lag_critical),
-    ]
+        "endpoints_ok=%d;;;0;%d" % (len(views), endpoints),
+        "response_time=%.3fs;;;0" % elapsed,
+    ] + trend_perf
 
     detail = None
     if args.verbose:
@@ -259,7 +571,11 @@ def main():
                              m.get("state", "?"),
                              human_bytes(m.get("lag"))
                              if isinstance(m.get("lag"), int)
-                             else m.get("lag", "n/a")))
+                             else m.get("lag", "n/a"))
+                          + ("  (%s)" % trend_detail[m.get("name")]
+                             if m.get("name") in trend_detail else ""))
+        for url, error in errors:
+            detail.append("  endpoint %s: %s" % (endpoint_name(url), error[1]))
 
     finish(worst, summary, perfdata, detail)
 
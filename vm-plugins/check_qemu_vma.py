@@ -11,6 +11,12 @@ Nagios plugin: Auto-discover QEMU VMs on host and check VMA (memory mappings) us
 - Извежда perfdata за графики:
     <vm>_maps=<value>;<warn_abs>;<crit_abs>;0;<max_map_count>
     <vm>_pct=<pct>;<warn_pct>;<crit_pct>;0;100
+    <vm>_growth=<VMA на час>
+    <vm>_hours_to_limit=<часове>;<hours_warn>:;<hours_crit>:;0
+- Пази история на броя VMA за всяка VM (име + старт на QEMU) в --state-file и
+  алармира, ако по наклона за последните --window часа лимитът ще бъде достигнат скоро.
+  Историята се разрежда по време (около една проба на --window/(--max-samples - 1)),
+  така че пробите покриват целия прозорец независимо от интервала на проверката.
 
 Опции за филтриране:
 - --include REGEX : следи само VM имена, които мачват REGEX
@@ -20,13 +26,27 @@ Nagios plugin: Auto-discover QEMU VMs on host and check VMA (memory mappings) us
 """
 
 import argparse
+import json
 import os
 import re
 import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Optional, Tuple
 
 N_OK, N_WARN, N_CRIT, N_UNK = 0, 1, 2, 3
 
+# libvirt слага VM-ите в machine.slice (cgroup v2 и различните v1 йерархии)
+MACHINE_SLICES = (
+    "/sys/fs/cgroup/machine.slice",
+    "/sys/fs/cgroup/systemd/machine.slice",
+    "/sys/fs/cgroup/cpu,cpuacct/machine.slice",
+    "/sys/fs/cgroup/memory/machine.slice",
+)
+MAPS_CHUNK = 1 << 20
+STATE_FILE = "/var/tmp/check_qemu_vma.json"
+
 def read_file(path: str) -> Optional[bytes]:
     try:
         with open(path, "rb") as f:
@@ -71,6 +91,40 @@ def iter_qemu_pids(proc_regex: re.Pattern) -> List[int]:
         pids.append(pid)
     return pids
 
+def iter_cgroup_pids(slice_dir: str, proc_regex: re.Pattern) -> List[int]:
+    """
+    Събира PID-овете от cgroup.procs на всички cgroup-и под slice_dir и
+    оставя само тези, чийто comm мачва proc_regex. Така не се обхожда целият /proc.
+    """
+    found = set()
+    for root, _dirs, files in os.walk(slice_dir):
+        if "cgroup.procs" not in files:
+            continue
+        data = read_file(os.path.join(root, "cgroup.procs"))
+        if data:
+            found.update(int(p) for p in data.split())
+    pids: List[int] = []
+    for pid in sorted(found):
+        comm_b = read_file(f"/proc/{pid}/comm")
+        if comm_b and proc_regex.match(comm_b.decode(errors="ignore").strip()):
+            pids.append(pid)
+    return pids
+
+def discover_qemu_pids(proc_regex: re.Pattern, mode: str, slice_dir: Optional[str]) -> List[int]:
+    """
+    В режим auto /proc се обхожда само ако няма нито един machine.slice;
+    съществуващ slice без QEMU процеси означава, че на хоста няма VM-и.
+    """
+    if mode != "proc":
+        candidates = [slice_dir] if slice_dir else list(MACHINE_SLICES)
+        slices = [d for d in candidates if os.path.isdir(d)]
+        if slices or mode == "cgroup":
+            found = set()
+            for d in slices:
+                found.update(iter_cgroup_pids(d, proc_regex))
+            return sorted(found)
+    return iter_qemu_pids(proc_regex)
+
 def parse_vm_name_from_cmdline(args: List[str]) -> Optional[str]:
     """
     Търси:
@@ -111,15 +165,72 @@ def get_cmdline_args(pid: int) -> List[str]:
     return out
 
 def count_maps(pid: int) -> Optional[int]:
+    # Всеки ред в maps е една VMA: броим \n в големи двоични блокове, без декодиране
     try:
         cnt = 0
-        with open(f"/proc/{pid}/maps", "r", encoding="utf-8", errors="ignore") as f:
-            for _ in f:
-                cnt += 1
+        with open(f"/proc/{pid}/maps", "rb", buffering=0) as f:
+            while True:
+                chunk = f.read(MAPS_CHUNK)
+                if not chunk:
+                    break
+                cnt += chunk.count(b"\n")
         return cnt
     except Exception:
         return None
 
+def read_boot_time() -> float:
+    data = read_file("/proc/stat") or b""
+    for line in data.split(b"\n"):
+        if line.startswith(b"btime "):
+            return float(line.split()[1])
+    return 0.0
+
+def process_start(pid: int, btime: float) -> Optional[int]:
+    # starttime (поле 22 в /proc/<pid>/stat) е в тикове от boot-а; превръщаме го в epoch секунди
+    data = read_file(f"/proc/{pid}/stat")
+    if not data:
+        return None
+    try:
+        fields = data[data.rindex(b")") + 2:].split()
+        return int(btime + int(fields[19]) / os.sysconf("SC_CLK_TCK"))
+    except Exception:
+        return None
+
+def load_state(path: str) -> Dict[str, List[List[float]]]:
+    data = read_file(path)
+    if not data:
+        return {}
+    try:
+        state = json.loads(data.decode())
+        return state if isinstance(state, dict) else {}
+    except Exception:
+        return {}
+
+def save_state(path: str, state: Dict[str, List[List[float]]]) -> None:
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".check_qemu_vma.")
+        with os.fdopen(fd, "w") as f:
+            json.dump(state, f, separators=(",", ":"))
+        os.rename(tmp, path)
+    except Exception:
+        pass
+
+def growth_rate(samples: List[List[float]]) -> Optional[float]:
+    """
+    Наклон по метода на най-малките квадрати (VMA на час) за [[time, maps], ...].
+    """
+    if len(samples) < 2:
+        return None
+    t0 = samples[0][0]
+    xs = [(t - t0) / 3600.0 for t, _ in samples]
+    ys = [m for _, m in samples]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    var_x = sum((x - mean_x) ** 2 for x in xs)
+    if var_x <= 0:
+        return None
+    return sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys)) / var_x
+
 def eval_status(pct: float, warn: float, crit: float) -> int:
     if pct >= crit:
         return N_CRIT
@@ -145,12 +256,26 @@ def main():
     ap.add_argument("--include", help="Regex to include only VM names matching this pattern.")
     ap.add_argument("--exclude", help="Regex to exclude VM names matching this pattern.")
     ap.add_argument("--ok-if-none", action="store_true", help="Return OK if no QEMU processes found (default: UNKNOWN).")
+    ap.add_argument("--discovery", choices=["auto", "cgroup", "proc"], default="auto",
+                    help="Find QEMU processes in the machine.slice cgroup, by walking /proc, or in the cgroup with /proc used only when no machine.slice exists (default: auto).")
+    ap.add_argument("--cgroup-dir", help="machine.slice cgroup directory (default: the first existing one of the cgroup v2/v1 mounts).")
+    ap.add_argument("--workers", type=int, default=8, help="Number of VMs scanned in parallel (default 8).")
+    ap.add_argument("--state-file", default=STATE_FILE, help=f"Per-VM map count history, empty to disable trends (default {STATE_FILE}).")
+    ap.add_argument("--window", type=float, default=6.0, help="Hours of history used for the growth rate (default 6).")
+    ap.add_argument("--min-span", type=float, default=1.0, help="Minimum hours of history before forecasting (default 1).")
+    ap.add_argument("--max-samples", type=int, default=60, help="Maximum samples kept per VM, spread over --window (default 60).")
+    ap.add_argument("--hours-warn", type=float, default=24.0, help="Warning if the limit is projected to be reached within this many hours, 0 to disable (default 24).")
+    ap.add_argument("--hours-crit", type=float, default=6.0, help="Critical if the limit is projected to be reached within this many hours, 0 to disable (default 6).")
     args = ap.parse_args()
 
     if args.warn >= args.crit:
         print("UNKNOWN - --warn must be less than --crit")
         sys.exit(N_UNK)
 
+    if args.max_samples < 2 or args.min_span >= args.window:
+        print("UNKNOWN - --max-samples must be at least 2 and --min-span less than --window")
+        sys.exit(N_UNK)
+
     try:
         proc_re = re.compile(args.proc_regex)
     except re.error as e:
@@ -173,7 +298,7 @@ def main():
         print("UNKNOWN - invalid vm.max_map_count")
         sys.exit(N_UNK)
 
-    pids = iter_qemu_pids(proc_re)
+    pids = discover_qemu_pids(proc_re, args.discovery, args.cgroup_dir)
     if not pids:
         msg = "No QEMU processes found"
         if args.ok_if_none:
@@ -184,8 +309,11 @@ def main():
             sys.exit(N_UNK)
 
     results: List[Tuple[str, int, float, int]] = []  # (name, maps, pct, pid)
+    starts: Dict[int, Optional[int]] = {}
     unknowns: List[str] = []
 
+    # имената се четат първо, за да не се брои maps на изключени VM-и
+    selected: List[Tuple[int, str]] = []
     for pid in pids:
         args_list = get_cmdline_args(pid)
         vm_name = parse_vm_name_from_cmdline(args_list)
@@ -197,8 +325,15 @@ def main():
             continue
         if exc_re and exc_re.search(vm_name):
             continue
+        selected.append((pid, vm_name))
+    btime = read_boot_time()
+    for pid, _ in selected:
+        starts[pid] = process_start(pid, btime)
 
-        maps = count_maps(pid)
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        counts = list(pool.map(count_maps, [pid for pid, _ in selected]))
+
+    for (pid, vm_name), maps in zip(selected, counts):
         if maps is None:
             unknowns.append(f"{vm_name}=NO_MAPS")
             continue
@@ -222,10 +357,50 @@ def main():
     warn_abs = int(max_map * (args.warn / 100.0))
     crit_abs = int(max_map * (args.crit / 100.0))
 
+    # История по VM, ключ <име>@<старт на QEMU>, за да не се смесват рестартирани VM-и
+    now = time.time()
+    state = load_state(args.state_file) if args.state_file else {}
+    new_state: Dict[str, List[List[float]]] = {}
+    trends: Dict[str, Tuple[Optional[float], Optional[float]]] = {}
+    for name, maps, pct, pid in results:
+        key = f"{name}@{starts.get(pid)}"
+        samples = [s for s in state.get(key, []) if now - s[0] <= args.window * 3600]
+        # Разреждане по време: последната проба е временна и се заменя с новата,
+        # докато не се отдалечи на step секунди от предпоследната
+        step = args.window * 3600 / (args.max_samples - 1)
+        if len(samples) >= 2 and samples[-1][0] - samples[-2][0] < step:
+            samples[-1] = [round(now), maps]
+        else:
+            samples.append([round(now), maps])
+        samples = samples[-args.max_samples:]
+        new_state[key] = samples
+        rate = growth_rate(samples)
+        hours = None
+        if rate and rate > 0 and samples[-1][0] - samples[0][0] >= args.min_span * 3600:
+            hours = (max_map - maps) / rate
+        trends[name] = (rate, hours)
+    if args.state_file:
+        # VM-и, които не са проверени сега, пазим докато историята им не изтече
+        for key, samples in state.items():
+            if key not in new_state and samples and now - samples[-1][0] <= args.window * 3600:
+                new_state[key] = samples
+        save_state(args.state_file, new_state)
+
     for name, maps, pct, pid in sorted(results, key=lambda x: x[0]):
         st = eval_status(pct, args.warn, args.crit)
+        rate, hours = trends.get(name, (None, None))
+        if hours is not None:
+            if args.hours_crit and hours <= args.hours_crit:
+                st = worst(st, N_CRIT)
+            elif args.hours_warn and hours <= args.hours_warn:
+                st = worst(st, N_WARN)
         overall = worst(overall, st)
-        msgs_human.append(f"{name}:{maps}/{max_map} ({pct:.1f}%)")
+        human = f"{name}:{maps}/{max_map} ({pct:.1f}%)"
+        if rate is not None:
+            human += f" {rate:+.1f}/h"
+        if hours is not None:
+            human += f" limit in {hours:.1f}h"
+        msgs_human.append(human)
 
         # perfdata
         label_maps = sanitize_label(f"{name}_maps")
@@ -234,6 +409,15 @@ def main():
         label_pct = sanitize_label(f"{name}_pct")
         perf.append(f"{label_pct}={pct:.2f}%;{args.warn:.2f};{args.crit:.2f};0;100")
 
+        if rate is not None:
+            label_growth = sanitize_label(f"{name}_growth")
+            perf.append(f"{label_growth}={rate:.2f}")
+        if hours is not None:
+            label_hours = sanitize_label(f"{name}_hours_to_limit")
+            hw = f"{args.hours_warn:g}:" if args.hours_warn else ""
+            hc = f"{args.hours_crit:g}:" if args.hours_crit else ""
+            perf.append(f"{label_hours}={hours:.1f};{hw};{hc};0")
+
     # добави unknown-и (без perfdata)
     if unknowns:
         overall = worst(overall, N_UNK)